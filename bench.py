@@ -0,0 +1,310 @@
+import argparse
+import copy
+import json
+import os
+import platform
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import cgroup
+import container
+import image
+import plan
+from cgroup import create_cgroup, invalidate_mount_index
+
+V1_SUBSYSTEMS = ["cpu", "cpuacct", "cpuset", "memory", "devices", "freezer", "net_cls", "net_prio", "blkio",
+                 "hugetlb", "pids"]
+V2_CONTROLLERS = ["cpuset", "cpu", "io", "memory", "hugetlb", "pids"]
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {"n": len(ordered),
+            "mean_us": round(sum(ordered) / len(ordered) * 1e6, 1),
+            "min_us": round(ordered[0] * 1e6, 1),
+            "p50_us": round(ordered[len(ordered) // 2] * 1e6, 1),
+            "p95_us": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1e6, 1)}
+
+
+class FakeCgroupfs:
+    # 在tmpfs上伪造cgroup层级和mountinfo，普通用户也可以运行cgroup相关的benchmark
+    # 新建的cgroup目录中预先放好所有会被写入的文件
+    def __init__(self, version, resources_list):
+        tmpfs = "/dev/shm" if os.access("/dev/shm", os.W_OK) else None
+        self.root = tempfile.mkdtemp(prefix="bench-cgroupfs-", dir=tmpfs)
+        self.version = version
+        self.files = {"cgroup.procs"} if version == 2 else {"cgroup.procs", "tasks"}
+        for resources in resources_list:
+            for knobs in plan.compile_cgroup_writes(resources, version).values():
+                self.files.update(filename for filename, _ in knobs)
+        lines = []
+        if version == 2:
+            mount_point = os.path.join(self.root, "unified")
+            self.make_dir(mount_point)
+            lines.append("30 25 0:26 / {0} rw,nosuid,nodev,noexec,relatime shared:4 - cgroup2 cgroup2 rw".format(
+                mount_point))
+        else:
+            for i, subsystem in enumerate(V1_SUBSYSTEMS):
+                mount_point = os.path.join(self.root, subsystem)
+                self.make_dir(mount_point)
+                lines.append("{0} 25 0:{0} / {1} rw,nosuid,nodev,noexec,relatime shared:{0} - cgroup cgroup "
+                             "rw,{2}".format(40 + i, mount_point, subsystem))
+        self.mountinfo = os.path.join(self.root, "mountinfo")
+        with open(self.mountinfo, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        self.saved = None
+
+    def make_dir(self, path):
+        os.mkdir(path)
+        for filename in self.files:
+            open(os.path.join(path, filename), "w").close()
+        if self.version == 2:
+            with open(os.path.join(path, "cgroup.controllers"), "w") as f:
+                f.write(" ".join(V2_CONTROLLERS) + "\n")
+            open(os.path.join(path, "cgroup.subtree_control"), "w").close()
+
+    def remove_dir(self, path):
+        shutil.rmtree(path)
+
+    def install(self):
+        self.saved = (cgroup.MOUNTINFO_PATH, cgroup.make_cgroup_dir, cgroup.remove_cgroup_dir)
+        cgroup.MOUNTINFO_PATH = self.mountinfo
+        cgroup.make_cgroup_dir = self.make_dir
+        cgroup.remove_cgroup_dir = self.remove_dir
+        invalidate_mount_index()
+
+    def uninstall(self):
+        if self.saved:
+            cgroup.MOUNTINFO_PATH, cgroup.make_cgroup_dir, cgroup.remove_cgroup_dir = self.saved
+            self.saved = None
+            invalidate_mount_index()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def spawn_sleepers(count):
+    # 真实cgroup上apply需要存在的进程
+    pids = []
+    for _ in range(count):
+        pid = os.fork()
+        if not pid:
+            signal.pause()
+            os._exit(0)
+        pids.append(pid)
+    return pids
+
+
+def kill_sleepers(pids):
+    for pid in pids:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+
+def bench_cgroup(name, resources, base, iterations, results):
+    # 每个资源key单独计时，再对整个配置计时
+    sections = [(key, {key: resources.get(key)}) for key in resources] + [("all", resources)]
+    for key, section in sections:
+        setup, teardown = [], []
+        try:
+            for _ in range(iterations):
+                start = time.perf_counter()
+                cg = create_cgroup("container_bench", section, base)
+                middle = time.perf_counter()
+                cg.clean()
+                setup.append(middle - start)
+                teardown.append(time.perf_counter() - middle)
+        except BaseException as e:
+            results["cgroup.setup.{0}.{1}".format(name, key)] = {"error": repr(e)}
+            continue
+        results["cgroup.setup.{0}.{1}".format(name, key)] = summarize(setup)
+        results["cgroup.teardown.{0}.{1}".format(name, key)] = summarize(teardown)
+
+
+def bench_apply(resources, base, pid_counts, iterations, real, results):
+    for count in pid_counts:
+        pids = spawn_sleepers(count) if real else list(range(100000, 100000 + count))
+        samples = []
+        try:
+            cg = create_cgroup("container_bench", resources, base)
+            try:
+                for _ in range(iterations):
+                    start = time.perf_counter()
+                    cg.apply(pids)
+                    samples.append(time.perf_counter() - start)
+            finally:
+                cg.clean()
+        except BaseException as e:
+            results["cgroup.apply.{0}".format(count)] = {"error": repr(e)}
+            continue
+        finally:
+            if real:
+                kill_sleepers(pids)
+        results["cgroup.apply.{0}".format(count)] = summarize(samples)
+
+
+def bench_config(config, workdir, container_id):
+    # 把fixture改写到工作目录中，容器进程立即退出
+    config = copy.deepcopy(config)
+    config["id"] = container_id
+    config["root"]["path"] = os.path.join(workdir, "root-{0}".format(container_id))
+    config["linux"]["cgroupsPath"] = os.path.join(workdir, "cgroups")
+    config["process"]["args"] = ["sh", "-c", "exit 0"]
+    return config
+
+
+def write_config(config, workdir):
+    path = os.path.join(workdir, "config-{0}.json".format(config.get("id")))
+    with open(path, "w") as f:
+        json.dump(config, f)
+    return path
+
+
+def launch_once(config_path):
+    # 从读取配置到容器进程被放行的时间
+    start = time.perf_counter()
+    launch = plan.load_plan(config_path)
+    cg, rootfs_mounted = container.prepare_container(launch)
+    child_pid, to_parent_r, to_child_w, trace_r = container.spawn_container(launch, config_path, cg)
+    container.release_child(child_pid, launch, to_parent_r, to_child_w, trace_r)
+    elapsed = time.perf_counter() - start
+    os.waitpid(child_pid, 0)
+    container.finish_container(launch, rootfs_mounted)
+    cg.clean()
+    return elapsed
+
+
+def bench_start(name, config, workdir, iterations, results):
+    store_root = image.STORE_ROOT
+    try:
+        # 冷启动：空的镜像仓库和启动计划缓存，重新读取挂载表
+        cold = []
+        config_path = write_config(bench_config(config, workdir, "{0}-cold".format(name)), workdir)
+        for i in range(iterations):
+            image.STORE_ROOT = os.path.join(workdir, "store-cold-{0}".format(i))
+            invalidate_mount_index()
+            cold.append(launch_once(config_path))
+        results["start.cold.{0}".format(name)] = summarize(cold)
+
+        # 热启动：镜像已经导入，启动计划已经缓存
+        image.STORE_ROOT = os.path.join(workdir, "store-warm")
+        config_path = write_config(bench_config(config, workdir, "{0}-warm".format(name)), workdir)
+        launch_once(config_path)
+        results["start.warm.{0}".format(name)] = summarize([launch_once(config_path) for _ in range(iterations)])
+    except BaseException as e:
+        results["start.{0}".format(name)] = {"error": repr(e)}
+    finally:
+        image.STORE_ROOT = store_root
+
+
+def bench_bulk(name, config, workdir, size, jobs, results):
+    store_root = image.STORE_ROOT
+    image.STORE_ROOT = os.path.join(workdir, "store-warm")
+    path = os.path.join(workdir, "bulk-{0}.jsonl".format(name))
+    configs = [bench_config(config, workdir, "{0}-bulk{1}".format(name, i)) for i in range(size)]
+    with open(path, "w") as f:
+        f.write("".join(json.dumps(c) + "\n" for c in configs))
+    try:
+        start = time.perf_counter()
+        container.bulk_main(path, jobs)
+        elapsed = time.perf_counter() - start
+        results["bulk.{0}".format(name)] = {"n": size, "seconds": round(elapsed, 4),
+                                            "containers_per_s": round(size / elapsed, 1)}
+    except BaseException as e:
+        results["bulk.{0}".format(name)] = {"error": repr(e)}
+    finally:
+        image.STORE_ROOT = store_root
+        # 容器退出后cgroup不会自动删除
+        for c in configs:
+            create_cgroup("container_{0}".format(c.get("id")), c.get("linux").get("resources"),
+                          c.get("linux").get("cgroupsPath"), create=False).clean()
+
+
+def metadata(args):
+    try:
+        commit = subprocess.run(["git", "-C", BENCH_DIR, "rev-parse", "HEAD"], capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "time": time.time(), "kernel": platform.release(), "python": platform.python_version(),
+            "cpus": os.cpu_count(), "cgroupfs": "real" if args.real else "fake-v{0}".format(args.version),
+            "iterations": args.n}
+
+
+def print_results(results, previous=None):
+    for key in sorted(results):
+        value = results.get(key)
+        if "error" in value:
+            line = "{0:48} error: {1}".format(key, value.get("error"))
+        elif "containers_per_s" in value:
+            line = "{0:48} {1:>10.1f} containers/s".format(key, value.get("containers_per_s"))
+        else:
+            line = "{0:48} {1:>10.1f} us p50 {2:>10.1f} us p95".format(key, value.get("p50_us"), value.get("p95_us"))
+        old = (previous or {}).get(key) or {}
+        metric = "containers_per_s" if "containers_per_s" in value else "p50_us"
+        if old.get(metric) and value.get(metric) is not None:
+            line += "  {0:+.1f}%".format((value.get(metric) - old.get(metric)) / old.get(metric) * 100)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="container benchmarks")
+    parser.add_argument('-config', default="{0},{1}".format(os.path.join(BENCH_DIR, "config_1.json"),
+                                                            os.path.join(BENCH_DIR, "config_2.json")),
+                        help='comma separated fixture configs')
+    parser.add_argument('-n', type=int, default=20, help='iterations of each benchmark')
+    parser.add_argument('-version', type=int, choices=[1, 2], default=1, help='layout of the fake cgroup hierarchy')
+    parser.add_argument('-real', action='store_true', help='use the real cgroup hierarchy, requires root')
+    parser.add_argument('-pids', default="1,16,64,256", help='comma separated process counts for apply()')
+    parser.add_argument('-bulk-size', type=int, default=16, help='containers started by the bulk benchmark')
+    parser.add_argument('-jobs', type=int, default=os.cpu_count(), help='concurrency of the bulk benchmark')
+    parser.add_argument('-skip-start', action='store_true', help='skip container start benchmarks')
+    parser.add_argument('-output', help='write results as json to this file')
+    parser.add_argument('-compare', help='results json of an earlier run to compare with')
+    args = parser.parse_args()
+
+    fixtures = []
+    for path in args.config.split(','):
+        with open(path, "r") as f:
+            fixtures.append((os.path.splitext(os.path.basename(path))[0], json.load(f)))
+    if args.real and os.geteuid() != 0:
+        container.err_exit("-real requires root")
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    fake = None if args.real else FakeCgroupfs(args.version, [c.get("linux").get("resources") for _, c in fixtures])
+    if fake:
+        fake.install()
+    results = {}
+    try:
+        base = os.path.join(workdir, "cgroups")
+        os.mkdir(base)
+        for name, config in fixtures:
+            bench_cgroup(name, config.get("linux").get("resources"), base, args.n, results)
+        bench_apply(fixtures[0][1].get("linux").get("resources"), base,
+                    [int(x) for x in args.pids.split(',')], args.n, args.real, results)
+        # 启动容器需要创建namespace和挂载，只在root下运行
+        if not args.skip_start and os.geteuid() == 0:
+            for name, config in fixtures:
+                bench_start(name, config, workdir, args.n, results)
+                bench_bulk(name, config, workdir, args.bulk_size, args.jobs, results)
+    finally:
+        if fake:
+            fake.uninstall()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    previous = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            previous = json.load(f).get("results")
+    print_results(results, previous)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": metadata(args), "results": results}, f, indent=1)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,98 +1,182 @@
 import json
 import os
-import subprocess
+import re
 import sys
+import signal
+import threading
+import time
 import traceback
 
+from tracing import event, span
+from unshare import mount, umount2
+
+
+MOUNTINFO_PATH = "/proc/self/mountinfo"
+CGROUPS_PATH = "/proc/cgroups"
+# 读不到/proc/cgroups时使用的v1 controller列表
+V1_CONTROLLERS = ["cpu", "cpuacct", "cpuset", "memory", "devices", "freezer", "net_cls", "net_prio", "blkio",
+                  "perf_event", "hugetlb", "pids", "rdma", "misc"]
+
+# 挂载表索引，只在本进程挂载/卸载cgroup时失效
+_mount_index = None
+_mount_index_lock = threading.Lock()
+
+
+def unescape_mount_field(field):
+    # mountinfo中空格等字符以\040形式的八进制转义
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+
+def kernel_controllers():
+    # /proc/cgroups的第一列是内核支持的controller
+    try:
+        with open(CGROUPS_PATH, "r") as f:
+            return set(line.split()[0] for line in f if line.strip() and not line.startswith('#'))
+    except OSError:
+        return set(V1_CONTROLLERS)
+
+
+def parse_mountinfo(path=MOUNTINFO_PATH, controllers=None):
+    subsystems = {}
+    unified = None
+    controllers = set(controllers or kernel_controllers())
+    with open(path, "r") as f:
+        for line in f:
+            fields = line.split()
+            separator = fields.index('-')
+            mount_point = unescape_mount_field(fields[4])
+            fs_type = fields[separator + 1]
+            if fs_type == "cgroup":
+                for option in fields[separator + 3].split(','):
+                    # 只索引controller，跳过xattr等挂载选项和name=systemd这样的命名hierarchy
+                    if option not in controllers:
+                        continue
+                    # v1挂载优先于v2，同一controller以第一个挂载点为准
+                    if subsystems.get(option, (None, 2))[1] == 2:
+                        subsystems[option] = (mount_point, 1)
+            elif fs_type == "cgroup2" and unified is None:
+                unified = mount_point
+                try:
+                    with open(os.path.join(mount_point, "cgroup.controllers"), "r") as cf:
+                        enabled = cf.read().split()
+                except OSError:
+                    enabled = []
+                for controller in enabled:
+                    subsystems.setdefault(controller, (mount_point, 2))
+    return {"subsystems": subsystems, "unified": unified}
+
+
+def get_mount_index():
+    global _mount_index
+    with _mount_index_lock:
+        if _mount_index is None:
+            with span("cgroup.discovery"):
+                _mount_index = parse_mountinfo(MOUNTINFO_PATH)
+        return _mount_index
+
+
+def invalidate_mount_index():
+    global _mount_index
+    _mount_index = None
+
 
 def find_subsystem_dir(subsystem):
-    # find in cgroup v1
-    out_string = subprocess.check_output(['mount', '--type', 'cgroup']).decode().rstrip()
-    if out_string:
-        for line in out_string.split('\n'):
-            attr = line.split(' ')[-1].strip('(').strip(')').split(',')
-            if subsystem in attr:
-                index = attr.index(subsystem) - len(attr)
-                directory = line.split(' ')[2]
-                return line.split(' ')[2], 1
-    # find in cgroup v2
-    out_string = subprocess.check_output(['mount', '--type', 'cgroup2']).decode().rstrip()
-    for line in out_string.split('\n'):
-        cg_dir = line.split(' ')[2]
-        with open(os.path.join(cg_dir, "cgroup.subtree_control"), "r") as f:
-            subsystems = f.readline()
-        if subsystem in subsystems:
-            return cg_dir, 2
-    return None, None
+    return get_mount_index().get("subsystems").get(subsystem, (None, None))
 
 
 def mount_subsystem_v1(subsystem, directory, name=""):
     if find_subsystem_dir(subsystem) != (None, None):
         raise CgroupError("subsystem {0} already mount".format(subsystem))
-    subprocess.run(["mount", "-t", "cgroup", "-o", subsystem, name, directory])
+    mount(name, directory, "cgroup", 0, subsystem)
+    invalidate_mount_index()
+
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+# v1中-1写入后读出的是按页对齐的最大值
+UNLIMITED = 1 << 62
+
+
+# 容器cgroup目录的创建和删除，benchmark在伪造的cgroupfs上替换为普通目录操作
+def make_cgroup_dir(path):
+    os.mkdir(path)
+
+
+def remove_cgroup_dir(path):
+    os.rmdir(path)
 
 
 def write_value(directory, filename, content):
     if os.path.exists(os.path.join(directory, filename)):
         with open(os.path.join(directory, filename), "w") as f:
-            print("writing {0} {1}".format(filename, str(content)))
+            event("cgroup.write", file=filename, value=content)
             f.write(str(content))
     else:
-        print("file {0} not exist".format(os.path.join(directory, filename)))
+        event("cgroup.missing", file=os.path.join(directory, filename))
 
 
-def cfg_cpu(directory, config):
-    write_value(directory, "cpu.cfs_quota_us", config.get("quota"))
-    write_value(directory, "cpu.cfs_period_us", config.get("period"))
-    write_value(directory, "cpu.shares", config.get("shares"))
-    # write_value(directory, "cpu.rt_runtime_us", config.get("realtimeRuntime"))
-    # write_value(directory, "cpu.rt_period_us", config.get("realtimePeriod"))
+def write_values(directory, knobs):
+    for filename, content in knobs:
+        write_value(directory, filename, content)
 
 
-def cfg_cpuset(directory, config):
-    write_value(directory, "cpuset.cpus", config.get("cpus"))
-    write_value(directory, "cpuset.mems", config.get("mems"))
+def read_value(directory, filename):
+    try:
+        with open(os.path.join(directory, filename), "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
 
 
-def cfg_memory(directory, config):
-    write_value(directory, "memory.limit_in_bytes", config.get("limit"))
-    write_value(directory, "memory.soft_limit_in_bytes", config.get("reservation"))
-    write_value(directory, "memory.memsw.limit_in_bytes", int(config.get("limit")) + int(config.get("swap")))
-    write_value(directory, "memory.kmem.limit_in_bytes", config.get("kernel"))
-    write_value(directory, "memory.kmem.tcp.limit_in_bytes", config.get("kernelTCP"))
-    write_value(directory, "memory.swappiness", config.get("swappiness"))
+# knobs_<subsystem>返回按写入顺序排列的(文件名, 值)列表
+def knobs_cpu(config):
+    return [("cpu.cfs_quota_us", config.get("quota")),
+            ("cpu.cfs_period_us", config.get("period")),
+            ("cpu.shares", config.get("shares"))]
+    # ("cpu.rt_runtime_us", config.get("realtimeRuntime"))
+    # ("cpu.rt_period_us", config.get("realtimePeriod"))
 
-    write_value(directory, "memory.swappiness", config.get("swappiness"))
 
-    if config.get("disableOOMKiller"):
-        write_value(directory, "memory.oom_control", '1')
-    else:
-        write_value(directory, "memory.oom_control", '0')
+def knobs_cpuset(config):
+    return [("cpuset.cpus", config.get("cpus")),
+            ("cpuset.mems", config.get("mems"))]
+
+
+def knobs_memory(config):
+    # memsw不能小于limit，创建时memsw是无限大，先写limit
+    return [("memory.limit_in_bytes", config.get("limit")),
+            ("memory.soft_limit_in_bytes", config.get("reservation")),
+            ("memory.memsw.limit_in_bytes", int(config.get("limit")) + int(config.get("swap"))),
+            ("memory.kmem.limit_in_bytes", config.get("kernel")),
+            ("memory.kmem.tcp.limit_in_bytes", config.get("kernelTCP")),
+            ("memory.swappiness", config.get("swappiness")),
+            ("memory.oom_control", '1' if config.get("disableOOMKiller") else '0')]
 
 
-def cfg_network(directory, config):
-    write_value(directory, "net_cls.classid", config.get("classID"))
+def knobs_network(config):
     value = ""
     for kv in config.get("priorities"):
         value += "{0} {1}\n".format(kv.get("name"), kv.get("priority"))
-    write_value(directory, "net_prio.ifpriomap", value)
+    return [("net_cls.classid", config.get("classID")),
+            ("net_prio.ifpriomap", value)]
 
 
-def cfg_blkio(directory, config):
-    # write_value(directory,"blkio.weight",config.get("weight"))
-    # write_value(directory, "blkio.weight_device", config.get("weightDevice"))
+def knobs_blkio(config):
+    # ("blkio.weight", config.get("weight"))
+    # ("blkio.weight_device", config.get("weightDevice"))
     # leafWeight
     data = ""
     for each in config.get("throttleReadBpsDevice"):
         data += "{0}:{1} {2}\n".format(each.get("major"), each.get("minor"), each.get("rate"))
-    write_value(directory, "blkio.throttle.read_bps_device", data)
+    knobs = [("blkio.throttle.read_bps_device", data)]
     data = ""
     for each in config.get("throttleWriteIOPSDevice"):
         data += "{0}:{1} {2}\n".format(each.get("major"), each.get("minor"), each.get("rate"))
-    write_value(directory, "blkio.throttle.write_iops_device", data)
+    knobs.append(("blkio.throttle.write_iops_device", data))
+    return knobs
 
 
-def cfg_devices(directory, config):
+def knobs_devices(config):
+    knobs = []
     # 先执行所有deny
     for device in config:
         dev_type = device.get("type") if device.get("type") else "a"
@@ -100,8 +184,7 @@ def cfg_devices(directory, config):
         dev_minor = device.get("minor") if device.get("minor") else "*"
         dev_access = device.get("access") if device.get("access") else "rwm"
         if device.get("deny"):
-            write_value(directory, "devices.deny",
-                        "{0} {1}:{2} {3}".format(dev_type, dev_major, dev_minor, dev_access))
+            knobs.append(("devices.deny", "{0} {1}:{2} {3}".format(dev_type, dev_major, dev_minor, dev_access)))
     # 再执行所有allow
     for device in config:
         dev_type = device.get("type") if device.get("type") else "a"
@@ -109,23 +192,197 @@ def cfg_devices(directory, config):
         dev_minor = device.get("minor") if device.get("minor") else "*"
         dev_access = device.get("access") if device.get("access") else "rwm"
         if device.get("allow"):
-            write_value(directory, "devices.allow",
-                        "{0} {1}:{2} {3}".format(dev_type, dev_major, dev_minor, dev_access))
+            knobs.append(("devices.allow", "{0} {1}:{2} {3}".format(dev_type, dev_major, dev_minor, dev_access)))
+    return knobs
 
 
-def cfg_hugetlb(directory, config):
-    for limit in config:
-        name = limit.get("pageSize")
-        limitation = limit.get("limit")
-        if os.path.exists("hugetlb.{0}.limit_in_bytes".format(name)):
-            write_value(directory, "hugetlb.{0}.limit_in_bytes", limitation)
-        else:
-            print("pageSize {0} not recognized/supported".format(name))
+def knobs_hugetlb(config):
+    return [("hugetlb.{0}.limit_in_bytes".format(limit.get("pageSize")), limit.get("limit")) for limit in config]
+
+
+def knobs_pids(config):
+    return [("pids.max", config.get("limit"))]
+
+
+# cgroup v2 统一层级下的配置，按资源配置的key命名
+def cpu_shares_to_weight(shares):
+    # cpu.shares [2, 262144] 映射到 cpu.weight [1, 10000]
+    return 1 + ((int(shares) - 2) * 9999) // 262142
+
+
+def blkio_weight_to_io_weight(weight):
+    # blkio.weight [10, 1000] 映射到 io.weight [1, 10000]
+    return 1 + ((int(weight) - 10) * 9999) // 990
+
+
+def max_value(value):
+    return "max" if value is None or int(value) < 0 else value
+
+
+def knobs2_cpu(config):
+    knobs = []
+    if config.get("quota") is not None or config.get("period") is not None:
+        knobs.append(("cpu.max", "{0} {1}".format(max_value(config.get("quota")), config.get("period") or 100000)))
+    if config.get("shares"):
+        knobs.append(("cpu.weight", cpu_shares_to_weight(config.get("shares"))))
+    if config.get("cpus"):
+        knobs.append(("cpuset.cpus", config.get("cpus")))
+    if config.get("mems"):
+        knobs.append(("cpuset.mems", config.get("mems")))
+    return knobs
+
+
+def knobs2_memory(config):
+    knobs = []
+    if config.get("limit") is not None:
+        knobs.append(("memory.max", max_value(config.get("limit"))))
+    if config.get("reservation") is not None:
+        knobs.append(("memory.low", max_value(config.get("reservation"))))
+    if config.get("swap") is not None:
+        knobs.append(("memory.swap.max", max_value(config.get("swap"))))
+    if config.get("disableOOMKiller"):
+        event("cgroup.unsupported", key="memory.disableOOMKiller", version=2)
+    return knobs
+
+
+def knobs2_network(config):
+    event("cgroup.unsupported", key="network", version=2)
+    return []
+
+
+def knobs2_devices(config):
+    # device cgroup在v2中需要eBPF
+    event("cgroup.unsupported", key="devices", version=2)
+    return []
+
+
+def knobs2_blockIO(config):
+    knobs = []
+    if config.get("weight"):
+        knobs.append(("io.weight", "default {0}".format(blkio_weight_to_io_weight(config.get("weight")))))
+    # 同一个设备的所有限制合并成io.max中的一行
+    limits = {}
+    for key, name in [("throttleReadBpsDevice", "rbps"), ("throttleWriteBpsDevice", "wbps"),
+                      ("throttleReadIOPSDevice", "riops"), ("throttleWriteIOPSDevice", "wiops")]:
+        for each in config.get(key) or []:
+            device = "{0}:{1}".format(each.get("major"), each.get("minor"))
+            limits.setdefault(device, []).append("{0}={1}".format(name, each.get("rate")))
+    for device, values in limits.items():
+        knobs.append(("io.max", "{0} {1}".format(device, " ".join(values))))
+    return knobs
+
+
+def knobs2_hugepageLimits(config):
+    return [("hugetlb.{0}.max".format(limit.get("pageSize")), limit.get("limit")) for limit in config]
+
+
+def knobs2_pids(config):
+    return [("pids.max", max_value(config.get("limit")))]
+
+
+# OCI的unified字段直接给出cgroup v2的文件和值
+def knobs2_unified(config):
+    return list(config.items())
+
+
+def parse_cpu_list(value):
+    result = set()
+    for part in value.replace("\n", ",").split(','):
+        if '-' in part:
+            low, high = part.split('-')
+            result.update(range(int(low), int(high) + 1))
+        elif part.strip():
+            result.add(int(part))
+    return result
+
+
+# 内存的字节数限制写入后按页向下取整，-1读回的是按页对齐的最大值
+MEMORY2_BYTE_KNOBS = ["memory.max", "memory.high", "memory.low", "memory.min", "memory.swap.max"]
+
+
+def page_rounded(filename):
+    return filename.startswith("memory.") and (filename.endswith("_in_bytes") or filename in MEMORY2_BYTE_KNOBS)
+
+
+def token_matches(current, desired, rounded=False):
+    try:
+        current, desired = int(current), int(desired)
+    except ValueError:
+        return current == desired
+    if current == desired:
+        return True
+    if not rounded:
+        return False
+    if desired < 0:
+        return current >= UNLIMITED
+    return current == desired // PAGE_SIZE * PAGE_SIZE
+
+
+def value_matches(filename, current, desired):
+    if desired is None:
+        return True
+    if current is None:
+        return False
+    # 按行生成的值只有一行时，去掉结尾的换行之前记下
+    per_line = "\n" in str(desired) or filename == "io.max"
+    desired = str(desired).strip()
+    if filename.startswith("cpuset."):
+        return parse_cpu_list(current) == parse_cpu_list(desired)
+    if filename == "memory.oom_control":
+        current = current.split('\n')[0].split()[-1]
+    # 按设备或网卡分行的文件，只要求期望的每一行都已经存在
+    if per_line:
+        current_lines = [line.split() for line in current.split('\n')]
+        for line in desired.split('\n'):
+            tokens = line.split()
+            if tokens and not any(c and c[0] == tokens[0] and all(t in c for t in tokens[1:])
+                                  for c in current_lines):
+                return False
+        return True
+    current, desired = current.split(), desired.split()
+    rounded = page_rounded(filename)
+    return len(current) == len(desired) and all(token_matches(c, d, rounded) for c, d in zip(current, desired))
+
+
+# (a, b): a不能小于b，调大时先写a，调小时先写b
+KNOB_ORDER = [("memory.memsw.limit_in_bytes", "memory.limit_in_bytes")]
+
+
+def order_changes(directory, changes):
+    changes = list(changes)
+    filenames = [filename for filename, _ in changes]
+    for upper, lower in KNOB_ORDER:
+        if upper not in filenames or lower not in filenames:
+            continue
+        upper_change = changes[filenames.index(upper)]
+        lower_change = changes[filenames.index(lower)]
+        current = read_value(directory, upper)
+        raising = current is None or int(current) < int(upper_change[1])
+        changes.remove(upper_change)
+        changes.remove(lower_change)
+        changes += [upper_change, lower_change] if raising else [lower_change, upper_change]
+        filenames = [filename for filename, _ in changes]
+    return changes
+
+
+# 只保留与cgroup文件中当前值不同的配置项
+def diff_knobs(directory, knobs, section_changed):
+    changes = []
+    for filename, value in knobs:
+        if value is None:
+            continue
+        current = read_value(directory, filename)
+        # devices.allow等只写文件无法读回，只在配置变化时写入
+        if current is None and os.path.exists(os.path.join(directory, filename)):
+            if section_changed:
+                changes.append((filename, value))
+        elif not value_matches(filename, current, value):
+            changes.append((filename, value))
+    return order_changes(directory, changes)
 
 
-def cfg_pids(directory, config):
-    pid_max = config.get("limit")
-    write_value(directory, "pids.max", pid_max)
+# 资源配置中所有的key
+RESOURCE_KEYS = ["cpu", "memory", "network", "pids", "hugepageLimits", "devices", "blockIO"]
 
 
 class CgroupError(Exception):
@@ -152,11 +409,35 @@ def keys2subsystems(keys):
             result += ["devices"]
         elif key == "blockIO":
             result += ["blkio"]
+        elif key == "unified":
+            # 只用于cgroup v2
+            continue
         else:
             raise CgroupError("subsystem config name {0} not recognised".format(key))
     return result
 
 
+def resources2controllers(config):
+    result = []
+    for key in config:
+        if key == "cpu":
+            result += ["cpu", "cpuset"]
+        elif key == "memory":
+            result += ["memory"]
+        elif key == "pids":
+            result += ["pids"]
+        elif key == "hugepageLimits":
+            result += ["hugetlb"]
+        elif key == "blockIO":
+            result += ["io"]
+        elif key == "unified":
+            # 文件名的前缀就是controller名
+            result += [x.split('.')[0] for x in config.get(key) if not x.startswith("cgroup.")]
+        elif key not in ["network", "devices"]:
+            raise CgroupError("subsystem config name {0} not recognised".format(key))
+    return result
+
+
 def subsystem2key(subsystem):
     if subsystem in ["cpu", "cpuset"]:
         result = "cpu"
@@ -178,11 +459,19 @@ def subsystem2key(subsystem):
 
 
 class cgroupv1:
-    def __init__(self, name, config, cgroup_base_dir):
-        self.config = config
+    # create为False时只记录已经存在的cgroup，不创建也不写入配置
+    # 此时config是cgroup当前已经应用的配置，不知道时为None
+    # writes为预先计算好的{subsystem: [(文件名, 值)]}，不给出时根据config计算
+    def __init__(self, name, config, cgroup_base_dir, create=True, writes=None):
+        self.config = dict(config or {})
+        # 不知道已应用的配置时，无法判断devices.allow等只写文件是否需要重新写入
+        self.config_known = create or config is not None
         self.subsystem_info = {}
         self.name = name
         self.cgroup_base_dir = cgroup_base_dir
+        if not create:
+            self.attach()
+            return
         try:
             # print(key2subsystem(config.keys()))
             for subsystem in keys2subsystems(config.keys()):
@@ -200,24 +489,60 @@ class cgroupv1:
 
                 # 创建cgroup目录
                 if not os.path.exists("{0}/{1}".format(subsystem_dir, self.name)):
-                    print("mkdir {0}/{1}".format(subsystem_dir, self.name))
-                    os.mkdir("{0}/{1}".format(subsystem_dir, self.name))
+                    event("cgroup.mkdir", path="{0}/{1}".format(subsystem_dir, self.name))
+                    make_cgroup_dir("{0}/{1}".format(subsystem_dir, self.name))
 
                 # 写入配置信息
                 key = subsystem2key(subsystem)
                 subsystem_config = config.get(key)
-                if globals().get("cfg_{0}".format(subsystem)):
-                    print("calling cfg_{0}".format(subsystem))
-                    globals().get("cfg_{0}".format(subsystem))("{0}/{1}".format(subsystem_dir, self.name), subsystem_config)
+                with span("cgroup.knobs", subsystem=subsystem):
+                    if writes is not None:
+                        write_values("{0}/{1}".format(subsystem_dir, self.name), writes.get(subsystem, []))
+                    elif globals().get("knobs_{0}".format(subsystem)):
+                        write_values("{0}/{1}".format(subsystem_dir, self.name),
+                                     globals().get("knobs_{0}".format(subsystem))(subsystem_config))
 
         except BaseException as e:
             print(traceback.format_exc())
             self.clean()
             sys.exit(-1)
 
+    def attach(self):
+        for subsystem in keys2subsystems(RESOURCE_KEYS):
+            subsystem_dir, version = find_subsystem_dir(subsystem)
+            if version != 1 or not os.path.exists("{0}/{1}".format(subsystem_dir, self.name)):
+                continue
+            self.subsystem_info.update({subsystem: {"mount_point": subsystem_dir}})
+            if subsystem_dir.startswith(os.path.join(self.cgroup_base_dir, "")):
+                self.subsystem_info.get(subsystem).update({"mount_by_hand": True})
+
+    # 只写入与cgroup文件当前值不同的配置项
+    def update(self, config):
+        for subsystem in keys2subsystems(config.keys()):
+            subsystem_dir = self.subsystem_info.get(subsystem, {}).get("mount_point")
+            if not subsystem_dir:
+                event("cgroup.skip_update", subsystem=subsystem, name=self.name)
+                continue
+            knobs = globals().get("knobs_{0}".format(subsystem))
+            if not knobs:
+                continue
+            key = subsystem2key(subsystem)
+            subsystem_config = merge_section(self.config.get(key), config.get(key))
+            directory = "{0}/{1}".format(subsystem_dir, self.name)
+            write_values(directory, diff_knobs(directory, knobs(subsystem_config),
+                                               self.section_changed(key, subsystem_config)))
+        for key in config:
+            self.config[key] = merge_section(self.config.get(key), config.get(key))
+
+    def section_changed(self, key, section):
+        if not self.config_known:
+            event("cgroup.write_only_skipped", name=self.name, key=key)
+            return False
+        return section != self.config.get(key)
+
     # 根据subsystem_info中记录的信息，清理创建的目录和挂载点
     def clean(self):
-        print("start cleaning")
+        event("cgroup.clean", name=self.name)
         for key in self.subsystem_info:
             subsystem = self.subsystem_info.get(key)
             subsystem_dir = subsystem.get("mount_point")
@@ -226,18 +551,15 @@ class cgroupv1:
             # 删除创建的cgroup目录
             if os.path.exists("{0}/{1}".format(subsystem_dir, self.name)):
                 try:
-                    with open("{0}/{1}/cgroup.procs".format(subsystem_dir, self.name), "r") as f:
-                        process_list = [x.strip() for x in f.read().strip().split('\n')]
-                    for process in process_list:
-                        with open("{0}/cgroup.procs".format(subsystem_dir), "w") as f:
-                            f.write(process)
+                    move_processes("{0}/cgroup.procs".format(subsystem_dir),
+                                   read_processes("{0}/{1}".format(subsystem_dir, self.name)))
                 except OSError as e:
                     print("rmdir {0}/{1} failed".format(subsystem_dir, self.name))
                     print(traceback.format_exc())
                     continue
-                print("doing rmdir {0}/{1}".format(subsystem_dir, self.name))
+                event("cgroup.rmdir", path="{0}/{1}".format(subsystem_dir, self.name))
                 try:
-                    os.rmdir("{0}/{1}".format(subsystem_dir, self.name))
+                    remove_cgroup_dir("{0}/{1}".format(subsystem_dir, self.name))
                 except OSError as e:
                     print("rmdir {0}/{1} failed".format(subsystem_dir, self.name))
                     print(traceback.format_exc())
@@ -245,29 +567,287 @@ class cgroupv1:
             # 如果subsystem是手动挂载的，那么移除
             if subsystem.get("mount_by_hand"):
                 if os.path.exists(subsystem_dir):
-                    print("doing umount {0}".format(subsystem_dir))
+                    event("cgroup.umount", path=subsystem_dir)
                     try:
-                        subprocess.run(["umount", subsystem_dir])
+                        umount2(subsystem_dir)
+                        invalidate_mount_index()
                     except BaseException as e:
                         print("doing umount {0} failed".format(subsystem_dir))
                         print(traceback.format_exc())
-                    print("doing rmdir {0}".format(subsystem_dir))
+                    event("cgroup.rmdir", path=subsystem_dir)
                     try:
                         os.rmdir(subsystem_dir)
                     except OSError as e:
                         print("rmdir {0} failed".format(subsystem_dir))
                         print(traceback.format_exc())
 
-        print("cleaning finished")
+    def directories(self):
+        return ["{0}/{1}".format(subsystem.get("mount_point"), self.name)
+                for subsystem in self.subsystem_info.values() if subsystem.get("mount_point")]
+
+    # 杀死cgroup中的所有进程，超时仍有进程残留时返回False，timeout为0时发送信号后立即返回
+    def kill(self, timeout=5.0):
+        with span("cgroup.kill", name=self.name):
+            return kill_processes_v1(self.name, self.directories(), timeout)
+
+    def teardown(self, timeout=5.0):
+        drained = self.kill(timeout)
+        self.clean()
+        return drained
+
+    # v1没有统一的cgroup目录，不能使用CLONE_INTO_CGROUP
+    def open_fd(self):
+        return None
 
     # 将一组进程放到所有subsystem的控制下
     def apply(self, process_list):
         for key in self.subsystem_info:
             subsystem = self.subsystem_info.get(key)
             subsystem_dir = subsystem.get("mount_point")
-            for process in process_list:
-                with open("{0}/{1}/{2}".format(subsystem_dir, self.name, "cgroup.procs"), "w") as f:
-                    f.write(str(process))
+            with span("cgroup.apply", subsystem=key, pids=len(process_list)):
+                for process in process_list:
+                    with open("{0}/{1}/{2}".format(subsystem_dir, self.name, "cgroup.procs"), "w") as f:
+                        f.write(str(process))
+
+
+class cgroupv2:
+    # create为False时只记录已经存在的cgroup，不创建也不写入配置
+    # 此时config是cgroup当前已经应用的配置，不知道时为None
+    # writes为预先计算好的{资源key: [(文件名, 值)]}，不给出时根据config计算
+    def __init__(self, name, config, cgroup_base_dir, create=True, writes=None):
+        self.config = dict(config or {})
+        self.config_known = create or config is not None
+        self.name = name
+        self.cgroup_base_dir = cgroup_base_dir
+        self.mount_point = None
+        self.mount_by_hand = False
+        self.path = None
+        if not create:
+            self.mount_point = get_mount_index().get("unified")
+            if not self.mount_point:
+                raise CgroupError("no cgroup2 hierarchy is mounted for {0}".format(self.name))
+            self.path = os.path.join(self.mount_point, self.name)
+            self.mount_by_hand = self.mount_point.startswith(os.path.join(self.cgroup_base_dir, ""))
+            return
+        try:
+            mount_point = get_mount_index().get("unified")
+            if not mount_point:
+                mount_point = os.path.join(self.cgroup_base_dir, "unified")
+                os.mkdir(mount_point)
+                mount("cgroup2", mount_point, "cgroup2")
+                invalidate_mount_index()
+                self.mount_by_hand = True
+            self.mount_point = mount_point
+
+            # 在父cgroup中启用需要的controller
+            enable_controllers(mount_point, resources2controllers(config))
+
+            # 创建cgroup目录
+            self.path = os.path.join(mount_point, self.name)
+            if not os.path.exists(self.path):
+                event("cgroup.mkdir", path=self.path)
+                make_cgroup_dir(self.path)
+
+            # 写入配置信息
+            for key in config:
+                with span("cgroup.knobs", key=key):
+                    if writes is not None:
+                        write_values(self.path, writes.get(key, []))
+                    elif globals().get("knobs2_{0}".format(key)):
+                        write_values(self.path, globals().get("knobs2_{0}".format(key))(config.get(key)))
+
+        except BaseException as e:
+            print(traceback.format_exc())
+            self.clean()
+            sys.exit(-1)
+
+    # 只写入与cgroup文件当前值不同的配置项
+    def update(self, config):
+        enable_controllers(self.mount_point, resources2controllers(config))
+        for key in config:
+            knobs = globals().get("knobs2_{0}".format(key))
+            if not knobs:
+                continue
+            section = merge_section(self.config.get(key), config.get(key))
+            write_values(self.path, diff_knobs(self.path, knobs(section), self.section_changed(key, section)))
+            self.config[key] = section
+
+    def section_changed(self, key, section):
+        if not self.config_known:
+            event("cgroup.write_only_skipped", name=self.name, key=key)
+            return False
+        return section != self.config.get(key)
+
+    # 清理创建的目录和挂载点
+    def clean(self):
+        event("cgroup.clean", name=self.name)
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(os.path.join(self.path, "cgroup.procs"), "r") as f:
+                    process_list = f.read().split()
+                move_processes(os.path.join(self.mount_point, "cgroup.procs"), process_list)
+                event("cgroup.rmdir", path=self.path)
+                remove_cgroup_dir(self.path)
+            except OSError as e:
+                print("rmdir {0} failed".format(self.path))
+                print(traceback.format_exc())
+
+        if self.mount_by_hand and os.path.exists(self.mount_point):
+            event("cgroup.umount", path=self.mount_point)
+            try:
+                umount2(self.mount_point)
+                invalidate_mount_index()
+                os.rmdir(self.mount_point)
+            except OSError as e:
+                print("umount {0} failed".format(self.mount_point))
+                print(traceback.format_exc())
+
+    def directories(self):
+        return [self.path] if self.path else []
+
+    def kill(self, timeout=5.0):
+        if not self.path or not os.path.exists(self.path):
+            return True
+        with span("cgroup.kill", name=self.name):
+            return kill_processes_v2(self.path, timeout)
+
+    def teardown(self, timeout=5.0):
+        drained = self.kill(timeout)
+        self.clean()
+        return drained
+
+    # 用于clone3的CLONE_INTO_CGROUP
+    def open_fd(self):
+        return os.open(self.path, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+
+    # 统一层级中只需写一次cgroup.procs
+    def apply(self, process_list):
+        with span("cgroup.apply", pids=len(process_list)):
+            move_processes(os.path.join(self.path, "cgroup.procs"), process_list)
+
+
+def move_processes(procs_file, process_list):
+    # cgroup.procs每次write只能写入一个pid，保持文件打开逐个写入
+    fd = os.open(procs_file, os.O_WRONLY)
+    try:
+        for process in process_list:
+            try:
+                os.write(fd, str(process).encode())
+            except ProcessLookupError:
+                # 进程已经退出
+                continue
+    finally:
+        os.close(fd)
+
+
+def read_processes(directory):
+    try:
+        with open(os.path.join(directory, "cgroup.procs"), "r") as f:
+            return [int(x) for x in f.read().split()]
+    except (OSError, ValueError):
+        return []
+
+
+def signal_processes(process_list, sig):
+    for process in process_list:
+        try:
+            os.kill(process, sig)
+        except ProcessLookupError:
+            continue
+
+
+def drain(directories, deadline):
+    # 等待被杀死的进程退出，间隔逐渐加长
+    delay = 0.0005
+    while True:
+        if not any(read_processes(directory) for directory in directories):
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 0.05)
+
+
+def kill_processes_v2(path, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    if os.path.exists(os.path.join(path, "cgroup.kill")):
+        # 5.14以上的内核由内核一次杀死整个cgroup，包括正在fork的进程
+        with open(os.path.join(path, "cgroup.kill"), "w") as f:
+            f.write("1")
+    else:
+        # 冻结后再杀死，避免读取cgroup.procs之后新fork出的进程逃过
+        # v2冻结的进程仍然会响应SIGKILL
+        freeze = os.path.exists(os.path.join(path, "cgroup.freeze"))
+        if freeze:
+            with open(os.path.join(path, "cgroup.freeze"), "w") as f:
+                f.write("1")
+        signal_processes(read_processes(path), signal.SIGKILL)
+        if freeze:
+            with open(os.path.join(path, "cgroup.freeze"), "w") as f:
+                f.write("0")
+    return drain([path], deadline)
+
+
+def kill_processes_v1(name, directories, timeout=5.0):
+    # 把所有进程移动到freezer cgroup中冻结，然后杀死再解冻，重复直到没有进程
+    deadline = time.monotonic() + timeout
+    freezer_dir, version = find_subsystem_dir("freezer")
+    freezer = os.path.join(freezer_dir, name) if version == 1 else None
+    try:
+        while True:
+            process_list = sorted(set(p for directory in directories for p in read_processes(directory)))
+            if not process_list:
+                return True
+            if freezer:
+                os.makedirs(freezer, exist_ok=True)
+                move_processes(os.path.join(freezer, "cgroup.procs"), process_list)
+                with open(os.path.join(freezer, "freezer.state"), "w") as f:
+                    f.write("FROZEN")
+                signal_processes(read_processes(freezer), signal.SIGKILL)
+                with open(os.path.join(freezer, "freezer.state"), "w") as f:
+                    f.write("THAWED")
+            else:
+                signal_processes(process_list, signal.SIGKILL)
+            # timeout为0时只发送一轮SIGKILL，不等待进程退出
+            if time.monotonic() >= deadline:
+                return False
+            drain(directories, min(deadline, time.monotonic() + 0.1))
+    finally:
+        if freezer and os.path.exists(freezer) and drain([freezer], deadline):
+            os.rmdir(freezer)
+
+
+def enable_controllers(directory, controllers):
+    with open(os.path.join(directory, "cgroup.controllers"), "r") as f:
+        available = f.read().split()
+    with open(os.path.join(directory, "cgroup.subtree_control"), "r") as f:
+        enabled = f.read().split()
+    for controller in sorted(set(controllers)):
+        if controller not in available:
+            event("cgroup.unavailable", controller=controller, directory=directory)
+        elif controller not in enabled:
+            write_value(directory, "cgroup.subtree_control", "+" + controller)
+
+
+def merge_section(old, new):
+    # 资源配置中的字典可以只给出需要修改的字段
+    if isinstance(old, dict) and isinstance(new, dict):
+        return dict(old, **new)
+    return new
+
+
+def use_cgroup_v2():
+    # 所有controller都在统一层级中时才使用cgroup v2
+    index = get_mount_index()
+    if not index.get("unified"):
+        return False
+    return all(version == 2 for _, version in index.get("subsystems").values())
+
+
+def create_cgroup(name, config, cgroup_base_dir, create=True, writes=None):
+    if use_cgroup_v2():
+        return cgroupv2(name, config, cgroup_base_dir, create, writes)
+    return cgroupv1(name, config, cgroup_base_dir, create, writes)
 
 
 def test():
@@ -278,8 +858,9 @@ def test():
             config = json.load(file)
             return config
 
-    config = get_json_config("./test/config.json")
-    tmp = cgroupv1("container_test", config.get("resources"), "/tmp/cgroup")
+    config = get_json_config(sys.argv[1] if len(sys.argv) > 1 else "./config_1.json")
+    os.makedirs(config.get("linux").get("cgroupsPath"), exist_ok=True)
+    tmp = create_cgroup("container_test", config.get("linux").get("resources"), config.get("linux").get("cgroupsPath"))
     while True:
         cmd = input("cmd:")
         cmd = cmd.split(',')
@@ -1,190 +1,621 @@
 import argparse
+import errno
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import cpuset
+import logs
+import netlink
+import state
+import tracing
 from cgroup import *
+from image import ImageError, mount_rootfs, umount_rootfs
+from plan import PlanError, cached_plan, load_plan, plan_for_text
+from teardown import forget, teardown_all
+from tracing import event, span
 from unshare import *
+from zygote import ZygotePool, zygote_accepts
 
+# setns的顺序：先进入user namespace，mount namespace最后进入，之前还要通过/proc打开其他namespace
+NAMESPACE_ORDER = [("user", CLONE_NEWUSER), ("ipc", CLONE_NEWIPC), ("uts", CLONE_NEWUTS), ("net", CLONE_NEWNET),
+                   ("pid", CLONE_NEWPID), ("cgroup", CLONE_NEWCGROUP), ("mnt", CLONE_NEWNS)]
 
-def get_json_config(config_file):
-    if not os.path.exists(config_file):
-        raise Exception('Error: {} not exist, could not get json file'.format(config_file))
-    with open(config_file, 'r') as file:
-        config = json.load(file)
-        return config
 
+# 启动器fork子进程时，线程池、日志线程可能正持有stdout、sqlite等锁，子进程中这些锁永远不会释放
+# 子进程在execve之前只能用os.write输出、os._exit退出，不能print，也不能写状态记录
+_forked_child = False
 
-def get_value(config, key_list):
-    ret = config
-    try:
-        for key in key_list:
-            ret = ret.get(key)
-    except KeyError:
-        return None
-    return ret
+
+def enter_child():
+    global _forked_child
+    _forked_child = True
+    tracing.after_fork()
+
+
+def child_error(msg):
+    os.write(2, msg.encode(errors="replace") + b'\n')
 
 
 def err_exit(msg):
+    if _forked_child:
+        child_error(msg)
+        os._exit(1)
     print(msg)
     sys.exit(1)
 
 
-def main():
-    # 解析命令行参数
-    parser = argparse.ArgumentParser(description="container arg")
-    parser.add_argument('-config', help='config path')
-    args = parser.parse_args()
+def sync_notify(fd):
+    os.write(fd, b'1')
+
+
+def sync_wait(fd):
+    # 对端退出时read返回空，不再继续等待
+    if not os.read(fd, 1):
+        err_exit('peer exited before synchronization')
+
+
+def format_id_mappings(mappings):
+    return "".join("{0} {1} {2}\n".format(m.get("containerID"), m.get("hostID"), m.get("size"))
+                   for m in mappings)
+
+
+def write_id_mappings(pid, uid_maps, gid_maps):
+    # 子进程与父进程处于同一个user namespace时，映射已经存在，无需写入
+    if os.readlink("/proc/{0}/ns/user".format(pid)) == os.readlink("/proc/self/ns/user"):
+        return
+    with open("/proc/{0}/uid_map".format(pid), "w") as f:
+        f.write(format_id_mappings(uid_maps))
+    if os.geteuid() != 0:
+        with open("/proc/{0}/setgroups".format(pid), "w") as f:
+            f.write("deny")
+    with open("/proc/{0}/gid_map".format(pid), "w") as f:
+        f.write(format_id_mappings(gid_maps))
+
+
+def release_child(child_pid, plan, to_parent_r, to_child_w, trace_r=None):
+    # 等待子进程准备好，写入uid/gid映射后放行
+    with span("release.wait_child", id=plan.get("id")):
+        sync_wait(to_parent_r)
+    with span("release.id_mappings", id=plan.get("id")):
+        write_id_mappings(child_pid, plan.get("uid_mappings"), plan.get("gid_mappings"))
+    # 子进程已经处于新的net namespace中，放行之前配置好网络
+    # 配置失败时关闭管道，子进程读到EOF后退出
+    try:
+        if plan.get("network"):
+            with span("release.network", id=plan.get("id")):
+                netlink.setup_network(child_pid, plan.get("id"), plan.get("network"))
+        sync_notify(to_child_w)
+    except BaseException:
+        if trace_r is not None:
+            os.close(trace_r)
+        raise
+    finally:
+        os.close(to_parent_r)
+        os.close(to_child_w)
+    state.record(plan.get("id"), status="running")
+    # 子进程在execve之前发回自己的阶段耗时
+    if trace_r is not None:
+        tracing.receive(trace_r, child_pid)
+
+
+def prepare_container(plan):
+    root = plan.get("root").get("path")
+    # 先写入creating记录，reap看到启动器还在运行时不会清理正在准备的cgroup、rootfs和cpu分配
+    # 重新创建同一个容器时覆盖之前的记录
+    state.record(plan.get("id"), status="creating", pid=None, pid_start=None, exit_code=None, config_path=None,
+                 config_hash=plan.get("config_hash"), cgroups=[], mounts=[], rootfs=root, created=time.time(),
+                 **state.owner_fields())
+    try:
+        cg, rootfs_mounted = setup_container(plan)
+    except BaseException:
+        state.record(plan.get("id"), status="exited")
+        raise
+    state.record(plan.get("id"), cgroups=cg.directories(), mounts=[root] if rootfs_mounted else [])
+    return cg, rootfs_mounted
 
-    # 获取json参数
-    config = get_json_config(args.config)
 
+def setup_container(plan):
     # 创建 cgroup hierarchy
-    cgroup_path = get_value(config, ["linux", "cgroupsPath"])
+    cgroup_path = plan.get("cgroups_path")
     if not os.path.exists(cgroup_path):
         os.mkdir(cgroup_path)
-    cg = cgroupv1("container_{0}".format(get_value(config,["id"])), get_value(config, ["linux", "resources"]), cgroup_path)
+    # 配置只给出cpuCount时，按NUMA拓扑分配cpuset
+    try:
+        resources, writes = cpuset.assign(plan)
+    except cpuset.CpusetError as e:
+        err_exit("allocate cpuset failed: {0}".format(e.message))
+    try:
+        with span("prepare.cgroup", id=plan.get("id")):
+            cg = create_cgroup(plan.get("name"), resources, cgroup_path, writes=writes)
+    except BaseException:
+        cpuset.release([plan.get("name")])
+        raise
 
     # 准备root目录
-    mount_info = get_value(config, ["root"])
+    mount_info = plan.get("root")
     root = mount_info.get("path")
-    image = mount_info.get("bundle")
     if not os.path.exists(root):
         os.mkdir(root)
-    if not os.listdir(root):
-        subprocess.run(["tar", "-xf", image, "-C", root])
+    # root目录为空时，从镜像仓库挂载rootfs，否则直接使用已有目录
+    rootfs_mounted = not os.listdir(root)
+    if rootfs_mounted:
+        try:
+            with span("prepare.rootfs", id=plan.get("id")):
+                mount_rootfs(plan.get("id"), mount_info)
+        except (ImageError, OSError) as e:
+            cg.clean()
+            cpuset.release([cg.name])
+            err_exit("prepare rootfs failed: {0}".format(e))
 
     if not os.path.exists("{0}/put_old".format(root)):
         os.mkdir("{0}/put_old".format(root))
+    return cg, rootfs_mounted
 
-    # 检查是否有root到root的映射
-    uid_maps = get_value(config, ["linux", "uidMappings"])
-    has_root2root = False
-    for uid_map in uid_maps:
-        if uid_map.get("containerID") == 0 and uid_map.get("hostID") == 0:
-            has_root2root = True
-            break
-    # 有root用户到root用户的映射，尝试使用所有功能
-    if has_root2root:
-        print('full function')
-        # user namespace
-        # if -1 == unshare(CLONE_NEWUSER):
-        #     err_exit('unshare user namespace failed')
-        # pid namespace
-        if -1 == unshare(CLONE_NEWPID):
-            err_exit("unshare pid failed")
-        child_pid = os.fork()
-        if child_pid:
-            print("container pid:{0}".format(child_pid))
-            print("applying cgroup restrict")
-            print("register using:register {0} {1} {2}".format(child_pid, args.config,get_value(config,["id"])))
-            cg.apply([child_pid])
-            os.waitpid(child_pid, 0)
-        else:
-            while True:
-                time.sleep(1)
-                with open("/proc/self/uid_map", "r") as f:
-                    if f.read().strip() == '':
-                        continue
-                with open("/proc/self/gid_map", "r") as f:
-                    if f.read().strip() == '':
-                        continue
-                break
-            if -1 == unshare(CLONE_NEWNS):
-                err_exit('unshare mount namespace failed')
-            subprocess.run(["mount", "--make-rprivate", "/"])
-            # 使用pivot_root 改变根目录
-            mount_info = get_value(config, ["root"])
-            root = mount_info.get("path")
-            subprocess.run(["mount", "--bind", root, root])
-            os.chdir(root)
-            subprocess.run(["pivot_root", '.', "put_old"])
-            # uts namespace
-            if -1 == unshare(CLONE_NEWUTS):
-                err_exit('unshare uts namespace failed')
-            hostname = get_value(config, ["hostname"])
-            subprocess.run(["hostname", hostname])
-
-            # cgroup namespace
-            if -1 == unshare(CLONE_NEWCGROUP):
-                err_exit('unshare cgroup namespace failed')
-            # ipc namespace
-            if -1 == unshare(CLONE_NEWIPC):
-                err_exit('unshare ipc namespace failed')
-            # net namespace
-            if -1 == unshare(CLONE_NEWNET):
-                err_exit('unshare net namespace failed')
-            subprocess.run(["mount", "-t", "proc", "proc", "/proc"])
-            subprocess.run(["mount", "-t", "sysfs", "sysfs", "/sys"])
-            # # start container process
-            process = get_value(config, ["process"])
-            cwd = process.get("cwd")
-            env = process.get("env")
-            env = {item[0]: item[1] for item in [x.split('=') for x in env]}
-            arg = process.get("args")
+
+def finish_container(plan, rootfs_mounted, exit_code=None):
+    if rootfs_mounted:
+        umount_rootfs(plan.get("id"), plan.get("root").get("path"))
+    state.record(plan.get("id"), status="exited", exit_code=exit_code, mounts=[])
+
+
+def abandon_container(plan, cg, rootfs_mounted):
+    # 容器进程没有启动起来时，撤销prepare_container创建的cgroup、rootfs挂载和cpu分配
+    try:
+        finish_container(plan, rootfs_mounted)
+    finally:
+        if cg.teardown():
+            forget([cg.name])
+
+
+def exec_process(plan):
+    # start container process
+    os.chdir(plan.get("cwd"))
+    event("child.exec", path=plan.get("path"))
+    tracing.flush()
+    os.execve(plan.get("path"), plan.get("argv"), plan.get("envp"))
+
+
+def enter_namespaces(pid):
+    # 先打开所有namespace，进入mount namespace之后/proc已经不是宿主机的
+    fds = []
+    for name, nstype in NAMESPACE_ORDER:
+        path = "/proc/{0}/ns/{1}".format(pid, name)
+        if os.readlink(path) != os.readlink("/proc/self/ns/{0}".format(name)):
+            fds.append((os.open(path, os.O_RDONLY | os.O_CLOEXEC), nstype))
+    for fd, nstype in fds:
+        setns(fd, nstype)
+        os.close(fd)
+
+
+def exec_helper(pid, directories, args, env, cwd, fds):
+    # helper进程加入容器的cgroup和namespace，pid namespace只对之后fork的子进程生效
+    helper = os.fork()
+    if helper:
+        return helper
+    enter_child()
+    try:
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+        for directory in directories:
+            move_processes(os.path.join(directory, "cgroup.procs"), [os.getpid()])
+        enter_namespaces(pid)
+        child = os.fork()
+        if not child:
             os.chdir(cwd)
+            os.execvpe(args[0], args, env)
+        _, status = os.waitpid(child, 0)
+        code = os.waitstatus_to_exitcode(status)
+        os._exit(code if code >= 0 else 128 - code)
+    except BaseException:
+        child_error(traceback.format_exc())
+    os._exit(127)
+
+
+# created为clone3时已经创建的namespace
+def enter_rootfs(plan, created=0):
+    if not created & CLONE_NEWNS and -1 == unshare(CLONE_NEWNS):
+        err_exit('unshare mount namespace failed')
+    mount(None, "/", None, MS_REC | MS_PRIVATE)
+    # 使用pivot_root 改变根目录
+    root = plan.get("root").get("path")
+    mount(root, root, None, MS_BIND)
+    os.chdir(root)
+    pivot_root('.', "put_old")
+
+
+def setup_namespaces(plan, created=0):
+    with span("child.rootfs"):
+        enter_rootfs(plan, created)
+    # uts namespace
+    if plan.get("namespaces") & CLONE_NEWUTS:
+        if not created & CLONE_NEWUTS and -1 == unshare(CLONE_NEWUTS):
+            err_exit('unshare uts namespace failed')
+        sethostname(plan.get("hostname"))
+
+    # cgroup namespace
+    if plan.get("namespaces") & CLONE_NEWCGROUP:
+        if -1 == unshare(CLONE_NEWCGROUP):
+            err_exit('unshare cgroup namespace failed')
+    # ipc namespace
+    if plan.get("namespaces") & CLONE_NEWIPC:
+        if not created & CLONE_NEWIPC and -1 == unshare(CLONE_NEWIPC):
+            err_exit('unshare ipc namespace failed')
+    # net namespace
+    if plan.get("namespaces") & CLONE_NEWNET:
+        if not created & CLONE_NEWNET and -1 == unshare(CLONE_NEWNET):
+            err_exit('unshare net namespace failed')
+        netlink.loopback_up()
+    with span("child.mounts"):
+        for source, target, fs_type, flags, data in plan.get("mounts"):
+            mount(source, target, fs_type, flags, data)
+
 
-            os.execve("/bin/sh", arg, env)
-    else:
-        # 没有root用户到root用户的映射
-        # 先使用现有权限把容器创建好，
-        print('restricted function')
-        # pid namespace
-        if -1 == unshare(CLONE_NEWPID):
-            err_exit("unshare pid failed")
+# 有root用户到root用户的映射，尝试使用所有功能
+def run_child_full(plan, to_parent_w, to_child_r, created=0):
+    # user namespace
+    # if -1 == unshare(CLONE_NEWUSER):
+    #     err_exit('unshare user namespace failed')
+    # 父进程要把veth放入容器的net namespace，在通知父进程之前创建
+    if plan.get("namespaces") & CLONE_NEWNET and not created & CLONE_NEWNET:
+        if -1 == unshare(CLONE_NEWNET):
+            err_exit('unshare net namespace failed')
+        created |= CLONE_NEWNET
+    # 通知父进程写入uid/gid映射，并阻塞等待其完成
+    sync_notify(to_parent_w)
+    with span("child.wait_release"):
+        sync_wait(to_child_r)
+    setup_namespaces(plan, created)
+    exec_process(plan)
+
+
+# 没有root用户到root用户的映射
+# 先使用现有权限把容器创建好，
+def run_child_restricted(plan, to_parent_w, to_child_r, created=0):
+    # cgroup namespace以创建时所在的cgroup为根，等父进程把自己加入容器的cgroup之后再创建
+    with span("child.wait_cgroup"):
+        sync_wait(to_child_r)
+    setup_namespaces(plan, created)
+
+    # user namespace
+    if -1 == unshare(CLONE_NEWUSER):
+        err_exit('unshare user namespace failed')
+    # 通知父进程写入uid/gid映射，并阻塞等待其完成
+    sync_notify(to_parent_w)
+    with span("child.wait_release"):
+        sync_wait(to_child_r)
+    exec_process(plan)
+
+
+# zygote收到启动计划后，完成剩余的容器初始化
+# zygote已经创建了ZYGOTE_FLAGS中的namespace，只有需要同样这些namespace的计划才会交给zygote
+def activate_zygote(plan):
+    enter_child()
+    enter_rootfs(plan)
+    if plan.get("namespaces") & CLONE_NEWUTS:
+        sethostname(plan.get("hostname"))
+    # cgroup namespace, 父进程已经把zygote加入了cgroup
+    if plan.get("namespaces") & CLONE_NEWCGROUP:
+        if -1 == unshare(CLONE_NEWCGROUP):
+            err_exit('unshare cgroup namespace failed')
+    if plan.get("namespaces") & CLONE_NEWNET:
+        netlink.loopback_up()
+    for source, target, fs_type, flags, data in plan.get("mounts"):
+        mount(source, target, fs_type, flags, data)
+    exec_process(plan)
+
+
+# clone3一次创建的namespace，cgroup namespace要在子进程加入cgroup之后创建，user namespace由子进程按需创建
+CLONE3_NAMESPACES = CLONE_NEWPID | CLONE_NEWNS | CLONE_NEWUTS | CLONE_NEWIPC | CLONE_NEWNET
+clone3_available = True
+
+
+# 返回(子进程pid, 已经创建的namespace, 子进程是否已经在容器cgroup中)
+def fork_child(plan, cg):
+    global clone3_available
+    # clone3不会执行glibc的fork处理，其他线程持有malloc锁时子进程可能死锁，只在单线程时使用
+    if clone3_available and threading.active_count() == 1:
+        flags = plan.get("namespaces") & CLONE3_NAMESPACES
+        cgroup_fd = cg.open_fd()
+        try:
+            with span("spawn.clone3", id=plan.get("id")):
+                return clone3(flags, cgroup_fd), flags, cgroup_fd is not None
+        except OSError as e:
+            # 旧内核没有clone3(ENOSYS)或不支持CLONE_INTO_CGROUP(E2BIG)，之后不再尝试
+            # 目标cgroup不能直接放入进程时，本次退回fork
+            if e.errno not in (errno.ENOSYS, errno.E2BIG, errno.EINVAL, errno.EBADF, errno.EBUSY, errno.EOPNOTSUPP):
+                raise
+            if e.errno in (errno.ENOSYS, errno.E2BIG):
+                clone3_available = False
+        finally:
+            if cgroup_fd is not None:
+                os.close(cgroup_fd)
+    # pid namespace
+    if -1 == unshare(CLONE_NEWPID):
+        err_exit("unshare pid failed")
+    with span("spawn.fork", id=plan.get("id")):
         child_pid = os.fork()
-        if child_pid:
-            print("container pid:{0}".format(child_pid))
-            print("applying cgroup restrict")
-            print("register using:register {0} {1} {2}".format(child_pid, args.config,get_value(config,["id"])))
-            # cg.apply([child_pid])
-            os.waitpid(child_pid, 0)
-        else:
-            if -1 == unshare(CLONE_NEWNS):
-                err_exit('unshare mount namespace failed')
-            subprocess.run(["mount", "--make-rprivate", "/"])
-            # 使用pivot_root 改变根目录
-            mount_info = get_value(config, ["root"])
-            root = mount_info.get("path")
-            subprocess.run(["mount", "--bind", root, root])
-            os.chdir(root)
-            subprocess.run(["pivot_root", '.', "put_old"])
-            # uts namespace
-            if -1 == unshare(CLONE_NEWUTS):
-                err_exit('unshare uts namespace failed')
-            hostname = get_value(config, ["hostname"])
-            subprocess.run(["hostname", hostname])
-
-            # cgroup namespace
-            if -1 == unshare(CLONE_NEWCGROUP):
-                err_exit('unshare cgroup namespace failed')
-            # ipc namespace
-            if -1 == unshare(CLONE_NEWIPC):
-                err_exit('unshare ipc namespace failed')
-            # net namespace
-            if -1 == unshare(CLONE_NEWNET):
-                err_exit('unshare net namespace failed')
-            subprocess.run(["mount", "-t", "proc", "proc", "/proc"])
-            subprocess.run(["mount", "-t", "sysfs", "sysfs", "/sys"])
-
-            # user namespace
-            if -1 == unshare(CLONE_NEWUSER):
-                err_exit('unshare user namespace failed')
-            while True:
-                time.sleep(1)
-                with open("/proc/self/uid_map", "r") as f:
-                    if f.read().strip() == '':
-                        continue
-                with open("/proc/self/gid_map", "r") as f:
-                    if f.read().strip() == '':
-                        continue
-                break
-            # start container process
-            process = get_value(config, ["process"])
-            cwd = process.get("cwd")
-            env = process.get("env")
-            env = {item[0]: item[1] for item in [x.split('=') for x in env]}
-            arg = process.get("args")
-            os.chdir(cwd)
+    if child_pid:
+        reset_pid_namespace()
+    return child_pid, 0, False
+
 
-            os.execve("/bin/sh", arg, env)
+# 创建容器stdout/stderr的管道，读端交给collector，返回写端
+def open_stdio(collector, plan):
+    if collector is None:
+        return None
+    stdout_r, stdout_w = logs.open_pipe()
+    stderr_r, stderr_w = logs.open_pipe()
+    collector.add(plan.get("id"), stdout_r, stderr_r)
+    return stdout_w, stderr_w
+
+
+# fork出容器进程，返回后需要调用release_child放行
+# 记录trace时多返回一个读端，子进程的阶段耗时从中读取
+# stdio为(stdout, stderr)写端时，容器的输出写入其中，否则继承启动器的终端
+def spawn_container(plan, config_path, cg, stdio=None):
+    full = plan.get("root_mapping")
+    to_parent_r, to_parent_w = os.pipe()
+    to_child_r, to_child_w = os.pipe()
+    trace_r, trace_w = os.pipe() if tracing.enabled() else (None, None)
+    try:
+        child_pid, created, in_cgroup = fork_child(plan, cg)
+    except BaseException:
+        for fd in [to_parent_r, to_parent_w, to_child_r, to_child_w, trace_r, trace_w] + list(stdio or ()):
+            if fd is not None:
+                os.close(fd)
+        raise
+    if not child_pid:
+        enter_child()
+        os.close(to_parent_r)
+        os.close(to_child_w)
+        if trace_r is not None:
+            os.close(trace_r)
+            tracing.set_sink(trace_w)
+        if stdio:
+            os.dup2(stdio[0], 1)
+            os.dup2(stdio[1], 2)
+        try:
+            if full:
+                run_child_full(plan, to_parent_w, to_child_r, created)
+            else:
+                run_child_restricted(plan, to_parent_w, to_child_r, created)
+        except BaseException:
+            child_error(traceback.format_exc())
+        # 子进程不能回到父进程的调用栈中继续执行
+        os._exit(1)
+
+    os.close(to_parent_w)
+    os.close(to_child_r)
+    if trace_w is not None:
+        os.close(trace_w)
+    for fd in stdio or ():
+        os.close(fd)
+    state.record(plan.get("id"), status="created", pid=child_pid, pid_start=state.process_start(child_pid),
+                 config_path=os.path.abspath(config_path) if config_path else None)
+    event("container.spawn", id=plan.get("id"), pid=child_pid, mode='full' if full else 'restricted',
+          clone3=bool(created), in_cgroup=in_cgroup,
+          register="register {0} {1} {2}".format(child_pid, config_path, plan.get("id")))
+    # 两种模式下子进程都在放行之前加入cgroup，不会在限制之外执行容器进程
+    try:
+        if not in_cgroup:
+            cg.apply([child_pid])
+        # restricted模式的子进程在创建namespace之前等待加入cgroup
+        if not full:
+            sync_notify(to_child_w)
+    except BaseException:
+        # 关闭管道，子进程读到EOF后退出
+        for fd in [to_parent_r, to_child_w, trace_r]:
+            if fd is not None:
+                os.close(fd)
+        raise
+    return child_pid, to_parent_r, to_child_w, trace_r
+
+
+def load_bulk_config(config_path, load, *args):
+    # 一个配置无效时只跳过这个容器，与单个配置时一样报告原因
+    try:
+        return load(*args)
+    except (PlanError, OSError) as e:
+        message = e.message if isinstance(e, PlanError) else str(e)
+        event("container.invalid", config=config_path, error=message)
+        print("invalid config {0}: {1}".format(config_path, message))
+        return None
+
+
+def load_bulk_configs(path):
+    # 目录下的每个json文件，或者jsonl文件中的每一行，都是一个容器配置
+    # 返回[(配置位置, 启动计划)]，无效配置的启动计划为None
+    if os.path.isdir(path):
+        paths = [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(".json")]
+        return [(config_path, load_bulk_config(config_path, load_plan, config_path)) for config_path in paths]
+    plans = []
+    with open(path, 'rb') as file:
+        for lineno, line in enumerate(file, 1):
+            if line.strip():
+                config_path = "{0}:{1}".format(path, lineno)
+                plans.append((config_path, load_bulk_config(config_path, plan_for_text, line.strip())))
+    return plans
+
+
+def bulk_main(path, jobs, pool_size=0, trace_file=None, trace_format="json", collector=None):
+    plans = load_bulk_configs(path)
+    # 所有容器共享同一份挂载表索引
+    get_mount_index()
+    # zygote只支持root到root映射、不需要配置网络、namespace与zygote相同的容器，其余容器走普通启动流程
+    # zygote预先fork时继承了启动器的标准输出，收集日志时不使用
+    pool = ZygotePool(pool_size, activate_zygote) if pool_size and collector is None else None
+    # 读取日志的线程在启动第一个容器之前运行，每个容器release之后输出立即被读取，不会写满管道而阻塞
+    # 管道仍由主线程创建和注册，fork也只在主线程中进行，子进程不使用collector线程可能持有的锁
+    if collector:
+        collector.start()
+
+    def prepare(config_path, plan):
+        start = time.monotonic()
+        try:
+            return config_path, plan, start, prepare_container(plan)
+        except BaseException:
+            traceback.print_exc()
+            print("container {0} prepare failed".format(plan.get("id")))
+            return None
+
+    def release(child_pid, plan, to_parent_r, to_child_w, trace_r, start):
+        try:
+            release_child(child_pid, plan, to_parent_r, to_child_w, trace_r)
+        except BaseException:
+            traceback.print_exc()
+            print("container {0} start failed".format(plan.get("id")))
+            return None
+        return time.monotonic() - start
+
+    bulk_start = time.monotonic()
+    running = {}
+    latencies = []
+    with ThreadPoolExecutor(max_workers=jobs) as pool_executor:
+        releases = []
+        prepared = [pool_executor.submit(prepare, config_path, plan) for config_path, plan in plans if plan]
+        for future in as_completed(prepared):
+            if future.result() is None:
+                continue
+            config_path, plan, start, (cg, rootfs_mounted) = future.result()
+            use_pool = pool and plan.get("root_mapping") and not plan.get("network")
+            zygote = pool.acquire() if use_pool and zygote_accepts(plan.get("namespaces")) else None
+            if zygote:
+                try:
+                    with span("zygote.start", id=plan.get("id")):
+                        pool.start(zygote, plan, cg)
+                except BaseException:
+                    traceback.print_exc()
+                    print("container {0} start failed".format(plan.get("id")))
+                    pool.kill(zygote)
+                    abandon_container(plan, cg, rootfs_mounted)
+                    continue
+                event("container.spawn", id=plan.get("id"), pid=zygote.pid, mode="zygote")
+                state.record(plan.get("id"), status="running", pid=zygote.pid,
+                             pid_start=state.process_start(zygote.pid), config_path=os.path.abspath(config_path))
+                running[zygote.pid] = (plan, cg, rootfs_mounted)
+                releases.append((plan, pool_executor.submit(lambda start=start: time.monotonic() - start)))
+                # 这个容器已经启动，再补一个zygote给后面的容器
+                pool.refill(1)
+                continue
+            # fork只在主线程中进行，此时线程池中的线程仍在运行，子进程只走不加锁的路径，见err_exit
+            # 一个容器失败时只清理这个容器，不影响其他已经准备好的容器
+            try:
+                child_pid, to_parent_r, to_child_w, trace_r = spawn_container(plan, config_path, cg,
+                                                                              open_stdio(collector, plan))
+            except BaseException:
+                traceback.print_exc()
+                print("container {0} spawn failed".format(plan.get("id")))
+                abandon_container(plan, cg, rootfs_mounted)
+                continue
+            running[child_pid] = (plan, cg, rootfs_mounted)
+            releases.append((plan, pool_executor.submit(release, child_pid, plan, to_parent_r, to_child_w,
+                                                        trace_r, start)))
+        for plan, future in releases:
+            latency = future.result()
+            if latency is not None:
+                latencies.append(latency)
+                print("container {0} started in {1:.1f} ms".format(plan.get("id"), latency * 1000))
+                event("container.started", id=plan.get("id"), ms=round(latency * 1000, 1))
+    elapsed = time.monotonic() - bulk_start
+    print("started {0}/{1} containers in {2:.3f}s, {3:.1f} containers/s".format(
+        len(latencies), len(plans), elapsed, len(latencies) / elapsed if elapsed else 0))
+    if pool:
+        pool.close()
+    if trace_file:
+        tracing.dump(trace_file, trace_format)
+
+    exited = []
+    while running:
+        child_pid, status = os.wait()
+        if child_pid in running:
+            plan, cg, rootfs_mounted = running.pop(child_pid)
+            finish_container(plan, rootfs_mounted, os.waitstatus_to_exitcode(status))
+            exited.append(cg)
+    # 容器的init进程退出后，并行删除所有cgroup
+    teardown_all(exited, jobs)
+    if collector and not collector.close():
+        print("container output still open after {0}s, stop reading logs".format(logs.CLOSE_TIMEOUT))
+
+
+def exec_main(container_id, args):
+    # 从状态记录取得容器进程和cgroup，不需要扫描/proc和cgroup目录
+    row = state.get(container_id)
+    if row is None or row.get("status") != "running" or not state.alive(row):
+        err_exit("container {0} is not running".format(container_id))
+    if not args:
+        err_exit("-exec requires a command")
+    plan = cached_plan(row.get("config_hash")) or {}
+    pid = exec_helper(row.get("pid"), row.get("cgroups"), args, plan.get("envp") or {"PATH": os.defpath},
+                      plan.get("cwd") or "/", [0, 1, 2])
+    _, status = os.waitpid(pid, 0)
+    return os.waitstatus_to_exitcode(status)
+
+
+def main():
+    # 解析命令行参数
+    parser = argparse.ArgumentParser(description="container arg")
+    parser.add_argument('-config', help='config path')
+    parser.add_argument('-bulk', help='directory of json configs or a jsonl file, start all of them')
+    parser.add_argument('-jobs', type=int, default=os.cpu_count(), help='concurrency of bulk start')
+    parser.add_argument('-pool', type=int, default=0, help='number of pre-forked zygotes used by bulk start')
+    parser.add_argument('-update', action='store_true', help='update resources of the running container in -config')
+    parser.add_argument('-trace', help='write per-phase startup timings to this file')
+    parser.add_argument('-trace-format', choices=["json", "chrome"], default="json", help='format of -trace output')
+    parser.add_argument('-log', action='store_true', help='write container stdout/stderr to rotated log files')
+    parser.add_argument('-log-size', type=int, default=logs.DEFAULT_MAX_BYTES, help='bytes per log file')
+    parser.add_argument('-log-files', type=int, default=logs.DEFAULT_MAX_FILES, help='log files kept per container')
+    parser.add_argument('-log-raw', action='store_true', help='no timestamps, move output to log files with splice')
+    parser.add_argument('-exec', help='run a command in the running container with this id')
+    parser.add_argument('-v', action='store_true', help='print launch events')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='command of -exec')
+    args = parser.parse_args()
+    tracing.enable(record=bool(args.trace), verbose=args.v)
+    collector = logs.LogCollector(max_bytes=args.log_size, max_files=args.log_files,
+                                  raw=args.log_raw) if args.log else None
+
+    if args.exec:
+        return exec_main(args.exec, args.args[1:] if args.args[:1] == ["--"] else args.args)
+    if args.bulk:
+        return bulk_main(args.bulk, args.jobs, args.pool, args.trace, args.trace_format, collector)
+
+    # 获取启动计划，配置没有变化时直接使用缓存
+    try:
+        with span("plan.load"):
+            plan = load_plan(args.config)
+    except PlanError as e:
+        err_exit("invalid config {0}: {1}".format(args.config, e.message))
+    if args.update:
+        # 只写入发生变化的cgroup配置，不重启容器
+        # 以启动时(或上一次update)的配置为基准，devices.allow等只写文件只在配置变化时写入
+        row = state.get(plan.get("id")) or {}
+        applied = cached_plan(row.get("config_hash")) if row.get("config_hash") else None
+        cg = create_cgroup(plan.get("name"), applied.get("resources") if applied else None, plan.get("cgroups_path"),
+                           create=False)
+        cg.update(plan.get("resources"))
+        if row:
+            state.record(plan.get("id"), config_hash=plan.get("config_hash"))
+        return
+    cg, rootfs_mounted = prepare_container(plan)
+    child_pid, to_parent_r, to_child_w, trace_r = spawn_container(plan, args.config, cg, open_stdio(collector, plan))
+    # 读取日志的线程在fork之后启动，不影响clone3的使用
+    if collector:
+        collector.start()
+    try:
+        release_child(child_pid, plan, to_parent_r, to_child_w, trace_r)
+        status = 0
+    except netlink.NetlinkError as e:
+        print("setup network failed: {0}".format(e.message))
+        status = 1
+    if args.trace:
+        tracing.dump(args.trace, args.trace_format)
+    _, wait_status = os.waitpid(child_pid, 0)
+    finish_container(plan, rootfs_mounted, os.waitstatus_to_exitcode(wait_status))
+    if cg.teardown():
+        forget([cg.name])
+    # cgroup中的进程都已退出，管道中剩余的输出读完后返回
+    if collector and not collector.close():
+        print("container output still open after {0}s, stop reading logs".format(logs.CLOSE_TIMEOUT))
+    return status
 
 
 if __name__ == "__main__":
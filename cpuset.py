@@ -0,0 +1,214 @@
+import argparse
+import fcntl
+import json
+import os
+import sys
+from contextlib import contextmanager
+
+import image
+from cgroup import parse_cpu_list
+from plan import compile_cgroup_writes
+from tracing import event, span
+
+CPU_DIR = "/sys/devices/system/cpu"
+NODE_DIR = "/sys/devices/system/node"
+
+
+class CpusetError(Exception):
+    def __init__(self, message, status=-1):
+        super().__init__(message, status)
+        self.message = message
+        self.status = status
+
+
+def state_path():
+    return os.path.join(image.STORE_ROOT, "cpuset.json")
+
+
+def read_list(path):
+    try:
+        with open(path, "r") as f:
+            return parse_cpu_list(f.read())
+    except OSError:
+        return None
+
+
+def format_cpu_list(cpus):
+    # [0, 1, 2, 5] -> "0-2,5"
+    parts = []
+    for cpu in sorted(cpus):
+        if parts and parts[-1][1] == cpu - 1:
+            parts[-1][1] = cpu
+        else:
+            parts.append([cpu, cpu])
+    return ",".join(str(low) if low == high else "{0}-{1}".format(low, high) for low, high in parts)
+
+
+def nearest_memory_node(node, memory_nodes):
+    # 没有内存的节点使用距离最近的有内存节点
+    if node in memory_nodes or not memory_nodes:
+        return node
+    try:
+        with open(os.path.join(NODE_DIR, "node{0}".format(node), "distance"), "r") as f:
+            distances = [int(x) for x in f.read().split()]
+    except (OSError, ValueError):
+        return min(memory_nodes)
+    return min(memory_nodes, key=lambda n: (distances[n] if n < len(distances) else sys.maxsize, n))
+
+
+def topology():
+    # 返回 {节点: {"cpus": [cpu], "mems": 内存节点, "cores": [[同一物理核上的cpu]]}}
+    online = read_list(os.path.join(CPU_DIR, "online")) or set(range(os.cpu_count() or 1))
+    nodes = {}
+    for name in sorted(os.listdir(NODE_DIR)) if os.path.isdir(NODE_DIR) else []:
+        if name.startswith("node") and name[4:].isdigit():
+            cpus = (read_list(os.path.join(NODE_DIR, name, "cpulist")) or set()) & online
+            if cpus:
+                nodes[int(name[4:])] = cpus
+    # 没有NUMA支持的内核上只有一个节点
+    if not nodes:
+        nodes = {0: online}
+    memory_nodes = read_list(os.path.join(NODE_DIR, "has_memory")) or set(nodes)
+    result = {}
+    for node, cpus in nodes.items():
+        cores = {}
+        for cpu in sorted(cpus):
+            siblings = read_list(os.path.join(CPU_DIR, "cpu{0}".format(cpu), "topology", "thread_siblings_list"))
+            cores.setdefault(min((siblings or {cpu}) & cpus or {cpu}), []).append(cpu)
+        result[node] = {"cpus": sorted(cpus), "mems": str(nearest_memory_node(node, memory_nodes)),
+                        "cores": list(cores.values())}
+    return result
+
+
+@contextmanager
+def locked_state():
+    # 多个启动器并发分配时，以文件锁保护分配记录
+    os.makedirs(image.STORE_ROOT, exist_ok=True)
+    with open(state_path() + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(state_path(), "r") as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            state = {}
+        state.setdefault("containers", {})
+        before = json.dumps(state, sort_keys=True)
+        yield state
+        if json.dumps(state, sort_keys=True) != before:
+            image.atomic_write(state_path(), json.dumps(state))
+
+
+def allocations():
+    with locked_state() as state:
+        return dict(state.get("containers"))
+
+
+def cpu_usage(containers):
+    # 返回 ({cpu: 独占的容器}, {cpu: 共享的容器数})
+    exclusive, shared = {}, {}
+    for name, item in containers.items():
+        for cpu in item.get("cpus"):
+            if item.get("exclusive"):
+                exclusive[cpu] = name
+            else:
+                shared[cpu] = shared.get(cpu, 0) + 1
+    return exclusive, shared
+
+
+def pick_exclusive(info, count, exclusive, shared):
+    free = set(cpu for cpu in info.get("cpus") if cpu not in exclusive and cpu not in shared)
+    if len(free) < count:
+        return None
+    # 先分配完整的物理核，避免和其他容器共享超线程
+    picked = []
+    for core in sorted(info.get("cores"), key=len, reverse=True):
+        if len(picked) + len(core) <= count and all(cpu in free for cpu in core):
+            picked += core
+    picked += [cpu for cpu in sorted(free) if cpu not in picked][:count - len(picked)]
+    return picked
+
+
+def pick_shared(info, count, exclusive, shared):
+    candidates = [cpu for cpu in info.get("cpus") if cpu not in exclusive]
+    if len(candidates) < count:
+        return None
+    return sorted(sorted(candidates, key=lambda cpu: (shared.get(cpu, 0), cpu))[:count])
+
+
+# 为容器分配count个cpu，全部位于同一个NUMA节点，cpuset.mems使用该节点的内存
+# exclusive为True时这些cpu不再分给其他容器
+def allocate(name, count, exclusive=False):
+    with span("cpuset.allocate", name=name, count=count), locked_state() as state:
+        containers = state.get("containers")
+        old = containers.pop(name, None)
+        # 重新启动的容器沿用原来的分配
+        if old and len(old.get("cpus")) == count and old.get("exclusive") == exclusive:
+            containers[name] = old
+            return format_cpu_list(old.get("cpus")), old.get("mems")
+        used_exclusive, used_shared = cpu_usage(containers)
+        choices = []
+        for node, info in topology().items():
+            pick = (pick_exclusive if exclusive else pick_shared)(info, count, used_exclusive, used_shared)
+            if pick is None:
+                continue
+            # 独占时选择剩余cpu最少的节点，减少碎片；共享时选择负载最轻的节点
+            if exclusive:
+                rank = len(set(info.get("cpus")) - set(used_exclusive) - set(used_shared))
+            else:
+                rank = sum(used_shared.get(cpu, 0) for cpu in pick)
+            choices.append((rank, node, pick, info.get("mems")))
+        if not choices:
+            raise CpusetError("no NUMA node has {0} {1} cpus for {2}".format(
+                count, "free" if exclusive else "unreserved", name))
+        _, node, cpus, mems = min(choices, key=lambda c: c[:2])
+        containers[name] = {"cpus": cpus, "node": node, "mems": mems, "exclusive": exclusive}
+    event("cpuset.allocated", name=name, cpus=format_cpu_list(cpus), mems=mems, exclusive=exclusive)
+    return format_cpu_list(cpus), mems
+
+
+def release(names):
+    names = set(names)
+    if not names or not os.path.exists(state_path()):
+        return []
+    with locked_state() as state:
+        removed = sorted(names & set(state.get("containers")))
+        for name in removed:
+            del state.get("containers")[name]
+    for name in removed:
+        event("cpuset.released", name=name)
+    return removed
+
+
+def wants_allocation(resources):
+    cpu = (resources or {}).get("cpu") or {}
+    return bool(cpu.get("cpuCount")) and not cpu.get("cpus")
+
+
+def assign(plan):
+    # 配置只给出cpuCount时，分配cpu并返回覆盖了cpuset的 (resources, cgroup_writes)
+    resources = plan.get("resources")
+    if not wants_allocation(resources):
+        return resources, plan.get("cgroup_writes")
+    cpu = resources.get("cpu")
+    cpus, mems = allocate(plan.get("name"), int(cpu.get("cpuCount")), bool(cpu.get("cpuExclusive")))
+    resources = dict(resources, cpu=dict(cpu, cpus=cpus, mems=mems))
+    return resources, compile_cgroup_writes(resources, plan.get("cgroup_version"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cpuset allocator")
+    parser.add_argument('-topology', action='store_true', help='print NUMA nodes, cpus and cores')
+    parser.add_argument('-release', help='comma separated container ids whose cpus are released')
+    args = parser.parse_args()
+
+    if args.topology:
+        print(json.dumps(topology()))
+    if args.release:
+        print(" ".join(release("container_" + x for x in args.release.split(','))))
+    if not args.topology and not args.release:
+        print(json.dumps(allocations()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,492 @@
+import argparse
+import heapq
+import json
+import os
+import selectors
+import signal
+import socket
+import sys
+import time
+import traceback
+
+import container
+import image
+import logs
+import state
+import teardown
+from cgroup import create_cgroup, get_mount_index
+from plan import PlanError, cached_plan, load_plan, plan_for_text
+from tracing import event
+from unshare import *
+
+MAX_FDS = 3
+# 每种请求必须给出的字段和类型
+REQUIRED_FIELDS = {"start": [("id", (str, int))],
+                   "exec": [("id", (str, int)), ("args", list)],
+                   "stop": [("id", (str, int))],
+                   "update": [("id", (str, int))],
+                   "logs": [("id", (str, int))],
+                   "inspect": [("id", (str, int))],
+                   "register": [("config", str), ("pid", int)]}
+MAX_REQUEST = 1024 * 1024
+# 删除cgroup时等待进程退出的总时间，超时后留给reap处理
+TEARDOWN_TIMEOUT = 5.0
+
+
+def socket_path():
+    return os.path.join(image.STORE_ROOT, "daemon.sock")
+
+
+class DaemonError(Exception):
+    def __init__(self, message, status=-1):
+        super().__init__(message, status)
+        self.message = message
+        self.status = status
+
+
+class Container:
+    def __init__(self, plan, cg, pid, rootfs_mounted=False, config_path=None):
+        self.plan = plan
+        self.cg = cg
+        self.pid = pid
+        self.rootfs_mounted = rootfs_mounted
+        self.config_path = config_path
+        self.status = "created"
+        self.exit_code = None
+        self.created = time.time()
+        self.pidfd = None
+        # create之后、start之前保存同步管道
+        self.sync = None
+        # cgroup还在等待进程退出、没有删除
+        self.removing = False
+
+
+class Daemon:
+    # 单线程事件循环，持有挂载表索引、镜像缓存和所有容器的cgroup对象
+    def __init__(self, path, max_bytes=logs.DEFAULT_MAX_BYTES, max_files=logs.DEFAULT_MAX_FILES, raw=False):
+        self.path = path
+        self.selector = selectors.DefaultSelector()
+        # 容器的stdout/stderr在同一个事件循环中读取
+        self.logs = logs.LogCollector(self.selector, max_bytes, max_files, raw)
+        self.containers = {}
+        # 还没有读完请求的连接 -> (已读到的数据, 收到的fd)
+        self.pending = {}
+        # pid -> 容器或等待exec结果的连接
+        self.children = {}
+        # (时间, 序号, 回调)的堆
+        self.timers = []
+        self.timer_seq = 0
+        self.running = True
+
+    def serve(self):
+        get_mount_index()
+        # 清理上一次运行崩溃后残留的cgroup和挂载，接管仍在运行的容器
+        print("reaped {0}".format(json.dumps(teardown.reap())))
+        print("adopted {0}".format(json.dumps(self.adopt())))
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        os.chmod(self.path, 0o600)
+        listener.listen(128)
+        listener.setblocking(False)
+        self.selector.register(listener, selectors.EVENT_READ, self.accept)
+
+        # 没有pidfd时依靠SIGCHLD唤醒事件循环
+        wakeup_r, wakeup_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        signal.set_wakeup_fd(wakeup_w)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.signal(signal.SIGTERM, self.shutdown)
+        signal.signal(signal.SIGINT, self.shutdown)
+        self.selector.register(wakeup_r, selectors.EVENT_READ, self.on_signal)
+        print("listening on {0}".format(self.path))
+        try:
+            while self.running:
+                timeout = max(0.0, self.timers[0][0] - time.monotonic()) if self.timers else None
+                for key, _ in self.selector.select(timeout):
+                    key.data(key.fileobj)
+                while self.timers and self.timers[0][0] <= time.monotonic():
+                    heapq.heappop(self.timers)[2]()
+        finally:
+            listener.close()
+            os.unlink(self.path)
+
+    def adopt(self):
+        # 启动容器的启动器或daemon已经退出、容器进程仍在运行时，由本daemon接管
+        adopted = []
+        for row in state.containers(("running", "stopping")):
+            if not state.alive(row) or state.owner_alive(row):
+                continue
+            plan = cached_plan(row.get("config_hash"))
+            if plan is None:
+                continue
+            cg = create_cgroup(plan.get("name"), plan.get("resources"), plan.get("cgroups_path"), create=False)
+            ctr = Container(plan, cg, row.get("pid"), bool(row.get("mounts")), row.get("config_path"))
+            ctr.status = row.get("status")
+            ctr.created = row.get("created")
+            ctr.pidfd = self.watch(ctr.pid, ctr)
+            self.containers[row.get("id")] = ctr
+            state.record(row.get("id"), **state.owner_fields())
+            adopted.append(row.get("id"))
+        return adopted
+
+    def call_later(self, delay, callback):
+        self.timer_seq += 1
+        heapq.heappush(self.timers, (time.monotonic() + delay, self.timer_seq, callback))
+
+    def remove_cgroup(self, ctr, deadline=None, delay=0.001):
+        # 事件循环中不等待进程退出：每次只发送一轮SIGKILL，由定时器再次检查，间隔逐渐加长
+        deadline = deadline or time.monotonic() + TEARDOWN_TIMEOUT
+        ctr.removing = True
+        try:
+            if ctr.cg.kill(0):
+                ctr.removing = False
+                ctr.cg.clean()
+                teardown.forget([ctr.cg.name])
+                return
+        except BaseException:
+            ctr.removing = False
+            traceback.print_exc()
+            return
+        if time.monotonic() >= deadline:
+            ctr.removing = False
+            print("container {0} still has processes, left for reap".format(ctr.plan.get("id")))
+            return
+        self.call_later(delay, lambda: self.remove_cgroup(ctr, deadline, min(delay * 2, 0.1)))
+
+    def shutdown(self, signum, frame):
+        # 容器继续运行，重新启动的daemon可以通过register接管
+        self.running = False
+
+    def on_signal(self, fd):
+        try:
+            while os.read(fd, 64):
+                pass
+        except BlockingIOError:
+            pass
+        for pid in list(self.children):
+            self.reap(pid)
+
+    def watch(self, pid, owner):
+        self.children[pid] = owner
+        try:
+            pidfd = os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            return None
+        self.selector.register(pidfd, selectors.EVENT_READ, lambda fd: self.reap(pid))
+        return pidfd
+
+    def reap(self, pid):
+        owner = self.children.get(pid)
+        if owner is None:
+            return
+        try:
+            waited, status = os.waitpid(pid, os.WNOHANG)
+            if not waited:
+                return
+            code = os.waitstatus_to_exitcode(status)
+        except ChildProcessError:
+            # register接管的容器不是daemon的子进程，无法取得退出码
+            if os.path.exists("/proc/{0}".format(pid)):
+                return
+            code = None
+        self.children.pop(pid)
+        if isinstance(owner, Container):
+            self.unwatch(owner.pidfd)
+            self.container_exited(owner, code)
+        else:
+            conn, pidfd = owner
+            self.unwatch(pidfd)
+            self.reply(conn, {"ok": True, "exit_code": code})
+
+    def unwatch(self, pidfd):
+        if pidfd is not None:
+            self.selector.unregister(pidfd)
+            os.close(pidfd)
+
+    def container_exited(self, ctr, code):
+        ctr.status = "exited"
+        ctr.exit_code = code
+        ctr.pidfd = None
+        if ctr.sync:
+            for fd in ctr.sync:
+                os.close(fd)
+            ctr.sync = None
+        event("daemon.exited", id=ctr.plan.get("id"), pid=ctr.pid, exit_code=code)
+        try:
+            container.finish_container(ctr.plan, ctr.rootfs_mounted, code)
+        except BaseException:
+            traceback.print_exc()
+        # 杀死exec留下的进程后删除cgroup
+        self.remove_cgroup(ctr)
+
+    def accept(self, listener):
+        # 连接注册到事件循环中，请求读完之后才处理，慢的客户端不会阻塞其他请求
+        try:
+            conn, _ = listener.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        self.pending[conn] = (b'', [])
+        self.selector.register(conn, selectors.EVENT_READ, self.on_request)
+
+    def on_request(self, conn):
+        data, fds = self.pending.get(conn)
+        try:
+            chunk, received, _, _ = socket.recv_fds(conn, 65536, MAX_FDS)
+        except BlockingIOError:
+            return
+        except OSError:
+            chunk, received = b'', []
+        fds += received
+        data += chunk
+        if chunk and not data.endswith(b'\n') and len(data) < MAX_REQUEST:
+            self.pending[conn] = (data, fds)
+            return
+        self.selector.unregister(conn)
+        self.pending.pop(conn)
+        if not data:
+            for fd in fds:
+                os.close(fd)
+            conn.close()
+            return
+        self.dispatch(conn, data, fds)
+
+    def dispatch(self, conn, data, fds):
+        # 回复时阻塞写，超时后放弃这个连接
+        conn.settimeout(1.0)
+        try:
+            if len(fds) > MAX_FDS:
+                raise DaemonError("too many file descriptors")
+            if not data.endswith(b'\n'):
+                raise DaemonError("request too large or incomplete")
+            request = json.loads(data)
+            response = self.handle(request, conn, fds)
+        except DaemonError as e:
+            response = {"ok": False, "error": e.message}
+        except PlanError as e:
+            response = {"ok": False, "error": "invalid config: {0}".format(e.message)}
+        except (OSError, ValueError) as e:
+            response = {"ok": False, "error": str(e)}
+        except SystemExit:
+            # 复用的启动函数在失败时调用sys.exit，详细信息已经输出到daemon的日志
+            response = {"ok": False, "error": "operation failed, see daemon output"}
+        except Exception as e:
+            # 一个请求的意外错误不能让daemon退出
+            traceback.print_exc()
+            response = {"ok": False, "error": "{0}: {1}".format(type(e).__name__, getattr(e, "message", e))}
+        finally:
+            for fd in fds:
+                os.close(fd)
+        # exec在命令退出后才回复
+        if response is not None:
+            self.reply(conn, response)
+
+    def reply(self, conn, response):
+        try:
+            conn.sendall(json.dumps(response).encode() + b'\n')
+        except OSError:
+            pass
+        conn.close()
+
+    def lookup(self, request):
+        ctr = self.containers.get(str(request.get("id")))
+        if ctr is None:
+            raise DaemonError("container {0} not found".format(request.get("id")))
+        return ctr
+
+    def handle(self, request, conn, fds):
+        if not isinstance(request, dict):
+            raise DaemonError("request must be a json object")
+        op = request.get("op")
+        handler = getattr(self, "op_{0}".format(op), None) if isinstance(op, str) else None
+        if handler is None:
+            raise DaemonError("unknown op {0}".format(op))
+        for field, types in REQUIRED_FIELDS.get(op, []):
+            value = request.get(field)
+            if value is None or isinstance(value, bool) or not isinstance(value, types):
+                raise DaemonError("{0} requires {1}".format(op, field))
+        start = time.perf_counter()
+        response = handler(request, conn, fds)
+        event("daemon.op", op=op, id=request.get("id"), us=round((time.perf_counter() - start) * 1e6, 1))
+        return response
+
+    def op_create(self, request, conn, fds):
+        if request.get("config"):
+            config_path = request.get("config")
+            plan = load_plan(config_path)
+        elif isinstance(request.get("config_text"), str):
+            config_path = None
+            plan = plan_for_text(request.get("config_text").encode())
+        else:
+            raise DaemonError("create requires config or config_text")
+        old = self.containers.get(plan.get("id"))
+        if old and old.status != "exited":
+            raise DaemonError("container {0} already exists".format(plan.get("id")))
+        if old and old.removing:
+            raise DaemonError("container {0} is being removed".format(plan.get("id")))
+        cg, rootfs_mounted = container.prepare_container(plan)
+        try:
+            pid, to_parent_r, to_child_w, trace_r = container.spawn_container(plan, config_path, cg,
+                                                                              container.open_stdio(self.logs, plan))
+        except BaseException:
+            # 进程没有启动，删除已经创建的cgroup、rootfs挂载和cpu分配
+            container.abandon_container(plan, cg, rootfs_mounted)
+            raise
+        ctr = Container(plan, cg, pid, rootfs_mounted, config_path)
+        ctr.sync = (to_parent_r, to_child_w) + ((trace_r,) if trace_r is not None else ())
+        ctr.pidfd = self.watch(pid, ctr)
+        self.containers[plan.get("id")] = ctr
+        return {"ok": True, "id": plan.get("id"), "pid": pid, "status": ctr.status}
+
+    def op_start(self, request, conn, fds):
+        ctr = self.lookup(request)
+        if ctr.status != "created":
+            raise DaemonError("container {0} is {1}".format(ctr.plan.get("id"), ctr.status))
+        sync, ctr.sync = ctr.sync, None
+        try:
+            container.release_child(ctr.pid, ctr.plan, *sync)
+        except BaseException:
+            # release_child已经关闭管道，子进程读到EOF后退出，由container_exited清理
+            ctr.status = "stopping"
+            state.record(ctr.plan.get("id"), status=ctr.status)
+            raise
+        ctr.status = "running"
+        return {"ok": True, "id": ctr.plan.get("id"), "pid": ctr.pid, "status": ctr.status}
+
+    def op_exec(self, request, conn, fds):
+        ctr = self.lookup(request)
+        if ctr.status != "running":
+            raise DaemonError("container {0} is {1}".format(ctr.plan.get("id"), ctr.status))
+        args = request.get("args")
+        if not args:
+            raise DaemonError("exec requires args")
+        env = request.get("env") or ctr.plan.get("envp")
+        pid = container.exec_helper(ctr.pid, ctr.cg.directories(), args, env,
+                                    request.get("cwd") or ctr.plan.get("cwd"), fds)
+        conn.settimeout(None)
+        self.children[pid] = (conn, self.watch(pid, (conn, None)))
+        return None
+
+    def op_stop(self, request, conn, fds):
+        ctr = self.lookup(request)
+        if ctr.status == "exited":
+            return {"ok": True, "id": ctr.plan.get("id"), "status": ctr.status}
+        if request.get("force"):
+            # 只发送SIGKILL不等待，退出由pidfd通知，cgroup在container_exited中删除
+            ctr.cg.kill(0)
+        else:
+            os.kill(ctr.pid, int(request.get("signal") or signal.SIGTERM))
+        ctr.status = "stopping"
+        state.record(ctr.plan.get("id"), status=ctr.status)
+        return {"ok": True, "id": ctr.plan.get("id"), "status": ctr.status}
+
+    def op_update(self, request, conn, fds):
+        ctr = self.lookup(request)
+        resources = request.get("resources")
+        if request.get("config"):
+            resources = load_plan(request.get("config")).get("resources")
+        if not isinstance(resources, dict):
+            raise DaemonError("update requires resources or config")
+        ctr.cg.update(resources)
+        return {"ok": True, "id": ctr.plan.get("id")}
+
+    def op_logs(self, request, conn, fds):
+        if request.get("id") is None:
+            raise DaemonError("logs requires id")
+        lines = int(request.get("lines") or 100)
+        log = self.logs.get(request.get("id"))
+        # 没有经过daemon启动的容器从日志文件读取
+        text = log.tail(lines) if log else logs.tail_file(logs.log_path(request.get("id")), lines)
+        return {"ok": True, "id": request.get("id"), "logs": text}
+
+    # 状态记录包含所有启动器启动的容器，不需要扫描/proc和cgroup目录
+    def op_list(self, request, conn, fds):
+        return {"ok": True, "containers": state.containers(request.get("status"))}
+
+    def op_inspect(self, request, conn, fds):
+        row = state.get(request.get("id"))
+        if row is None:
+            raise DaemonError("container {0} not found".format(request.get("id")))
+        return {"ok": True, "container": row}
+
+    # 接管由container.py启动的容器
+    def op_register(self, request, conn, fds):
+        plan = load_plan(request.get("config"))
+        pid = request.get("pid")
+        if not os.path.exists("/proc/{0}".format(pid)):
+            raise DaemonError("process {0} not exist".format(pid))
+        cg = create_cgroup(plan.get("name"), plan.get("resources"), plan.get("cgroups_path"), create=False)
+        ctr = Container(plan, cg, pid, config_path=request.get("config"))
+        ctr.status = "running"
+        ctr.pidfd = self.watch(pid, ctr)
+        self.containers[plan.get("id")] = ctr
+        state.record(plan.get("id"), status=ctr.status, pid=pid, pid_start=state.process_start(pid),
+                     config_path=request.get("config"), config_hash=plan.get("config_hash"),
+                     cgroups=cg.directories(), **state.owner_fields())
+        return {"ok": True, "id": plan.get("id"), "pid": pid, "status": ctr.status}
+
+
+def call(path, request, fds=()):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(path)
+    socket.send_fds(conn, [json.dumps(request).encode() + b'\n'], list(fds))
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    conn.close()
+    if not data:
+        raise DaemonError("daemon closed the connection")
+    return json.loads(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="container manager daemon")
+    parser.add_argument('-socket', help='unix socket path')
+    parser.add_argument('-serve', action='store_true', help='run the daemon')
+    parser.add_argument('-op', choices=["create", "start", "exec", "stop", "update", "list", "inspect", "register",
+                                        "logs"],
+                        help='request to send to the daemon')
+    parser.add_argument('-config', help='config path of create, update and register')
+    parser.add_argument('-id', help='container id')
+    parser.add_argument('-pid', type=int, help='container pid of register')
+    parser.add_argument('-signal', type=int, help='signal sent by stop, SIGTERM by default')
+    parser.add_argument('-force', action='store_true', help='stop by killing every process in the container cgroup')
+    parser.add_argument('-lines', type=int, help='number of recent output lines returned by logs')
+    parser.add_argument('-log-size', type=int, default=logs.DEFAULT_MAX_BYTES, help='bytes per container log file')
+    parser.add_argument('-log-files', type=int, default=logs.DEFAULT_MAX_FILES, help='log files kept per container')
+    parser.add_argument('-log-raw', action='store_true', help='no timestamps, move output to log files with splice')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='command of exec')
+    args = parser.parse_args()
+    path = args.socket or socket_path()
+
+    if args.serve:
+        return Daemon(path, args.log_size, args.log_files, args.log_raw).serve()
+    if not args.op:
+        parser.error("one of -serve or -op is required")
+    request = {"op": args.op}
+    for key in ["config", "id", "pid", "signal", "force", "lines"]:
+        if getattr(args, key) is not None:
+            request[key] = os.path.abspath(args.config) if key == "config" else getattr(args, key)
+    if args.op == "exec":
+        request["args"] = args.args[1:] if args.args[:1] == ["--"] else args.args
+    try:
+        # exec的标准输入输出直接交给容器中的进程
+        response = call(path, request, [0, 1, 2] if args.op == "exec" else ())
+    except (OSError, DaemonError) as e:
+        container.err_exit("request failed: {0}".format(e))
+    if args.op == "exec" and response.get("ok"):
+        return response.get("exit_code")
+    if args.op == "logs" and response.get("ok"):
+        sys.stdout.write(response.get("logs"))
+        return 0
+    print(json.dumps(response, indent=1))
+    return 0 if response.get("ok") else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
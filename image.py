@@ -0,0 +1,335 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from tracing import event, span
+from unshare import mount, umount2, MS_BIND, MS_REMOUNT, MS_RDONLY, MNT_DETACH
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+STORE_ROOT = os.environ.get("MYCONTAINER_ROOT", "/var/lib/mycontainer")
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+WHITEOUT_PREFIX = ".wh."
+WHITEOUT_OPAQUE = ".wh..wh..opq"
+
+# 并行准备的容器共用同一个layer时只解压一次：digest_key -> 正在导入的Future或已经导入的摘要
+_imports = {}
+_imports_lock = threading.Lock()
+
+
+class ImageError(Exception):
+    def __init__(self, message, status=-1):
+        super().__init__(message, status)
+        self.message = message
+        self.status = status
+
+
+def images_dir():
+    return os.path.join(STORE_ROOT, "images")
+
+
+def containers_dir():
+    return os.path.join(STORE_ROOT, "containers")
+
+
+# overlayfs用':'分隔lowerdir，目录名只使用摘要的十六进制部分
+def image_dir(digest):
+    return os.path.join(images_dir(), digest.split(":")[-1])
+
+
+def image_rootfs(digest):
+    return os.path.join(image_dir(digest), "rootfs")
+
+
+def atomic_write(path, content):
+    tmp = "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.get_ident())
+    with open(tmp, "w") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+class HashingReader:
+    # 解压的同时计算原始bundle的摘要，避免再读一遍文件
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+    def drain(self):
+        while self.read(1 << 20):
+            pass
+
+    def digest(self):
+        return "sha256:" + self.sha256.hexdigest()
+
+
+def bundle_layers(bundle):
+    # bundle可以是单个文件，也可以是从下到上排列的多个layer
+    if not isinstance(bundle, list):
+        bundle = [bundle]
+    layers = []
+    for layer in bundle:
+        if isinstance(layer, dict):
+            layers.append((layer.get("path"), layer.get("digest")))
+        else:
+            layers.append((layer, None))
+    return layers
+
+
+def digest_key(path):
+    st = os.stat(path)
+    return "{0}:{1}:{2}".format(os.path.realpath(path), st.st_size, st.st_mtime_ns)
+
+
+def load_digest_index():
+    # 以(路径, 大小, mtime)缓存摘要，同一个layer只需完整读取一次
+    index_file = os.path.join(images_dir(), "digests.json")
+    if not os.path.exists(index_file):
+        return {}
+    with open(index_file, "r") as f:
+        return json.load(f)
+
+
+def open_layer_stream(reader):
+    magic = reader.fileobj.peek(4)[:4]
+    if magic == ZSTD_MAGIC:
+        if zstandard is None:
+            raise ImageError("zstd compressed layer requires the zstandard module")
+        return tarfile.open(fileobj=zstandard.ZstdDecompressor().stream_reader(reader), mode="r|")
+    # gzip/bzip2/xz由tarfile根据文件头自动识别
+    return tarfile.open(fileobj=reader, mode="r|*")
+
+
+def check_inside(rootfs, path, checked):
+    # 防止layer通过之前解压出的符号链接把文件写到rootfs之外
+    parent = os.path.dirname(path)
+    if parent in checked:
+        return
+    real = os.path.realpath(parent)
+    if real != rootfs and not real.startswith(rootfs + os.sep):
+        raise ImageError("layer member {0} escapes rootfs".format(path))
+    checked.add(parent)
+
+
+def extract_layer(tar, rootfs):
+    checked = set()
+    for member in tar:
+        name = os.path.normpath(member.name.lstrip("/"))
+        if name == "." or name.startswith(".."):
+            continue
+        directory, base = os.path.split(name)
+        target = os.path.join(rootfs, name)
+        check_inside(rootfs, target, checked)
+        # whiteout转换成overlayfs的格式，由overlay按layer顺序生效
+        if base == WHITEOUT_OPAQUE:
+            os.makedirs(os.path.join(rootfs, directory), exist_ok=True)
+            os.setxattr(os.path.join(rootfs, directory), "trusted.overlay.opaque", b"y")
+        elif base.startswith(WHITEOUT_PREFIX):
+            os.makedirs(os.path.join(rootfs, directory), exist_ok=True)
+            os.mknod(os.path.join(rootfs, directory, base[len(WHITEOUT_PREFIX):]),
+                     stat.S_IFCHR | 0o600, os.makedev(0, 0))
+        else:
+            if member.islnk():
+                # 硬链接的目标与tar -xf一样按rootfs内的路径处理，不能链接到rootfs之外的文件
+                linkname = os.path.normpath(member.linkname.lstrip("/"))
+                if linkname == "." or linkname.startswith(".."):
+                    raise ImageError("layer member {0} links outside rootfs".format(name))
+                check_inside(rootfs, os.path.join(rootfs, linkname), checked)
+                if not os.path.lexists(os.path.join(rootfs, linkname)):
+                    raise ImageError("layer member {0} links to missing {1}".format(name, linkname))
+                member.linkname = linkname
+            member.name = name
+            # 保留setuid等权限位，路径已经在上面检查过
+            tar.extract(member, rootfs, numeric_owner=True, filter="fully_trusted")
+
+
+def import_layer(path, expected=None, digest_index=None):
+    if not path or not os.path.exists(path):
+        raise ImageError("bundle {0} not exist".format(path))
+    key = digest_key(path)
+    with _imports_lock:
+        known = _imports.get(key)
+        # 导入过的layer可能已经被删除
+        if isinstance(known, str) and not os.path.exists(image_rootfs(known)):
+            known = None
+        if known is None:
+            digest = expected or (digest_index or {}).get(key)
+            if digest and os.path.exists(image_rootfs(digest)):
+                return digest
+            known = _imports[key] = Future()
+            owner = True
+        else:
+            owner = False
+    if not owner:
+        # 其他线程正在或已经导入这个layer
+        digest = known.result() if isinstance(known, Future) else known
+        if expected and expected != digest:
+            raise ImageError("layer {0} digest mismatch: expect {1}, got {2}".format(path, expected, digest))
+        return digest
+    try:
+        digest = unpack_layer(path, expected)
+    except BaseException as e:
+        with _imports_lock:
+            _imports.pop(key, None)
+        known.set_exception(e)
+        raise
+    with _imports_lock:
+        _imports[key] = digest
+    known.set_result(digest)
+    return digest
+
+
+def unpack_layer(path, expected=None):
+    start = time.monotonic()
+    event("image.import", layer=path)
+    tmp = tempfile.mkdtemp(prefix=".import-", dir=images_dir())
+    try:
+        rootfs = os.path.join(tmp, "rootfs")
+        os.mkdir(rootfs)
+        with open(path, "rb") as f:
+            reader = HashingReader(f)
+            with open_layer_stream(reader) as tar, span("image.extract", layer=path):
+                extract_layer(tar, rootfs)
+            reader.drain()
+        digest = reader.digest()
+        if expected and expected != digest:
+            raise ImageError("layer {0} digest mismatch: expect {1}, got {2}".format(path, expected, digest))
+        # 只读根目录下无法再创建pivot_root需要的put_old，导入时预先建好
+        os.makedirs(os.path.join(rootfs, "put_old"), exist_ok=True)
+        try:
+            os.rename(tmp, image_dir(digest))
+        except OSError:
+            # 其他进程已经导入了同一个layer
+            if not os.path.exists(image_rootfs(digest)):
+                raise
+    except (tarfile.TarError, EOFError) as e:
+        raise ImageError("extract {0} failed: {1}".format(path, e))
+    finally:
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+    elapsed = time.monotonic() - start
+    event("image.imported", layer=path, digest=digest, size=reader.size, seconds=round(elapsed, 3))
+    return digest
+
+
+# 并行导入所有layer，返回从下到上排列的摘要列表
+def import_image(bundle):
+    os.makedirs(images_dir(), exist_ok=True)
+    layers = bundle_layers(bundle)
+    digest_index = load_digest_index()
+    workers = min(len(layers), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        digests = list(pool.map(lambda layer: import_layer(layer[0], layer[1], digest_index), layers))
+
+    changed = False
+    for (path, _), digest in zip(layers, digests):
+        key = digest_key(path)
+        if digest_index.get(key) != digest:
+            digest_index[key] = digest
+            changed = True
+    if changed:
+        atomic_write(os.path.join(images_dir(), "digests.json"), json.dumps(digest_index))
+    return digests
+
+
+def mount_rootfs(container_id, root):
+    path = root.get("path")
+    digests = import_image(root.get("bundle"))
+    container_dir = os.path.join(containers_dir(), container_id)
+    os.makedirs(container_dir, exist_ok=True)
+    atomic_write(os.path.join(container_dir, "image"), "\n".join(digests))
+    # 启动器崩溃后，teardown据此找到残留的rootfs挂载
+    atomic_write(os.path.join(container_dir, "rootfs"), path)
+
+    # overlayfs的lowerdir从上到下排列
+    lower = ":".join(image_rootfs(digest) for digest in reversed(digests))
+    if root.get("readonly"):
+        if len(digests) == 1:
+            mount(lower, path, None, MS_BIND)
+            mount(None, path, None, MS_BIND | MS_REMOUNT | MS_RDONLY)
+        else:
+            mount("overlay", path, "overlay", MS_RDONLY, "lowerdir={0}".format(lower))
+    else:
+        upper = os.path.join(container_dir, "upper")
+        work = os.path.join(container_dir, "work")
+        os.makedirs(upper, exist_ok=True)
+        os.makedirs(work, exist_ok=True)
+        mount("overlay", path, "overlay", 0,
+              "lowerdir={0},upperdir={1},workdir={2}".format(lower, upper, work))
+    event("rootfs.mounted", path=path, layers=" ".join(digests))
+
+
+def umount_rootfs(container_id, path):
+    try:
+        umount2(path, MNT_DETACH)
+    except OSError as e:
+        print("umount {0} failed: {1}".format(path, e))
+    container_dir = os.path.join(containers_dir(), container_id)
+    if os.path.exists(container_dir):
+        shutil.rmtree(container_dir)
+
+
+def referenced_images():
+    result = set()
+    if not os.path.exists(containers_dir()):
+        return result
+    for container_id in os.listdir(containers_dir()):
+        try:
+            with open(os.path.join(containers_dir(), container_id, "image"), "r") as f:
+                result.update(f.read().split())
+        except OSError:
+            continue
+    return result
+
+
+def list_images():
+    if not os.path.exists(images_dir()):
+        return []
+    return ["sha256:" + x for x in os.listdir(images_dir()) if len(x) == 64]
+
+
+# 删除没有任何容器引用的layer
+def gc():
+    referenced = referenced_images()
+    removed = []
+    for digest in list_images():
+        if digest not in referenced:
+            print("removing image {0}".format(digest))
+            shutil.rmtree(image_dir(digest))
+            removed.append(digest)
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="image store")
+    parser.add_argument('-list', action='store_true', help='list imported images')
+    parser.add_argument('-gc', action='store_true', help='remove images no container references')
+    args = parser.parse_args()
+    if args.list:
+        referenced = referenced_images()
+        for digest in list_images():
+            print("{0} {1}".format(digest, "in use" if digest in referenced else "unused"))
+    if args.gc:
+        gc()
+
+
+if __name__ == "__main__":
+    main()
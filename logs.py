@@ -0,0 +1,231 @@
+import argparse
+import fcntl
+import os
+import selectors
+import sys
+import threading
+import time
+from collections import deque
+
+import image
+from tracing import event
+
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_MAX_FILES = 3
+RING_LINES = 1000
+READ_SIZE = 65536
+# 每次就绪最多读取的字节数，避免一个容器占满事件循环
+DRAIN_BUDGET = 4 * READ_SIZE
+# 超过这个长度还没有换行时，先作为不完整的行写出
+MAX_LINE = 16384
+PIPE_SIZE = 1024 * 1024
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+# 容器退出后等待读完剩余输出的时间，逃出cgroup的进程可能一直持有管道写端
+CLOSE_TIMEOUT = 5.0
+
+
+def logs_dir():
+    # 容器目录在卸载rootfs时删除，日志单独存放，容器退出后仍然可以读取
+    return os.path.join(image.STORE_ROOT, "logs")
+
+
+def log_path(container_id):
+    return os.path.join(logs_dir(), "{0}.log".format(container_id))
+
+
+def open_pipe():
+    # 读端非阻塞，写端交给容器进程；扩大管道缓冲区，吸收输出的突发
+    read_fd, write_fd = os.pipe2(os.O_CLOEXEC)
+    try:
+        fcntl.fcntl(write_fd, F_SETPIPE_SZ, PIPE_SIZE)
+    except OSError:
+        pass
+    os.set_blocking(read_fd, False)
+    return read_fd, write_fd
+
+
+def timestamp(now):
+    return "{0}.{1:06d}Z".format(time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(now)), int(now % 1 * 1000000))
+
+
+class ContainerLog:
+    # 每行格式为 "<时间> <stdout|stderr> <F|P> <内容>"，P表示被截断的不完整行
+    # raw为True时不加时间戳，直接用splice把管道中的数据移入日志文件，不经过用户态
+    def __init__(self, container_id, max_bytes=DEFAULT_MAX_BYTES, max_files=DEFAULT_MAX_FILES, raw=False,
+                 ring_lines=RING_LINES):
+        self.container_id = str(container_id)
+        self.path = log_path(container_id)
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.raw = raw and hasattr(os, "splice")
+        self.ring = deque(maxlen=ring_lines)
+        self.partial = {}
+        self.streams = 0
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # splice不能写入O_APPEND打开的文件，由唯一的写入者维护偏移
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_CLOEXEC, 0o640)
+        self.size = os.lseek(self.fd, 0, os.SEEK_END)
+
+    def rotate(self):
+        os.close(self.fd)
+        for index in range(self.max_files - 1, 0, -1):
+            source = self.path if index == 1 else "{0}.{1}".format(self.path, index - 1)
+            if os.path.exists(source):
+                os.replace(source, "{0}.{1}".format(self.path, index))
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o640)
+        self.size = 0
+        event("logs.rotate", id=self.container_id)
+
+    def write(self, data):
+        if self.size and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+        self.size += len(data)
+
+    def record(self, stream, tag, line, now):
+        item = b"%s %s %s %s\n" % (now, stream, tag, line)
+        self.ring.append(item)
+        return item
+
+    def feed(self, stream, data):
+        now = timestamp(time.time()).encode()
+        lines = (self.partial.pop(stream, b'') + data).split(b'\n')
+        rest = lines.pop()
+        items = [self.record(stream, b"F", line, now) for line in lines]
+        while len(rest) > MAX_LINE:
+            items.append(self.record(stream, b"P", rest[:MAX_LINE], now))
+            rest = rest[MAX_LINE:]
+        if rest:
+            self.partial[stream] = rest
+        if items:
+            self.write(b''.join(items))
+
+    def splice(self, fd):
+        if self.size >= self.max_bytes:
+            self.rotate()
+        count = os.splice(fd, self.fd, min(READ_SIZE, self.max_bytes - self.size))
+        self.size += count
+        return count
+
+    # 读取一个就绪的管道，返回False表示对端已经全部关闭
+    def drain(self, fd, stream):
+        budget = DRAIN_BUDGET
+        while budget > 0:
+            try:
+                if self.raw:
+                    count = self.splice(fd)
+                else:
+                    data = os.read(fd, READ_SIZE)
+                    count = len(data)
+                    if count:
+                        self.feed(stream, data)
+            except BlockingIOError:
+                return True
+            if not count:
+                if stream in self.partial:
+                    self.write(self.record(stream, b"F", self.partial.pop(stream), timestamp(time.time()).encode()))
+                return False
+            budget -= count
+        return True
+
+    def tail(self, lines):
+        if not self.raw:
+            return b''.join(list(self.ring)[-lines:] if lines else []).decode(errors="replace")
+        return tail_file(self.path, lines)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def last_lines(path, count):
+    # 从文件末尾向前按块读取，直到包含足够的行
+    with open(path, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        data = b''
+        while end and data.count(b'\n') <= count:
+            step = min(end, READ_SIZE)
+            end -= step
+            f.seek(end)
+            data = f.read(step) + data
+    return data.splitlines(keepends=True)[-count:] if count else []
+
+
+def tail_file(path, lines):
+    # 当前文件不够时继续读取轮转的旧文件
+    result = []
+    name, index = path, 0
+    while len(result) < lines and os.path.exists(name):
+        result = last_lines(name, lines - len(result)) + result
+        index += 1
+        name = "{0}.{1}".format(path, index)
+    return b''.join(result).decode(errors="replace")
+
+
+class LogCollector:
+    # 一个事件循环读取所有容器的stdout/stderr，daemon中复用daemon的selector
+    def __init__(self, selector=None, max_bytes=DEFAULT_MAX_BYTES, max_files=DEFAULT_MAX_FILES, raw=False):
+        self.selector = selector or selectors.DefaultSelector()
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.raw = raw
+        self.fds = {}
+        self.logs = {}
+        self.thread = None
+        self.closing = False
+
+    # 可以在事件循环运行时从其他线程调用：先登记fd再注册到selector，epoll立即开始监听新的fd
+    def add(self, container_id, stdout_r, stderr_r):
+        log = ContainerLog(container_id, self.max_bytes, self.max_files, self.raw)
+        self.logs[log.container_id] = log
+        for fd, stream in [(stdout_r, b"stdout"), (stderr_r, b"stderr")]:
+            self.fds[fd] = (log, stream)
+            log.streams += 1
+            self.selector.register(fd, selectors.EVENT_READ, self.on_ready)
+        return log
+
+    def on_ready(self, fd):
+        log, stream = self.fds.get(fd)
+        if log.drain(fd, stream):
+            return
+        self.selector.unregister(fd)
+        os.close(fd)
+        self.fds.pop(fd)
+        log.streams -= 1
+        if not log.streams:
+            log.close()
+
+    def get(self, container_id):
+        return self.logs.get(str(container_id))
+
+    def run(self):
+        # close之后，等所有容器进程关闭管道再退出
+        while self.fds or not self.closing:
+            for key, _ in self.selector.select(0.1):
+                key.data(key.fileobj)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # 返回False表示超时后仍有管道没有关闭
+    def close(self, timeout=CLOSE_TIMEOUT):
+        self.closing = True
+        if self.thread:
+            self.thread.join(timeout)
+            return not self.thread.is_alive()
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="container logs")
+    parser.add_argument('-id', required=True, help='container id')
+    parser.add_argument('-lines', type=int, default=100, help='number of lines to print')
+    args = parser.parse_args()
+    sys.stdout.write(tail_file(log_path(args.id), args.lines))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,318 @@
+import argparse
+import json
+import os
+import select
+import sys
+import time
+
+from cgroup import UNLIMITED, get_mount_index, read_value, use_cgroup_v2, write_value
+from stats import discover_containers, parse_cpu_stat, process_cpu_usage
+from tracing import event
+
+PSI_RESOURCES = ["memory", "cpu", "io"]
+HOST = "host"
+
+
+def parse_pressure(data):
+    # "some avg10=0.00 avg60=0.00 avg300=0.00 total=0"
+    result = {}
+    for line in data.decode().splitlines():
+        fields = line.split()
+        if fields:
+            result[fields[0]] = {k: float(v) for k, v in (x.split('=') for x in fields[1:])}
+    return result
+
+
+def parse_flat_keyed(data):
+    # memory.events, memory.oom_control: "key value"
+    result = {}
+    for line in data.decode().splitlines():
+        fields = line.split()
+        if len(fields) == 2:
+            result[fields[0]] = int(fields[1])
+    return result
+
+
+class Monitor:
+    # 所有通知都注册在一个epoll上，没有事件时阻塞到下一次发现新容器
+    # v2: 每个容器的memory/cpu/io.pressure触发器和memory.events
+    # v1: cgroup.event_control上的OOM、内存阈值和pressure_level eventfd
+    # 宿主机的/proc/pressure触发器在两种版本下都注册
+    def __init__(self, stall_us=150000, window_us=2000000, thresholds=(), policy=None, output=None):
+        self.trigger = "some {0} {1}".format(stall_us, window_us)
+        self.thresholds = thresholds
+        self.policy = policy
+        self.output = output
+        self.epoll = select.epoll()
+        self.v2 = use_cgroup_v2()
+        # fd -> (容器名字, 类型, 资源)
+        self.watches = {}
+        # 容器名字 -> 需要关闭的fd
+        self.files = {}
+        self.counters = {}
+        self.cpu_usage = {}
+        self.last_action = {}
+
+    def emit(self, record):
+        record = dict(record, ts=time.time())
+        event("monitor." + record.get("type"), **{k: v for k, v in record.items() if k != "type"})
+        text = json.dumps(record) + "\n"
+        if self.output:
+            with open(self.output, "a") as f:
+                f.write(text)
+        else:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+    def cgroup_dir(self, name, subsystem):
+        index = get_mount_index()
+        if self.v2:
+            return os.path.join(index.get("unified"), name)
+        return os.path.join(index.get("subsystems").get(subsystem, (None, None))[0] or "", name)
+
+    def register(self, name, fd, kind, resource, mask):
+        self.epoll.register(fd, mask)
+        self.watches[fd] = (name, kind, resource)
+        self.files.setdefault(name, []).append(fd)
+
+    def add_psi(self, name, path, resource):
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_NONBLOCK | os.O_CLOEXEC)
+        except OSError:
+            return
+        try:
+            os.write(fd, self.trigger.encode() + b'\0')
+        except OSError as e:
+            os.close(fd)
+            print("psi trigger on {0} failed: {1}".format(path, e))
+            return
+        self.register(name, fd, "psi", resource, select.EPOLLPRI)
+
+    def add_eventfd(self, name, directory, filename, kind, argument=None):
+        # cgroup.event_control: "<eventfd> <被监视文件的fd> [参数]"
+        try:
+            target = os.open(os.path.join(directory, filename), os.O_RDONLY | os.O_CLOEXEC)
+        except OSError:
+            return
+        efd = os.eventfd(0, os.EFD_CLOEXEC | os.EFD_NONBLOCK)
+        line = "{0} {1}".format(efd, target) + ("" if argument is None else " {0}".format(argument))
+        try:
+            with open(os.path.join(directory, "cgroup.event_control"), "w") as f:
+                f.write(line)
+        except OSError as e:
+            os.close(efd)
+            os.close(target)
+            print("event_control on {0} failed: {1}".format(directory, e))
+            return
+        self.files.setdefault(name, []).append(target)
+        self.register(name, efd, kind, argument, select.EPOLLIN)
+
+    def watch_host(self):
+        # 根cgroup的pressure文件与/proc/pressure相同，部分内核只允许在cgroup文件上注册触发器
+        unified = get_mount_index().get("unified")
+        for resource in PSI_RESOURCES:
+            path = os.path.join(unified or "", "{0}.pressure".format(resource))
+            self.add_psi(HOST, path if unified and os.path.exists(path) else "/proc/pressure/{0}".format(resource),
+                         resource)
+
+    def watch(self, name):
+        if self.v2:
+            directory = self.cgroup_dir(name, None)
+            for resource in PSI_RESOURCES:
+                self.add_psi(name, os.path.join(directory, "{0}.pressure".format(resource)), resource)
+            # memory.events变化时产生POLLPRI
+            try:
+                fd = os.open(os.path.join(directory, "memory.events"), os.O_RDONLY | os.O_CLOEXEC)
+                self.counters[name] = parse_flat_keyed(os.pread(fd, 4096, 0))
+                self.register(name, fd, "memory_events", "memory", select.EPOLLPRI)
+            except OSError:
+                pass
+        else:
+            directory = self.cgroup_dir(name, "memory")
+            self.add_eventfd(name, directory, "memory.oom_control", "oom")
+            self.add_eventfd(name, directory, "memory.pressure_level", "pressure_level", "medium")
+            limit = read_value(directory, "memory.limit_in_bytes")
+            if limit and int(limit) < UNLIMITED:
+                for fraction in self.thresholds:
+                    self.add_eventfd(name, directory, "memory.usage_in_bytes", "threshold", int(int(limit) * fraction))
+        self.files.setdefault(name, [])
+
+    def unwatch(self, name):
+        for fd in self.files.pop(name, []):
+            if fd in self.watches:
+                self.epoll.unregister(fd)
+                self.watches.pop(fd)
+            os.close(fd)
+        self.counters.pop(name, None)
+        self.cpu_usage.pop(name, None)
+
+    def refresh(self):
+        names = discover_containers()
+        for name in set(self.files) - names - {HOST}:
+            self.unwatch(name)
+        for name in names - set(self.files):
+            self.watch(name)
+        if self.policy and self.policy.get("cpu_step"):
+            # 为找出cpu使用最多的容器保留一个采样点
+            now = time.monotonic()
+            for name in names:
+                usage = self.read_cpu_usage(name)
+                if usage is not None:
+                    self.cpu_usage[name] = (now, usage)
+
+    def dispatch(self, fd, mask):
+        name, kind, resource = self.watches.get(fd)
+        if name != HOST and not os.path.exists(self.cgroup_dir(name, "memory")):
+            # cgroup删除时v1的eventfd也会被通知
+            self.emit({"type": "removed", "container": name})
+            self.unwatch(name)
+            return
+        if kind == "psi":
+            self.emit({"type": "pressure", "container": name, "resource": resource,
+                       "psi": parse_pressure(os.pread(fd, 4096, 0))})
+            if resource == "memory" and name != HOST:
+                self.relieve_memory(name)
+            elif resource == "cpu":
+                self.throttle_noisiest(name)
+        elif kind == "memory_events":
+            counters = parse_flat_keyed(os.pread(fd, 4096, 0))
+            old = self.counters.get(name, {})
+            changed = {k: v - old.get(k, 0) for k, v in counters.items() if v != old.get(k, 0)}
+            self.counters[name] = counters
+            if changed:
+                self.emit({"type": "oom" if changed.get("oom_kill") or changed.get("oom") else "memory_events",
+                           "container": name, "delta": changed})
+            if changed.get("high") or changed.get("max"):
+                self.relieve_memory(name)
+        else:
+            try:
+                os.eventfd_read(fd)
+            except BlockingIOError:
+                return
+            record = {"type": kind, "container": name}
+            if kind == "threshold":
+                record["bytes"] = resource
+            self.emit(record)
+            if kind in ("threshold", "pressure_level"):
+                self.relieve_memory(name)
+
+    def allowed(self, name, action):
+        # 同一个容器的同一种调整在冷却时间内只做一次
+        now = time.monotonic()
+        if now - self.last_action.get((name, action), -1e9) < self.policy.get("cooldown"):
+            return False
+        self.last_action[(name, action)] = now
+        return True
+
+    def relieve_memory(self, name):
+        # 在上限之内提高memory.high(v2)或soft limit(v1)
+        if not self.policy or not self.policy.get("memory_step") or not self.allowed(name, "memory"):
+            return
+        directory = self.cgroup_dir(name, "memory")
+        if self.v2:
+            knob, limit = "memory.high", read_value(directory, "memory.max")
+        else:
+            knob, limit = "memory.soft_limit_in_bytes", read_value(directory, "memory.limit_in_bytes")
+        current = read_value(directory, knob)
+        if current is None or current == "max" or int(current) >= UNLIMITED:
+            return
+        ceiling = self.policy.get("memory_ceiling") or UNLIMITED
+        if limit and limit != "max":
+            ceiling = min(ceiling, int(limit))
+        value = min(int(int(current) * (1 + self.policy.get("memory_step"))), ceiling)
+        if value > int(current):
+            write_value(directory, knob, value)
+            self.emit({"type": "action", "container": name, "file": knob, "old": int(current), "new": value})
+
+    def read_cpu_usage(self, name):
+        directory = self.cgroup_dir(name, "cpu" if self.v2 else "cpuacct")
+        if self.v2:
+            data = read_value(directory, "cpu.stat")
+            return parse_cpu_stat(data.encode()) if data else None
+        if os.path.isdir(directory):
+            data = read_value(directory, "cpuacct.usage")
+            return int(data) if data else None
+        # 容器没有单独的cpuacct cgroup时，累加cpu cgroup中进程的utime和stime，使用量变小时不会被选中
+        procs = read_value(self.cgroup_dir(name, "cpu"), "cgroup.procs")
+        return None if procs is None else process_cpu_usage(procs.split())
+
+    def throttle_noisiest(self, victim):
+        # 受到cpu压力时，降低其他容器中cpu使用最多的那个的quota
+        if not self.policy or not self.policy.get("cpu_step"):
+            return
+        now = time.monotonic()
+        noisiest, rate = None, 0.0
+        for name in self.files:
+            if name in (HOST, victim):
+                continue
+            usage = self.read_cpu_usage(name)
+            if usage is None:
+                continue
+            last = self.cpu_usage.get(name)
+            self.cpu_usage[name] = (now, usage)
+            if last and now > last[0] and (usage - last[1]) / (now - last[0]) > rate:
+                noisiest, rate = name, (usage - last[1]) / (now - last[0])
+        if noisiest is None or not self.allowed(noisiest, "cpu"):
+            return
+        directory = self.cgroup_dir(noisiest, "cpu")
+        if self.v2:
+            quota, period = (read_value(directory, "cpu.max") or "max 100000").split()
+            quota = -1 if quota == "max" else int(quota)
+        else:
+            quota = int(read_value(directory, "cpu.cfs_quota_us") or -1)
+            period = read_value(directory, "cpu.cfs_period_us")
+        period = int(period or 100000)
+        if quota < 0:
+            # 没有限制时以实际使用量为起点
+            quota = int(rate / 1e9 * period) or period
+        value = max(int(quota * (1 - self.policy.get("cpu_step"))), self.policy.get("cpu_floor"))
+        if value >= quota:
+            return
+        if self.v2:
+            write_value(directory, "cpu.max", "{0} {1}".format(value, period))
+        else:
+            write_value(directory, "cpu.cfs_quota_us", value)
+        self.emit({"type": "action", "container": noisiest, "victim": victim, "file": "cpu quota",
+                   "old": quota, "new": value})
+
+    def run(self, rescan=10.0, duration=None):
+        self.watch_host()
+        end = None if duration is None else time.monotonic() + duration
+        next_scan = time.monotonic()
+        while end is None or time.monotonic() < end:
+            if time.monotonic() >= next_scan:
+                self.refresh()
+                next_scan = time.monotonic() + rescan
+            timeout = next_scan - time.monotonic()
+            if end is not None:
+                timeout = min(timeout, end - time.monotonic())
+            for fd, mask in self.epoll.poll(max(timeout, 0)):
+                if fd in self.watches:
+                    self.dispatch(fd, mask)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="container pressure and oom monitor")
+    parser.add_argument('-stall', type=int, default=150000, help='psi trigger stall time in us')
+    parser.add_argument('-window', type=int, default=2000000,
+                        help='psi trigger window in us, a multiple of 2s without CAP_SYS_RESOURCE')
+    parser.add_argument('-thresholds', default="0.9", help='comma separated fractions of the v1 memory limit')
+    parser.add_argument('-rescan', type=float, default=10.0, help='seconds between container discovery')
+    parser.add_argument('-duration', type=float, help='stop after this many seconds')
+    parser.add_argument('-output', help='jsonl output file, stdout by default')
+    parser.add_argument('-memory-step', type=float, help='raise memory.high or soft limit by this fraction')
+    parser.add_argument('-memory-ceiling', type=int, help='never raise memory above this many bytes')
+    parser.add_argument('-cpu-step', type=float, help='cut cpu quota of the noisiest container by this fraction')
+    parser.add_argument('-cpu-floor', type=int, default=10000, help='never cut cpu quota below this many us')
+    parser.add_argument('-cooldown', type=float, default=10.0, help='seconds between actions on one container')
+    args = parser.parse_args()
+    policy = None
+    if args.memory_step or args.cpu_step:
+        policy = {"memory_step": args.memory_step, "memory_ceiling": args.memory_ceiling, "cpu_step": args.cpu_step,
+                  "cpu_floor": args.cpu_floor, "cooldown": args.cooldown}
+    thresholds = [float(x) for x in args.thresholds.split(',')] if args.thresholds else []
+    Monitor(args.stall, args.window, thresholds, policy, args.output).run(args.rescan, args.duration)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+import errno
+import hashlib
+import ipaddress
+import itertools
+import os
+import socket
+import struct
+import threading
+
+from tracing import event, span
+from unshare import setns, CLONE_NEWNET
+
+NLMSG_ERROR = 2
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+
+RTM_NEWLINK = 16
+RTM_NEWADDR = 20
+RTM_NEWROUTE = 24
+
+IFF_UP = 0x1
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFLA_MASTER = 10
+IFLA_LINKINFO = 18
+IFLA_NET_NS_PID = 19
+IFLA_INFO_KIND = 1
+IFLA_INFO_DATA = 2
+VETH_INFO_PEER = 1
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RT_TABLE_MAIN = 254
+RTPROT_BOOT = 3
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_LINK = 253
+RTN_UNICAST = 1
+
+# 新net namespace中的lo总是1号设备
+LOOPBACK_INDEX = 1
+IFNAMSIZ = 16
+
+NLMSGHDR = struct.Struct("=IHHII")
+IFINFOMSG = struct.Struct("=BxHiII")
+IFADDRMSG = struct.Struct("=BBBBI")
+RTMSG = struct.Struct("=BBBBBBBBI")
+RTATTR = struct.Struct("=HH")
+
+# 等待内核回复的时间
+RECV_TIMEOUT = 5.0
+
+
+class NetlinkError(Exception):
+    def __init__(self, message, status=-1):
+        super().__init__(message, status)
+        self.message = message
+        self.status = status
+
+
+def align(data):
+    return data + b'\0' * (-len(data) % 4)
+
+
+def attr(attr_type, payload):
+    if isinstance(payload, str):
+        payload = payload.encode() + b'\0'
+    elif isinstance(payload, int):
+        payload = struct.pack("=I", payload)
+    elif isinstance(payload, list):
+        payload = b''.join(payload)
+    return align(RTATTR.pack(RTATTR.size + len(payload), attr_type) + payload)
+
+
+def ifinfo(index=0, flags=0, change=0):
+    return IFINFOMSG.pack(socket.AF_UNSPEC, 0, index, flags, change)
+
+
+# 宿主机socket按线程复用，每批请求的序号不同，出错或超时后残留的回复不会被下一批请求误认
+# 序号高16位是批次，低16位是批内的序号；fork出的子进程也会发送请求，不使用锁
+_batches = itertools.count(1)
+
+
+def batch_sequence():
+    return (next(_batches) & 0xffff) << 16
+
+
+class Batch:
+    # 多条请求拼成一个缓冲区，一次sendmsg发送，只在最后一条请求上要求ACK
+    # 内核按顺序处理，前面请求的错误在最后一条的ACK之前返回，收到第一个错误就失败
+    def __init__(self):
+        self.messages = []
+
+    def add(self, msg_type, flags, body, description):
+        self.messages.append((msg_type, flags, body, description))
+
+    def link_up(self, index):
+        self.add(RTM_NEWLINK, 0, ifinfo(index, IFF_UP, IFF_UP), "link {0} up".format(index))
+
+    def create_bridge(self, name):
+        linkinfo = attr(IFLA_LINKINFO, [attr(IFLA_INFO_KIND, "bridge")])
+        self.add(RTM_NEWLINK, NLM_F_CREATE | NLM_F_EXCL, ifinfo(0, IFF_UP, IFF_UP) + attr(IFLA_IFNAME, name) + linkinfo,
+                 "create bridge {0}".format(name))
+
+    # 创建veth对，peer直接创建在pid所在的net namespace中，本端加入网桥并启动
+    def create_veth(self, name, peer, pid, master=None, mtu=None):
+        peer_info = ifinfo() + attr(IFLA_IFNAME, peer) + attr(IFLA_NET_NS_PID, pid)
+        if mtu:
+            peer_info += attr(IFLA_MTU, mtu)
+        linkinfo = attr(IFLA_LINKINFO, [attr(IFLA_INFO_KIND, "veth"),
+                                        attr(IFLA_INFO_DATA, [attr(VETH_INFO_PEER, peer_info)])])
+        attrs = [attr(IFLA_IFNAME, name), linkinfo]
+        if master:
+            attrs.append(attr(IFLA_MASTER, master))
+        if mtu:
+            attrs.append(attr(IFLA_MTU, mtu))
+        self.add(RTM_NEWLINK, NLM_F_CREATE | NLM_F_EXCL, ifinfo(0, IFF_UP, IFF_UP) + b''.join(attrs),
+                 "create veth {0}".format(name))
+
+    def add_address(self, index, address):
+        address = ipaddress.ip_interface(address)
+        family = socket.AF_INET if address.version == 4 else socket.AF_INET6
+        attrs = [attr(IFA_LOCAL, address.ip.packed)] if address.version == 4 else []
+        attrs.append(attr(IFA_ADDRESS, address.ip.packed))
+        self.add(RTM_NEWADDR, NLM_F_CREATE | NLM_F_EXCL,
+                 IFADDRMSG.pack(family, address.network.prefixlen, 0, RT_SCOPE_UNIVERSE, index) + b''.join(attrs),
+                 "add address {0}".format(address))
+
+    def add_route(self, index, destination, gateway=None):
+        destination = ipaddress.ip_network("0.0.0.0/0" if destination == "default" else destination)
+        family = socket.AF_INET if destination.version == 4 else socket.AF_INET6
+        attrs = [attr(RTA_OIF, index)]
+        if destination.prefixlen:
+            attrs.append(attr(RTA_DST, destination.network_address.packed))
+        if gateway:
+            attrs.append(attr(RTA_GATEWAY, ipaddress.ip_address(gateway).packed))
+        body = RTMSG.pack(family, destination.prefixlen, 0, 0, RT_TABLE_MAIN, RTPROT_BOOT,
+                          RT_SCOPE_UNIVERSE if gateway else RT_SCOPE_LINK, RTN_UNICAST, 0)
+        self.add(RTM_NEWROUTE, NLM_F_CREATE | NLM_F_EXCL, body + b''.join(attrs),
+                 "add route {0}".format(destination))
+
+    def send(self, sock, timeout=RECV_TIMEOUT):
+        if not self.messages:
+            return
+        first = batch_sequence() + 1
+        last = first + len(self.messages) - 1
+        data = []
+        for seq, (msg_type, flags, body, _) in enumerate(self.messages, first):
+            flags |= NLM_F_REQUEST | (NLM_F_ACK if seq == last else 0)
+            data.append(NLMSGHDR.pack(NLMSGHDR.size + len(body), msg_type, flags, seq, 0) + body)
+        previous = sock.gettimeout()
+        sock.settimeout(timeout)
+        try:
+            sock.sendall(b''.join(data))
+            while True:
+                buf = sock.recv(65536)
+                offset = 0
+                while offset + NLMSGHDR.size <= len(buf):
+                    length, msg_type, _, seq, _ = NLMSGHDR.unpack_from(buf, offset)
+                    if length < NLMSGHDR.size:
+                        break
+                    # 出错的请求总会返回错误，不需要等到最后一条的ACK
+                    if msg_type == NLMSG_ERROR and first <= seq <= last:
+                        code = -struct.unpack_from("=i", buf, offset + NLMSGHDR.size)[0]
+                        if code:
+                            raise NetlinkError("{0} failed: {1}".format(
+                                self.messages[seq - first][3], os.strerror(code)), code)
+                        if seq == last:
+                            return
+                    offset += (length + 3) & ~3
+        except socket.timeout:
+            raise NetlinkError("{0} failed: no reply in {1}s".format(self.messages[-1][3], timeout), errno.ETIMEDOUT)
+        finally:
+            sock.settimeout(previous)
+
+
+def route_socket():
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_CLOEXEC, socket.NETLINK_ROUTE)
+    sock.bind((0, 0))
+    return sock
+
+
+def namespace_socket(pid, interface):
+    # 在pid所在的net namespace中创建socket、查找设备序号后切回，socket保持属于该namespace
+    # setns只影响当前线程，并行启动时各线程互不干扰
+    target = os.open("/proc/{0}/ns/net".format(pid), os.O_RDONLY | os.O_CLOEXEC)
+    current = os.open("/proc/thread-self/ns/net", os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        setns(target, CLONE_NEWNET)
+        try:
+            sock = route_socket()
+            try:
+                return sock, socket.if_nametoindex(interface)
+            except OSError:
+                sock.close()
+                raise
+        finally:
+            setns(current, CLONE_NEWNET)
+    finally:
+        os.close(target)
+        os.close(current)
+
+
+_local = threading.local()
+_bridge_lock = threading.Lock()
+
+
+def host_socket():
+    # 宿主机一侧的socket按线程复用
+    if getattr(_local, "sock", None) is None:
+        _local.sock = route_socket()
+    return _local.sock
+
+
+def loopback_up():
+    # 在容器进程自己的net namespace中启动lo
+    batch = Batch()
+    batch.link_up(LOOPBACK_INDEX)
+    with route_socket() as sock:
+        batch.send(sock)
+
+
+def host_interface_name(container_id, network):
+    if network.get("hostInterface"):
+        return network.get("hostInterface")
+    name = "veth{0}".format(container_id)
+    if len(name) >= IFNAMSIZ:
+        name = "veth" + hashlib.sha1(str(container_id).encode()).hexdigest()[:IFNAMSIZ - 5]
+    return name
+
+
+def ensure_bridge(name, addresses):
+    with _bridge_lock:
+        try:
+            return socket.if_nametoindex(name)
+        except OSError:
+            pass
+        batch = Batch()
+        batch.create_bridge(name)
+        batch.send(host_socket())
+        index = socket.if_nametoindex(name)
+        batch = Batch()
+        for address in addresses or []:
+            batch.add_address(index, address)
+        batch.send(host_socket())
+        event("netlink.bridge", name=name, index=index)
+        return index
+
+
+# 为pid所在的net namespace配置网络：宿主机一侧一批请求创建veth并加入网桥，
+# 容器一侧一批请求配置地址和路由
+def setup_network(pid, container_id, network):
+    host_name = host_interface_name(container_id, network)
+    peer = network.get("interface") or "eth0"
+    mtu = network.get("mtu")
+    with span("netlink.host", id=container_id):
+        master = ensure_bridge(network.get("bridge"), network.get("bridgeAddresses")) if network.get("bridge") else None
+        batch = Batch()
+        batch.create_veth(host_name, peer, pid, master, mtu)
+        batch.send(host_socket())
+    with span("netlink.container", id=container_id):
+        sock, index = namespace_socket(pid, peer)
+        with sock:
+            batch = Batch()
+            for address in network.get("addresses") or []:
+                batch.add_address(index, address)
+            batch.link_up(index)
+            for route in network.get("routes") or []:
+                batch.add_route(index, route.get("destination"), route.get("gateway"))
+            batch.send(sock)
+    event("netlink.configured", id=container_id, host=host_name, interface=peer, index=index)
@@ -0,0 +1,223 @@
+import hashlib
+import ipaddress
+import json
+import os
+import threading
+
+import cgroup
+import image
+from cgroup import CgroupError, keys2subsystems, subsystem2key, use_cgroup_v2
+from unshare import *
+
+# 启动计划格式变化时增加，旧的缓存随之失效
+PLAN_VERSION = 2
+
+NAMESPACE_FLAGS = {"pid": CLONE_NEWPID, "network": CLONE_NEWNET, "ipc": CLONE_NEWIPC, "user": CLONE_NEWUSER,
+                   "uts": CLONE_NEWUTS, "mount": CLONE_NEWNS, "cgroup": CLONE_NEWCGROUP}
+
+
+class PlanError(Exception):
+    def __init__(self, message, status=-1):
+        super().__init__(message, status)
+        self.message = message
+        self.status = status
+
+
+def plans_dir():
+    return os.path.join(image.STORE_ROOT, "plans")
+
+
+def require(config, key_list, types):
+    value = config
+    for key in key_list:
+        value = value.get(key) if isinstance(value, dict) else None
+    if not isinstance(value, types):
+        raise PlanError("config field {0} missing or invalid".format(".".join(key_list)))
+    return value
+
+
+def validate(config):
+    require(config, ["id"], (str, int))
+    require(config, ["hostname"], str)
+    require(config, ["root", "path"], str)
+    args = require(config, ["process", "args"], list)
+    if not args:
+        raise PlanError("config field process.args is empty")
+    require(config, ["process", "cwd"], str)
+    for item in require(config, ["process", "env"], list):
+        if not isinstance(item, str) or '=' not in item:
+            raise PlanError("config field process.env has invalid item {0}".format(item))
+    require(config, ["linux", "cgroupsPath"], str)
+    resources = require(config, ["linux", "resources"], dict)
+    try:
+        keys2subsystems(resources.keys())
+    except CgroupError as e:
+        raise PlanError(e.message)
+    cpu = resources.get("cpu") or {}
+    if cpu.get("cpuCount") is not None and (not isinstance(cpu.get("cpuCount"), int) or cpu.get("cpuCount") <= 0):
+        raise PlanError("config field linux.resources.cpu.cpuCount must be a positive integer")
+    for key in ["uidMappings", "gidMappings"]:
+        for mapping in require(config, ["linux", key], list):
+            for field in ["containerID", "hostID", "size"]:
+                require(mapping, [field], int)
+    for namespace in config.get("linux").get("namespaces") or []:
+        if namespace.get("type") not in NAMESPACE_FLAGS:
+            raise PlanError("namespace type {0} not recognised".format(namespace.get("type")))
+    if config.get("linux").get("network") is not None:
+        validate_network(config.get("linux"))
+
+
+def validate_network(linux):
+    network = require(linux, ["network"], dict)
+    if not any(namespace.get("type") == "network" for namespace in linux.get("namespaces") or []):
+        raise PlanError("config field linux.network requires a network namespace")
+    for key in ["bridge", "hostInterface", "interface"]:
+        if network.get(key) is not None and (not isinstance(network.get(key), str) or
+                                             not 0 < len(network.get(key)) < 16):
+            raise PlanError("config field linux.network.{0} must be an interface name".format(key))
+    if network.get("mtu") is not None:
+        require(network, ["mtu"], int)
+    try:
+        for address in (network.get("addresses") or []) + (network.get("bridgeAddresses") or []):
+            ipaddress.ip_interface(address)
+        for route in network.get("routes") or []:
+            if route.get("destination") != "default":
+                ipaddress.ip_network(require(route, ["destination"], str))
+            if route.get("gateway") is not None:
+                ipaddress.ip_address(route.get("gateway"))
+    except ValueError as e:
+        raise PlanError("config field linux.network: {0}".format(e))
+
+
+def compile_cgroup_writes(resources, version):
+    # 预先计算每个subsystem(v1)或资源key(v2)需要写入的文件和值
+    writes = {}
+    if version == 2:
+        for key in resources:
+            knobs = getattr(cgroup, "knobs2_{0}".format(key), None)
+            if knobs:
+                writes[key] = knobs(resources.get(key))
+    else:
+        for subsystem in keys2subsystems(resources.keys()):
+            knobs = getattr(cgroup, "knobs_{0}".format(subsystem), None)
+            if knobs:
+                writes[subsystem] = knobs(resources.get(subsystem2key(subsystem)))
+    return writes
+
+
+def compile_plan(config, config_hash, version):
+    validate(config)
+    linux = config.get("linux")
+    process = config.get("process")
+    # pivot_root依赖mount namespace，容器进程依赖pid namespace，总是创建
+    namespaces = CLONE_NEWNS | CLONE_NEWPID
+    for namespace in linux.get("namespaces") or []:
+        namespaces |= NAMESPACE_FLAGS.get(namespace.get("type"))
+    root_mapping = any(m.get("containerID") == 0 and m.get("hostID") == 0 for m in linux.get("uidMappings"))
+    return {
+        "version": PLAN_VERSION,
+        "config_hash": config_hash,
+        "cgroup_version": version,
+        "id": str(config.get("id")),
+        "name": "container_{0}".format(config.get("id")),
+        "hostname": config.get("hostname"),
+        "root": config.get("root"),
+        "cgroups_path": linux.get("cgroupsPath"),
+        "resources": linux.get("resources"),
+        "cgroup_writes": compile_cgroup_writes(linux.get("resources"), version),
+        "namespaces": namespaces,
+        "root_mapping": root_mapping,
+        "network": linux.get("network"),
+        "uid_mappings": linux.get("uidMappings"),
+        "gid_mappings": linux.get("gidMappings"),
+        "mounts": [["proc", "/proc", "proc", 0, None],
+                   ["sysfs", "/sys", "sysfs", 0, None]],
+        "path": "/bin/sh",
+        "argv": process.get("args"),
+        # 环境变量的值中可能包含'='
+        "envp": dict(item.split('=', 1) for item in process.get("env")),
+        "cwd": process.get("cwd"),
+    }
+
+
+def cgroup_version():
+    return 2 if use_cgroup_v2() else 1
+
+
+def plan_file_path(config_hash, version):
+    return os.path.join(plans_dir(), "{0}-c{1}-p{2}.json".format(config_hash[7:], version, PLAN_VERSION))
+
+
+def cached_plan(config_hash, version=None):
+    # 按配置摘要读取缓存的启动计划，不存在时返回None
+    try:
+        with open(plan_file_path(config_hash, version or cgroup_version()), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+def plan_for_text(data, version=None):
+    # 以配置内容的摘要缓存启动计划
+    version = version or cgroup_version()
+    config_hash = "sha256:" + hashlib.sha256(data).hexdigest()
+    plan_file = plan_file_path(config_hash, version)
+    try:
+        with open(plan_file, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+    try:
+        config = json.loads(data)
+    except ValueError as e:
+        raise PlanError("config is not valid json: {0}".format(e))
+    plan = compile_plan(config, config_hash, version)
+    os.makedirs(plans_dir(), exist_ok=True)
+    image.atomic_write(plan_file, json.dumps(plan))
+    return plan
+
+
+def stat_link_prefix(config_path):
+    # 同一个配置文件的所有stat链接有相同的前缀，文件变化后可以找到并删除旧的链接
+    return "stat-{0}-".format(hashlib.sha1(os.path.realpath(config_path).encode()).hexdigest()[:16])
+
+
+def prune_stat_links(prefix, keep):
+    # 删除同一个配置文件旧的stat链接、指向的计划已经不存在的链接和旧格式的链接
+    try:
+        names = os.listdir(plans_dir())
+    except OSError:
+        return
+    for name in names:
+        if not name.startswith("stat-") or name == keep or name.endswith(".tmp"):
+            continue
+        path = os.path.join(plans_dir(), name)
+        if name.startswith(prefix) or name.count('-') == 1 or not os.path.exists(path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+def load_plan(config_path):
+    # 配置文件的路径、大小和mtime都没有变化时，直接读取缓存的启动计划，不再读取配置
+    version = cgroup_version()
+    st = os.stat(config_path)
+    key = "{0}:{1}:{2}:c{3}:p{4}".format(os.path.realpath(config_path), st.st_size, st.st_mtime_ns,
+                                         version, PLAN_VERSION)
+    prefix = stat_link_prefix(config_path)
+    name = prefix + hashlib.sha1(key.encode()).hexdigest()
+    link = os.path.join(plans_dir(), name)
+    try:
+        with open(link, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+    with open(config_path, "rb") as f:
+        plan = plan_for_text(f.read(), version)
+    plan_file = "{0}-c{1}-p{2}.json".format(plan.get("config_hash")[7:], version, PLAN_VERSION)
+    tmp = "{0}.{1}.{2}.tmp".format(link, os.getpid(), threading.get_ident())
+    os.symlink(plan_file, tmp)
+    os.replace(tmp, link)
+    prune_stat_links(prefix, name)
+    return plan
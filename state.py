@@ -0,0 +1,197 @@
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import image
+
+# 可以由多个启动器和daemon同时写入，WAL模式下读不阻塞写
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS containers (
+    id TEXT PRIMARY KEY,
+    pid INTEGER,
+    pid_start INTEGER,
+    status TEXT NOT NULL DEFAULT 'creating',
+    exit_code INTEGER,
+    config_path TEXT,
+    config_hash TEXT,
+    cgroups TEXT NOT NULL DEFAULT '[]',
+    mounts TEXT NOT NULL DEFAULT '[]',
+    rootfs TEXT,
+    owner INTEGER,
+    owner_start INTEGER,
+    created REAL,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS containers_pid ON containers(pid);
+CREATE INDEX IF NOT EXISTS containers_status ON containers(status);
+"""
+JSON_FIELDS = ("cgroups", "mounts")
+FIELDS = ("pid", "pid_start", "status", "exit_code", "config_path", "config_hash", "cgroups", "mounts", "rootfs",
+          "owner", "owner_start", "created", "updated")
+# 容器进程可能还存在的状态
+ACTIVE = ("creating", "created", "running", "stopping")
+
+_local = threading.local()
+
+
+class StateError(Exception):
+    def __init__(self, message, status=-1):
+        super().__init__(message, status)
+        self.message = message
+        self.status = status
+
+
+def state_path():
+    return os.path.join(image.STORE_ROOT, "state.db")
+
+
+def connect():
+    # 每个线程一个连接，fork出的子进程不能继续使用父进程的连接
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.pid != os.getpid() or _local.path != state_path():
+        os.makedirs(image.STORE_ROOT, exist_ok=True)
+        conn = sqlite3.connect(state_path(), timeout=5.0, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        _local.conn, _local.pid, _local.path = conn, os.getpid(), state_path()
+    return conn
+
+
+def encode(fields):
+    unknown = set(fields) - set(FIELDS)
+    if unknown:
+        raise StateError("unknown state fields {0}".format(" ".join(sorted(unknown))))
+    return {k: json.dumps(v) if k in JSON_FIELDS else v for k, v in fields.items()}
+
+
+def decode(row):
+    if row is None:
+        return None
+    result = dict(row)
+    for key in JSON_FIELDS:
+        result[key] = json.loads(result.get(key) or "[]")
+    return result
+
+
+# 每次调用是一个事务，容器的每个生命周期阶段写入一次
+def record(container_id, **fields):
+    fields = encode(dict(fields, updated=time.time()))
+    columns = ["id"] + list(fields)
+    sql = "INSERT INTO containers ({0}) VALUES ({1}) ON CONFLICT(id) DO UPDATE SET {2}".format(
+        ", ".join(columns), ", ".join("?" * len(columns)),
+        ", ".join("{0}=excluded.{0}".format(column) for column in fields))
+    connect().execute(sql, [str(container_id)] + list(fields.values()))
+
+
+def update(container_ids, **fields):
+    # 一个事务中更新多个容器
+    container_ids = [str(x) for x in container_ids]
+    if not container_ids:
+        return
+    fields = encode(dict(fields, updated=time.time()))
+    conn = connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany("UPDATE containers SET {0} WHERE id=?".format(", ".join("{0}=?".format(k) for k in fields)),
+                         [list(fields.values()) + [x] for x in container_ids])
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def remove(container_ids):
+    connect().executemany("DELETE FROM containers WHERE id=?", [(str(x),) for x in container_ids])
+
+
+def get(container_id):
+    return decode(connect().execute("SELECT * FROM containers WHERE id=?", (str(container_id),)).fetchone())
+
+
+def by_pid(pid):
+    return decode(connect().execute("SELECT * FROM containers WHERE pid=?", (int(pid),)).fetchone())
+
+
+def containers(status=None):
+    if status:
+        status = [status] if isinstance(status, str) else list(status)
+        rows = connect().execute("SELECT * FROM containers WHERE status IN ({0}) ORDER BY id".format(
+            ", ".join("?" * len(status))), status)
+    else:
+        rows = connect().execute("SELECT * FROM containers ORDER BY id")
+    return [decode(row) for row in rows]
+
+
+def process_start(pid):
+    # /proc/<pid>/stat的第22个字段，与pid一起唯一确定一个进程，pid被复用时不会误判
+    # 已经退出、等待回收的进程返回None
+    try:
+        with open("/proc/{0}/stat".format(pid), "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return None if fields[0] == "Z" else int(fields[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def alive(row):
+    return bool(row.get("pid")) and process_start(row.get("pid")) == row.get("pid_start")
+
+
+def owner_alive(row):
+    # 管理容器的启动器或daemon是否还在运行
+    return bool(row.get("owner")) and process_start(row.get("owner")) == row.get("owner_start")
+
+
+def owner_fields():
+    return {"owner": os.getpid(), "owner_start": process_start(os.getpid())}
+
+
+def recover():
+    # 启动器或daemon崩溃后，把进程已经不存在的容器标记为退出，返回这些容器
+    # 仍在运行的启动器正在准备的容器还没有进程，不算退出
+    dead = [row for row in containers(ACTIVE)
+            if not alive(row) and not (row.get("status") == "creating" and owner_alive(row))]
+    update([row.get("id") for row in dead], status="exited")
+    return dead
+
+
+def main():
+    parser = argparse.ArgumentParser(description="container state")
+    parser.add_argument('-list', action='store_true', help='list containers')
+    parser.add_argument('-status', help='with -list, only containers in this status')
+    parser.add_argument('-inspect', help='print the state of this container id')
+    parser.add_argument('-pid', type=int, help='print the container whose init process has this pid')
+    parser.add_argument('-recover', action='store_true', help='mark containers whose process is gone as exited')
+    parser.add_argument('-remove', help='comma separated ids of exited containers to forget')
+    args = parser.parse_args()
+
+    if args.remove:
+        ids = args.remove.split(',')
+        active = [x for x in ids if (get(x) or {}).get("status") in ACTIVE]
+        if active:
+            print("containers {0} are not exited".format(" ".join(active)))
+            return 1
+        remove(ids)
+    if args.recover:
+        print(json.dumps([row.get("id") for row in recover()]))
+    if args.inspect or args.pid:
+        row = get(args.inspect) if args.inspect else by_pid(args.pid)
+        if row is None:
+            print("container {0} not found".format(args.inspect or args.pid))
+            return 1
+        print(json.dumps(row, indent=1))
+    if args.list:
+        for row in containers(args.status):
+            print("{0}\t{1}\t{2}\t{3}".format(row.get("id"), row.get("pid"), row.get("status"),
+                                              "" if row.get("exit_code") is None else row.get("exit_code")))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,250 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+from cgroup import get_mount_index, use_cgroup_v2
+
+# (subsystem, 文件名, 读取缓冲区大小)
+V1_FILES = [("memory", "memory.usage_in_bytes", 64),
+            ("memory", "memory.stat", 8192),
+            ("cpuacct", "cpuacct.usage", 64),
+            ("pids", "pids.current", 64),
+            ("blkio", "blkio.throttle.io_service_bytes", 8192)]
+V2_FILES = [("memory", "memory.current", 64),
+            ("memory", "memory.stat", 8192),
+            ("cpu", "cpu.stat", 1024),
+            ("pids", "pids.current", 64),
+            ("io", "io.stat", 8192)]
+
+# 读取cgroup.procs的缓冲区大小
+PROCS_SIZE = 65536
+
+MEMORY_STAT_KEYS = {"rss", "cache", "total_rss", "total_cache", "anon", "file", "pgmajfault"}
+
+METRICS = [("memory_usage_bytes", "gauge", "Memory usage of the container cgroup"),
+           ("cpu_usage_ns", "counter", "Total CPU time consumed by the container cgroup"),
+           ("pids_current", "gauge", "Number of processes in the container cgroup"),
+           ("io_read_bytes", "counter", "Bytes read from block devices"),
+           ("io_write_bytes", "counter", "Bytes written to block devices")]
+
+
+def parse_int(data):
+    return int(data)
+
+
+def parse_memory_stat(data):
+    result = {}
+    for line in data.split(b'\n'):
+        key, _, value = line.partition(b' ')
+        key = key.decode()
+        if key in MEMORY_STAT_KEYS:
+            result["memory_stat_" + key] = int(value)
+    return result
+
+
+def parse_io_service_bytes(data):
+    # v1: "8:0 Read 1024"
+    read = write = 0
+    for line in data.split(b'\n'):
+        fields = line.split()
+        if len(fields) == 3:
+            if fields[1] == b'Read':
+                read += int(fields[2])
+            elif fields[1] == b'Write':
+                write += int(fields[2])
+    return read, write
+
+
+def parse_io_stat(data):
+    # v2: "8:0 rbytes=1024 wbytes=0 rios=1 wios=0 ..."
+    read = write = 0
+    for field in data.split():
+        if field.startswith(b'rbytes='):
+            read += int(field[7:])
+        elif field.startswith(b'wbytes='):
+            write += int(field[7:])
+    return read, write
+
+
+def process_cpu_usage(pids):
+    # cpuacct没有与cpu挂载在一起时容器没有cpuacct cgroup，累加cpu cgroup中进程的utime和stime
+    # 退出的进程不再计入，结果可能比上一次小
+    ticks = 0
+    for pid in pids:
+        try:
+            with open("/proc/{0}/stat".format(int(pid)), "rb") as f:
+                fields = f.read().rsplit(b")", 1)[1].split()
+            ticks += int(fields[11]) + int(fields[12])
+        except (OSError, IndexError, ValueError):
+            continue
+    return ticks * 1000000000 // os.sysconf("SC_CLK_TCK")
+
+
+def parse_cpu_stat(data):
+    for line in data.split(b'\n'):
+        if line.startswith(b'usage_usec '):
+            return int(line.split()[1]) * 1000
+    return None
+
+
+class ContainerStats:
+    # 为一个容器保持打开所有统计文件，每次采样只做pread
+    def __init__(self, name, files):
+        self.name = name
+        self.fds = []
+        for filename, path, size in files:
+            try:
+                self.fds.append((filename, os.open(path, os.O_RDONLY | os.O_CLOEXEC), size))
+            except OSError:
+                continue
+
+    def sample(self):
+        result = {"container": self.name}
+        for filename, fd, size in self.fds:
+            data = os.pread(fd, size, 0)
+            if filename in ("memory.usage_in_bytes", "memory.current"):
+                result["memory_usage_bytes"] = parse_int(data)
+            elif filename == "memory.stat":
+                result.update(parse_memory_stat(data))
+            elif filename == "cpuacct.usage":
+                result["cpu_usage_ns"] = parse_int(data)
+            elif filename == "cgroup.procs":
+                result["cpu_usage_ns"] = process_cpu_usage(data.split())
+            elif filename == "cpu.stat":
+                result["cpu_usage_ns"] = parse_cpu_stat(data)
+            elif filename == "pids.current":
+                result["pids_current"] = parse_int(data)
+            elif filename == "blkio.throttle.io_service_bytes":
+                result["io_read_bytes"], result["io_write_bytes"] = parse_io_service_bytes(data)
+            elif filename == "io.stat":
+                result["io_read_bytes"], result["io_write_bytes"] = parse_io_stat(data)
+        return result
+
+    def close(self):
+        for _, fd, _ in self.fds:
+            os.close(fd)
+        self.fds = []
+
+
+def stat_files(name):
+    # 返回容器的统计文件列表 [(文件名, 路径, 缓冲区大小)]
+    index = get_mount_index()
+    if use_cgroup_v2():
+        directory = os.path.join(index.get("unified"), name)
+        return [(filename, os.path.join(directory, filename), size) for _, filename, size in V2_FILES]
+    result = []
+    for subsystem, filename, size in V1_FILES:
+        mount_point, version = index.get("subsystems").get(subsystem, (None, None))
+        if version != 1:
+            continue
+        if subsystem == "cpuacct" and not os.path.isdir(os.path.join(mount_point, name)):
+            # 容器只有cpu cgroup，从其中的进程统计cpu使用量
+            mount_point, version = index.get("subsystems").get("cpu", (None, None))
+            if version == 1:
+                result.append(("cgroup.procs", os.path.join(mount_point, name, "cgroup.procs"), PROCS_SIZE))
+            continue
+        result.append((filename, os.path.join(mount_point, name, filename), size))
+    return result
+
+
+def discover_containers(prefix="container_"):
+    index = get_mount_index()
+    if use_cgroup_v2():
+        directories = [index.get("unified")]
+    else:
+        directories = [index.get("subsystems").get(subsystem, (None, None))[0] for subsystem, _, _ in V1_FILES]
+    names = set()
+    for directory in set(filter(None, directories)):
+        try:
+            names.update(x for x in os.listdir(directory) if x.startswith(prefix))
+        except OSError:
+            continue
+    return names
+
+
+def format_prometheus(samples, timestamp):
+    lines = []
+    for metric, metric_type, help_text in METRICS:
+        lines.append("# HELP container_{0} {1}".format(metric, help_text))
+        lines.append("# TYPE container_{0} {1}".format(metric, metric_type))
+        for sample in samples:
+            if sample.get(metric) is not None:
+                lines.append('container_{0}{{container="{1}"}} {2} {3}'.format(
+                    metric, sample.get("container"), sample.get(metric), int(timestamp * 1000)))
+    return "\n".join(lines) + "\n"
+
+
+class Sampler:
+    def __init__(self, names=None, rescan=10.0):
+        self.names = names
+        self.rescan = rescan
+        self.last_scan = None
+        self.containers = {}
+
+    def refresh(self):
+        names = set(self.names) if self.names else discover_containers()
+        for name in set(self.containers) - names:
+            self.containers.pop(name).close()
+        for name in names - set(self.containers):
+            self.containers[name] = ContainerStats(name, stat_files(name))
+        self.last_scan = time.monotonic()
+
+    def sample(self):
+        if self.last_scan is None or time.monotonic() - self.last_scan >= self.rescan:
+            self.refresh()
+        samples = []
+        for name in list(self.containers):
+            try:
+                samples.append(self.containers[name].sample())
+            except OSError:
+                # cgroup已经被删除
+                self.containers.pop(name).close()
+        return samples
+
+    def run(self, interval, output_format, output=None, count=None):
+        next_tick = time.monotonic()
+        while count is None or count > 0:
+            timestamp = time.time()
+            samples = self.sample()
+            if output_format == "prometheus":
+                text = format_prometheus(samples, timestamp)
+                if output:
+                    # node_exporter textfile collector要求整个文件原子替换
+                    with open(output + ".tmp", "w") as f:
+                        f.write(text)
+                    os.replace(output + ".tmp", output)
+                else:
+                    sys.stdout.write(text + "\n")
+            else:
+                text = "".join(json.dumps(dict(sample, ts=timestamp)) + "\n" for sample in samples)
+                if output:
+                    with open(output, "a") as f:
+                        f.write(text)
+                else:
+                    sys.stdout.write(text)
+            sys.stdout.flush()
+            if count is not None:
+                count -= 1
+                if count == 0:
+                    break
+            next_tick += interval
+            time.sleep(max(0.0, next_tick - time.monotonic()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="container resource stats")
+    parser.add_argument('-interval', type=float, default=1.0, help='sampling interval in seconds')
+    parser.add_argument('-format', choices=["jsonl", "prometheus"], default="jsonl", help='output format')
+    parser.add_argument('-output', help='output file, stdout by default')
+    parser.add_argument('-names', help='comma separated cgroup names, all container_* by default')
+    parser.add_argument('-count', type=int, help='number of samples to take')
+    parser.add_argument('-rescan', type=float, default=10.0, help='seconds between container discovery')
+    args = parser.parse_args()
+    names = args.names.split(',') if args.names else None
+    Sampler(names, args.rescan).run(args.interval, args.format, args.output, args.count)
+
+
+if __name__ == "__main__":
+    main()
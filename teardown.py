@@ -0,0 +1,228 @@
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import cpuset
+import image
+import state
+from cgroup import (get_mount_index, invalidate_mount_index, kill_processes_v1, kill_processes_v2,
+                    read_processes, unescape_mount_field)
+from plan import plans_dir
+from tracing import event, span
+from unshare import umount2, MNT_DETACH
+
+CONTAINER_PREFIX = "container_"
+
+
+def teardown_all(cgroups, jobs=None, timeout=5.0):
+    # cgroup的读写都是阻塞的系统调用，多线程并行即可
+    # 返回仍有进程残留的cgroup名字
+    jobs = jobs or min(32, len(cgroups) or 1)
+    with span("teardown.all", count=len(cgroups)):
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            drained = list(pool.map(lambda cg: cg.teardown(timeout), cgroups))
+    # 仍有进程的cgroup保留cpu分配，等待reap时释放
+    forget([cg.name for cg, ok in zip(cgroups, drained) if ok])
+    return [cg.name for cg, ok in zip(cgroups, drained) if not ok]
+
+
+def forget(names):
+    # cgroup已经删除的容器，释放cpu分配并从状态记录中去掉cgroup
+    names = list(names)
+    cpuset.release(names)
+    state.update([name[len(CONTAINER_PREFIX):] for name in names], cgroups=[])
+
+
+def hierarchies():
+    # 返回 {挂载点: 版本}
+    index = get_mount_index()
+    result = {mount_point: version for mount_point, version in index.get("subsystems").values()}
+    if index.get("unified"):
+        result[index.get("unified")] = 2
+    return result
+
+
+def container_cgroups(prefix=CONTAINER_PREFIX):
+    # 返回 {cgroup名字: [(目录, 版本)]}
+    result = {}
+    for mount_point, version in hierarchies().items():
+        try:
+            names = os.listdir(mount_point)
+        except OSError:
+            continue
+        for name in names:
+            path = os.path.join(mount_point, name)
+            if name.startswith(prefix) and os.path.isdir(path):
+                result.setdefault(name, []).append((path, version))
+    return result
+
+
+def is_live(directories):
+    return any(read_processes(directory) for directory, _ in directories)
+
+
+def remove_stale(name, directories, force, timeout):
+    if is_live(directories):
+        if not force:
+            return False
+        v1 = [directory for directory, version in directories if version == 1]
+        if v1:
+            kill_processes_v1(name, v1, timeout)
+        for directory, version in directories:
+            if version == 2:
+                kill_processes_v2(directory, timeout)
+    for directory, _ in directories:
+        try:
+            # 子cgroup先于父cgroup删除
+            for root, dirs, _ in os.walk(directory, topdown=False):
+                for child in dirs:
+                    os.rmdir(os.path.join(root, child))
+            os.rmdir(directory)
+            event("teardown.rmdir", path=directory)
+        except FileNotFoundError:
+            # v1的freezer cgroup在杀死进程后已经删除
+            continue
+        except OSError as e:
+            print("rmdir {0} failed: {1}".format(directory, e))
+    return True
+
+
+def mount_entries():
+    # 返回 [(挂载点, 文件系统类型)]
+    result = []
+    with open("/proc/self/mountinfo", "r") as f:
+        for line in f:
+            fields = line.split()
+            result.append((unescape_mount_field(fields[4]), fields[fields.index('-') + 1]))
+    return result
+
+
+def known_cgroup_paths():
+    # 所有缓存过的启动计划中的cgroupsPath，手动挂载的hierarchy都在这些目录下
+    result = set()
+    try:
+        names = os.listdir(plans_dir())
+    except OSError:
+        return result
+    for name in names:
+        if name.endswith(".json"):
+            try:
+                with open(os.path.join(plans_dir(), name), "r") as f:
+                    result.add(json.load(f).get("cgroups_path"))
+            except (OSError, ValueError):
+                continue
+    return set(filter(None, result))
+
+
+def reap_hand_mounts(cgroup_paths):
+    removed = []
+    # 嵌套的挂载点先卸载
+    for mount_point, fs_type in sorted(mount_entries(), key=lambda m: len(m[0]), reverse=True):
+        if fs_type not in ("cgroup", "cgroup2"):
+            continue
+        if not any(mount_point.startswith(os.path.join(path, "")) for path in cgroup_paths):
+            continue
+        try:
+            children = [x for x in os.listdir(mount_point) if os.path.isdir(os.path.join(mount_point, x))]
+        except OSError:
+            continue
+        # 还有其他cgroup的hierarchy可能仍在使用
+        if children:
+            continue
+        try:
+            umount2(mount_point, MNT_DETACH)
+            os.rmdir(mount_point)
+            removed.append(mount_point)
+            event("teardown.umount", path=mount_point)
+        except OSError as e:
+            print("umount {0} failed: {1}".format(mount_point, e))
+    if removed:
+        invalidate_mount_index()
+    return removed
+
+
+def reap_rootfs(live_names, container_ids=None):
+    # 容器进程已经不存在时，卸载挂载的rootfs
+    removed = []
+    try:
+        container_ids = container_ids or os.listdir(image.containers_dir())
+    except OSError:
+        return removed
+    mounted = set(mount_point for mount_point, _ in mount_entries())
+    for container_id in container_ids:
+        if CONTAINER_PREFIX + container_id in live_names:
+            continue
+        try:
+            with open(os.path.join(image.containers_dir(), container_id, "rootfs"), "r") as f:
+                path = f.read().strip()
+        except OSError:
+            continue
+        if path in mounted:
+            image.umount_rootfs(container_id, path)
+            removed.append(path)
+            event("teardown.rootfs", id=container_id, path=path)
+    return removed
+
+
+def owned_names():
+    return set(CONTAINER_PREFIX + row.get("id") for row in state.containers(state.ACTIVE) if state.owner_alive(row))
+
+
+# 清理启动器崩溃后残留的cgroup、手动挂载的hierarchy和rootfs
+# force为False时只清理没有进程的cgroup
+def reap(cgroup_paths=None, force=False, jobs=None, timeout=5.0, exclude=()):
+    cgroup_paths = set(cgroup_paths or []) | known_cgroup_paths()
+    with span("teardown.reap"):
+        dead = state.recover()
+        # 启动器或daemon仍在运行的容器由它们自己清理，包括还在准备、cgroup中没有进程的容器
+        exclude = set(exclude) | owned_names()
+        cgroups = {name: dirs for name, dirs in container_cgroups().items() if name not in exclude}
+        with ThreadPoolExecutor(max_workers=jobs or min(32, len(cgroups) or 1)) as pool:
+            removed = list(pool.map(lambda item: remove_stale(item[0], item[1], force, timeout), cgroups.items()))
+        live = set(exclude) | set(name for name, ok in zip(cgroups, removed) if not ok)
+        stale = [name for name, ok in zip(cgroups, removed) if ok]
+        mounts = reap_hand_mounts(cgroup_paths)
+        rootfs = reap_rootfs(live)
+        # 没有存活cgroup的容器不再占用cpu
+        cpus = cpuset.release(set(cpuset.allocations()) - live)
+        forget(stale)
+        state.update([row.get("id") for row in dead if CONTAINER_PREFIX + row.get("id") not in live], mounts=[])
+    return {"cgroups": stale, "live": sorted(live - set(exclude)), "mounts": mounts, "rootfs": rootfs,
+            "cpusets": cpus}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="container teardown")
+    parser.add_argument('-ids', help='comma separated container ids to kill and remove')
+    parser.add_argument('-reap', action='store_true', help='remove stale container cgroups, mounts and rootfs')
+    parser.add_argument('-force', action='store_true', help='with -reap, also kill containers that still have processes')
+    parser.add_argument('-cgroups-path', help='comma separated cgroupsPath directories to look for hand mounts')
+    parser.add_argument('-jobs', type=int, help='concurrency')
+    parser.add_argument('-timeout', type=float, default=5.0, help='seconds to wait for processes to exit')
+    args = parser.parse_args()
+
+    if args.ids:
+        # 不需要容器的配置，删除所有hierarchy中同名的cgroup
+        container_ids = args.ids.split(',')
+        names = set(CONTAINER_PREFIX + container_id for container_id in container_ids)
+        cgroups = {name: dirs for name, dirs in container_cgroups().items() if name in names}
+        with ThreadPoolExecutor(max_workers=args.jobs or min(32, len(cgroups) or 1)) as pool:
+            list(pool.map(lambda item: remove_stale(item[0], item[1], True, args.timeout), cgroups.items()))
+        reap_rootfs(set(), container_ids)
+        removed = names - set(container_cgroups())
+        forget(removed)
+        state.update([name[len(CONTAINER_PREFIX):] for name in removed], status="exited", mounts=[])
+        remaining = sorted(set(container_cgroups()) & names)
+        if remaining:
+            print("failed to remove {0}".format(" ".join(remaining)))
+            return 1
+    if args.reap:
+        paths = args.cgroups_path.split(',') if args.cgroups_path else []
+        print(json.dumps(reap(paths, args.force, args.jobs, args.timeout)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
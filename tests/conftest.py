@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+# 模块都在仓库根目录，没有安装为包
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import image  # noqa: E402
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # 状态库和日志都放在临时目录中
+    monkeypatch.setattr(image, "STORE_ROOT", str(tmp_path))
+    return tmp_path
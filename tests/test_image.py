@@ -0,0 +1,73 @@
+import io
+import os
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import image
+
+
+def layer(members):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w") as tar:
+        for name, linkname in members:
+            info = tarfile.TarInfo(name)
+            if linkname is None:
+                info.size = 3
+                tar.addfile(info, io.BytesIO(b"abc"))
+            else:
+                info.type = tarfile.LNKTYPE
+                info.linkname = linkname
+                tar.addfile(info)
+    data.seek(0)
+    return data
+
+
+def extract(tmp_path, members):
+    rootfs = tmp_path / "rootfs"
+    rootfs.mkdir()
+    with tarfile.open(fileobj=layer(members), mode="r|") as tar:
+        image.extract_layer(tar, str(rootfs))
+    return rootfs
+
+
+@pytest.mark.parametrize("linkname", ["etc/passwd", "/etc/passwd", "./etc/../etc/passwd"])
+def test_hardlink_inside_rootfs(tmp_path, linkname):
+    rootfs = extract(tmp_path, [("etc/passwd", None), ("etc/leak", linkname)])
+    assert os.stat(rootfs / "etc/leak").st_ino == os.stat(rootfs / "etc/passwd").st_ino
+
+
+def test_absolute_hardlink_stays_in_rootfs(tmp_path):
+    # 与tar -xf一样去掉开头的/，不会链接到宿主机上的文件
+    outside = tmp_path / "outside"
+    outside.write_text("secret")
+    with pytest.raises(image.ImageError):
+        extract(tmp_path, [("etc/passwd", None), ("etc/leak", str(outside))])
+    assert not (tmp_path / "rootfs/etc/leak").exists()
+    assert os.stat(outside).st_nlink == 1
+
+
+def test_hardlink_escaping_rootfs(tmp_path):
+    (tmp_path / "outside").write_text("secret")
+    with pytest.raises(image.ImageError):
+        extract(tmp_path, [("etc/passwd", None), ("etc/leak", "../outside")])
+
+
+def test_parallel_imports_extract_once(store, tmp_path, monkeypatch):
+    bundle = tmp_path / "layer.tar"
+    bundle.write_bytes(layer([("etc/passwd", None)]).getvalue())
+    os.makedirs(image.images_dir())
+    calls = []
+    unpack_layer = image.unpack_layer
+
+    def counted(path, expected=None):
+        calls.append(path)
+        return unpack_layer(path, expected)
+
+    monkeypatch.setattr(image, "unpack_layer", counted)
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        digests = list(pool.map(lambda _: image.import_image(str(bundle)), range(6)))
+    assert len(calls) == 1
+    assert all(digest == digests[0] for digest in digests)
+    assert os.path.exists(os.path.join(image.image_rootfs(digests[0][0]), "etc/passwd"))
@@ -0,0 +1,119 @@
+import pytest
+
+import cgroup
+from cgroup import PAGE_SIZE, UNLIMITED, diff_knobs, order_changes, value_matches
+
+
+def write_knobs(directory, knobs):
+    directory.mkdir(exist_ok=True)
+    for filename, value in knobs.items():
+        (directory / filename).write_text("{0}\n".format(value))
+
+
+@pytest.mark.parametrize("filename, current, desired, expected", [
+    # 内存字节数按页向下取整，-1读回的是按页对齐的最大值
+    ("memory.limit_in_bytes", str(PAGE_SIZE), PAGE_SIZE + 1, True),
+    ("memory.limit_in_bytes", str(PAGE_SIZE), 2 * PAGE_SIZE, False),
+    ("memory.limit_in_bytes", str(UNLIMITED // PAGE_SIZE * PAGE_SIZE), -1, True),
+    ("memory.max", str(PAGE_SIZE), PAGE_SIZE + 1, True),
+    # 其他文件要求完全相同
+    ("pids.max", "4096", 5000, False),
+    ("pids.max", "max", "max", True),
+    ("cpu.cfs_quota_us", "-1", -1, True),
+    ("cpu.cfs_quota_us", "10000", 10001, False),
+    ("cpu.max", "10000 100000", "10000 100000", True),
+    ("cpu.max", "10000 100000", "20000 100000", False),
+    ("cpuset.cpus", "0-2,4", "0,1,2,4", True),
+    ("cpuset.cpus", "0-2", "0-3", False),
+    ("memory.oom_control", "oom_kill_disable 1\nunder_oom 0", "1", True),
+    ("memory.oom_control", "oom_kill_disable 0\nunder_oom 0", "1", False),
+    # 按设备分行的文件只要求期望的行都存在
+    ("blkio.throttle.read_bps_device", "8:0 1048576\n8:16 2048", "8:0 1048576\n", True),
+    ("blkio.throttle.read_bps_device", "8:0 1048576", "8:0 2048\n", False),
+    ("io.max", "8:0 rbps=1048576 wbps=max riops=max wiops=max", "8:0 rbps=1048576", True),
+    ("pids.max", None, 10, False),
+    ("pids.max", "10", None, True),
+])
+def test_value_matches(filename, current, desired, expected):
+    assert value_matches(filename, current, desired) is expected
+
+
+def test_diff_keeps_only_changed_knobs(tmp_path):
+    write_knobs(tmp_path, {"cpu.cfs_quota_us": -1, "cpu.cfs_period_us": 100000, "cpu.shares": 1024})
+    knobs = [("cpu.cfs_quota_us", 50000), ("cpu.cfs_period_us", 100000), ("cpu.shares", None)]
+    assert diff_knobs(str(tmp_path), knobs, False) == [("cpu.cfs_quota_us", 50000)]
+
+
+def test_diff_write_only_knobs_follow_the_section(tmp_path, monkeypatch):
+    # devices.allow读不回内容，只在配置变化时写入
+    write_knobs(tmp_path, {"devices.allow": ""})
+    monkeypatch.setattr(cgroup, "read_value", lambda directory, filename: None)
+    knobs = [("devices.allow", "c 1:3 rw")]
+    assert diff_knobs(str(tmp_path), knobs, False) == []
+    assert diff_knobs(str(tmp_path), knobs, True) == knobs
+
+
+def test_diff_missing_knob_is_written(tmp_path):
+    tmp_path.joinpath("pids.max").write_text("max\n")
+    assert diff_knobs(str(tmp_path), [("pids.max", 64)], False) == [("pids.max", 64)]
+
+
+@pytest.mark.parametrize("memsw, limit, current_memsw, expected", [
+    # 调大时先写memsw，调小时先写limit
+    (4 * PAGE_SIZE, 2 * PAGE_SIZE, 2 * PAGE_SIZE, ["memory.memsw.limit_in_bytes", "memory.limit_in_bytes"]),
+    (2 * PAGE_SIZE, PAGE_SIZE, 4 * PAGE_SIZE, ["memory.limit_in_bytes", "memory.memsw.limit_in_bytes"]),
+])
+def test_order_changes_memsw(tmp_path, memsw, limit, current_memsw, expected):
+    write_knobs(tmp_path, {"memory.memsw.limit_in_bytes": current_memsw})
+    changes = [("memory.limit_in_bytes", limit), ("memory.swappiness", 0), ("memory.memsw.limit_in_bytes", memsw)]
+    ordered = order_changes(str(tmp_path), changes)
+    assert sorted(ordered) == sorted(changes)
+    assert [filename for filename, _ in ordered if "limit_in_bytes" in filename] == expected
+
+
+@pytest.fixture
+def fake_v1(tmp_path, monkeypatch):
+    # pids和devices两个v1 hierarchy，容器cgroup已经存在
+    mounts = {subsystem: tmp_path / subsystem for subsystem in ["pids", "devices"]}
+    for mount_point in mounts.values():
+        (mount_point / "c1").mkdir(parents=True)
+    write_knobs(mounts["pids"] / "c1", {"pids.max": 64})
+    write_knobs(mounts["devices"] / "c1", {"devices.allow": "", "devices.deny": ""})
+    index = {"subsystems": {k: (str(v), 1) for k, v in mounts.items()}, "unified": None}
+    monkeypatch.setattr(cgroup, "get_mount_index", lambda: index)
+    read_value = cgroup.read_value
+    monkeypatch.setattr(cgroup, "read_value", lambda directory, filename: None if filename.startswith(
+        "devices.") else read_value(directory, filename))
+    return mounts
+
+
+DEVICES = [{"allow": False, "deny": True, "access": "rwm"},
+           {"allow": True, "type": "c", "major": 1, "minor": 3, "access": "rw"}]
+
+
+def update(fake_v1, applied, config):
+    for path in [fake_v1["devices"] / "c1" / "devices.allow", fake_v1["devices"] / "c1" / "devices.deny"]:
+        path.write_text("")
+    cg = cgroup.cgroupv1("c1", applied, str(fake_v1["pids"].parent), create=False)
+    cg.update(config)
+    return {path.name: path.read_text() for path in (fake_v1["devices"] / "c1").iterdir()}
+
+
+def test_update_known_config(fake_v1):
+    applied = {"pids": {"limit": 64}, "devices": DEVICES}
+    # 没有变化时不写入任何文件
+    assert update(fake_v1, applied, {"pids": {"limit": 64}, "devices": DEVICES}) == {
+        "devices.allow": "", "devices.deny": ""}
+    assert (fake_v1["pids"] / "c1" / "pids.max").read_text() == "64\n"
+    # 只修改pids时devices不重新写入
+    assert update(fake_v1, applied, {"pids": {"limit": 128}}) == {"devices.allow": "", "devices.deny": ""}
+    assert (fake_v1["pids"] / "c1" / "pids.max").read_text() == "128"
+    # devices变化时写入deny和allow
+    written = update(fake_v1, applied, {"devices": DEVICES[1:]})
+    assert written == {"devices.allow": "c 1:3 rw", "devices.deny": ""}
+
+
+def test_update_unknown_config_skips_write_only_knobs(fake_v1):
+    written = update(fake_v1, None, {"pids": {"limit": 32}, "devices": DEVICES})
+    assert written == {"devices.allow": "", "devices.deny": ""}
+    assert (fake_v1["pids"] / "c1" / "pids.max").read_text() == "32"
@@ -0,0 +1,68 @@
+import os
+
+import logs
+from logs import ContainerLog, LogCollector, log_path, tail_file
+
+
+def lines(path):
+    with open(path, "rb") as f:
+        return [line.split(b" ", 1)[1] for line in f.read().splitlines()]
+
+
+def test_feed_splits_lines_and_keeps_partial(store):
+    log = ContainerLog("c1")
+    log.feed(b"stdout", b"hello\nwor")
+    log.feed(b"stdout", b"ld\n")
+    log.feed(b"stderr", b"oops\n")
+    log.close()
+    assert lines(log_path("c1")) == [b"stdout F hello", b"stdout F world", b"stderr F oops"]
+    # 最近的行保存在内存中
+    assert [line.split(" ", 1)[1] for line in log.tail(2).splitlines()] == ["stdout F world", "stderr F oops"]
+
+
+def test_long_line_is_cut_into_partial_records(store):
+    log = ContainerLog("c1")
+    log.feed(b"stdout", b"x" * (logs.MAX_LINE + 10))
+    log.feed(b"stdout", b"\n")
+    log.close()
+    assert lines(log_path("c1")) == [b"stdout P " + b"x" * logs.MAX_LINE, b"stdout F " + b"x" * 10]
+
+
+def test_rotate_keeps_max_files(store):
+    log = ContainerLog("c1", max_bytes=200, max_files=3)
+    for index in range(20):
+        log.feed(b"stdout", b"line %02d\n" % index)
+    log.close()
+    path = log_path("c1")
+    assert sorted(os.listdir(os.path.dirname(path))) == ["c1.log", "c1.log.1", "c1.log.2"]
+    for name in [path, path + ".1", path + ".2"]:
+        assert 0 < os.path.getsize(name) <= 200
+    # 轮转后的文件按时间顺序拼接，最旧的已经删除
+    kept = lines(path + ".2") + lines(path + ".1") + lines(path)
+    assert kept == [b"stdout F line %02d" % index for index in range(20 - len(kept), 20)]
+    assert [line.split(" ", 1)[1] for line in tail_file(path, 4).splitlines()] == [
+        "stdout F line %02d" % index for index in range(16, 20)]
+
+
+def test_reopen_appends(store):
+    ContainerLog("c1").feed(b"stdout", b"first\n")
+    log = ContainerLog("c1")
+    log.feed(b"stdout", b"second\n")
+    log.close()
+    assert lines(log_path("c1")) == [b"stdout F first", b"stdout F second"]
+
+
+def test_collector_drains_pipes_and_close_is_bounded(store):
+    collector = LogCollector()
+    stdout_r, stdout_w = logs.open_pipe()
+    stderr_r, stderr_w = logs.open_pipe()
+    collector.add("c1", stdout_r, stderr_r)
+    collector.start()
+    os.write(stdout_w, b"out\nlast")
+    os.write(stderr_w, b"err\n")
+    # 写端没有关闭时close在超时后返回False
+    assert collector.close(0.2) is False
+    os.close(stdout_w)
+    os.close(stderr_w)
+    assert collector.close() is True
+    assert sorted(lines(log_path("c1"))) == [b"stderr F err", b"stdout F last", b"stdout F out"]
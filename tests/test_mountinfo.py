@@ -0,0 +1,45 @@
+from cgroup import parse_mountinfo
+
+CONTROLLERS = ["cpu", "cpuacct", "cpuset", "memory", "pids", "hugetlb"]
+
+
+def mountinfo(tmp_path, lines):
+    path = tmp_path / "mountinfo"
+    path.write_text("".join(line + "\n" for line in lines))
+    return str(path)
+
+
+def v1_line(mount_id, mount_point, options):
+    return "{0} 25 0:{0} / {1} rw,nosuid - cgroup cgroup rw,{2}".format(mount_id, mount_point, options)
+
+
+def test_v1_skips_mount_options_and_named_hierarchies(tmp_path):
+    path = mountinfo(tmp_path, [
+        v1_line(30, "/sys/fs/cgroup/systemd", "xattr,name=systemd"),
+        v1_line(31, "/sys/fs/cgroup/cpu,cpuacct", "cpu,cpuacct"),
+        v1_line(32, "/sys/fs/cgroup/memory", "memory"),
+    ])
+    index = parse_mountinfo(path, CONTROLLERS)
+    assert index["unified"] is None
+    assert index["subsystems"] == {"cpu": ("/sys/fs/cgroup/cpu,cpuacct", 1),
+                                   "cpuacct": ("/sys/fs/cgroup/cpu,cpuacct", 1),
+                                   "memory": ("/sys/fs/cgroup/memory", 1)}
+
+
+def test_escaped_mount_point(tmp_path):
+    path = mountinfo(tmp_path, [v1_line(31, "/mnt/cg\\040pids", "pids")])
+    assert parse_mountinfo(path, CONTROLLERS)["subsystems"] == {"pids": ("/mnt/cg pids", 1)}
+
+
+def test_hybrid_prefers_v1_whatever_the_order(tmp_path):
+    unified = tmp_path / "unified"
+    unified.mkdir()
+    (unified / "cgroup.controllers").write_text("memory hugetlb\n")
+    v2_line = "29 25 0:26 / {0} rw - cgroup2 cgroup2 rw,nsdelegate".format(unified)
+    v1_lines = [v1_line(31, "/sys/fs/cgroup/memory", "memory"), v1_line(32, "/sys/fs/cgroup/pids", "pids")]
+    for lines in ([v2_line] + v1_lines, v1_lines + [v2_line]):
+        index = parse_mountinfo(mountinfo(tmp_path, lines), CONTROLLERS)
+        assert index["unified"] == str(unified)
+        assert index["subsystems"] == {"memory": ("/sys/fs/cgroup/memory", 1),
+                                       "pids": ("/sys/fs/cgroup/pids", 1),
+                                       "hugetlb": (str(unified), 2)}
@@ -0,0 +1,106 @@
+import errno
+import socket
+import struct
+
+import pytest
+
+import netlink
+from netlink import NLMSG_ERROR, NLM_F_ACK, NLM_F_REQUEST, NLMSGHDR, RTATTR, Batch, NetlinkError, attr
+
+
+def test_attr_padding_and_nesting():
+    assert attr(netlink.IFLA_IFNAME, "eth0") == RTATTR.pack(9, netlink.IFLA_IFNAME) + b"eth0\0" + b"\0" * 3
+    assert attr(netlink.IFLA_MTU, 1500) == RTATTR.pack(8, netlink.IFLA_MTU) + struct.pack("=I", 1500)
+    inner = attr(netlink.IFLA_INFO_KIND, "veth")
+    assert attr(netlink.IFLA_LINKINFO, [inner]) == RTATTR.pack(4 + len(inner), netlink.IFLA_LINKINFO) + inner
+
+
+def parse_requests(data):
+    result = []
+    offset = 0
+    while offset < len(data):
+        length, msg_type, flags, seq, _ = NLMSGHDR.unpack_from(data, offset)
+        result.append((msg_type, flags, seq))
+        offset += (length + 3) & ~3
+    return result
+
+
+def error_reply(seq, code):
+    return NLMSGHDR.pack(NLMSGHDR.size + 4, NLMSG_ERROR, 0, seq, 0) + struct.pack("=i", -code)
+
+
+class FakeSocket:
+    # 按收到的请求生成回复，replies(requests)返回每次recv的数据，None表示超时
+    def __init__(self, replies):
+        self.replies = replies
+        self.timeout = None
+        self.sent = []
+        self.pending = []
+
+    def gettimeout(self):
+        return self.timeout
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def sendall(self, data):
+        self.sent.append(parse_requests(data))
+        self.pending = list(self.replies(self.sent[-1]))
+
+    def recv(self, size):
+        data = self.pending.pop(0) if self.pending else None
+        if data is None:
+            raise socket.timeout()
+        return data
+
+
+def three_links():
+    batch = Batch()
+    for index in (1, 2, 3):
+        batch.link_up(index)
+    return batch
+
+
+def test_send_requests_ack_only_on_last():
+    sock = FakeSocket(lambda requests: [error_reply(requests[-1][2], 0)])
+    three_links().send(sock)
+    requests = sock.sent[0]
+    assert [msg_type for msg_type, _, _ in requests] == [netlink.RTM_NEWLINK] * 3
+    assert [flags & (NLM_F_REQUEST | NLM_F_ACK) for _, flags, _ in requests] == [
+        NLM_F_REQUEST, NLM_F_REQUEST, NLM_F_REQUEST | NLM_F_ACK]
+    seqs = [seq for _, _, seq in requests]
+    assert seqs == list(range(seqs[0], seqs[0] + 3))
+    assert sock.timeout is None
+
+
+def test_send_fails_on_first_error():
+    # 第二条出错后不再等待最后一条的ACK
+    sock = FakeSocket(lambda requests: [error_reply(requests[1][2], errno.ENODEV)])
+    with pytest.raises(NetlinkError) as info:
+        three_links().send(sock)
+    assert info.value.status == errno.ENODEV
+    assert info.value.message.startswith("link 2 up failed")
+
+
+def test_send_ignores_replies_of_earlier_batches():
+    stale = []
+
+    def replies(requests):
+        result = stale + [error_reply(requests[-1][2], 0)]
+        stale[:] = [error_reply(requests[0][2], errno.EEXIST)]
+        return result
+
+    sock = FakeSocket(replies)
+    three_links().send(sock)
+    # 上一批残留的错误不影响下一批
+    three_links().send(sock)
+    assert sock.sent[0][0][2] != sock.sent[1][0][2]
+
+
+def test_send_times_out():
+    sock = FakeSocket(lambda requests: [])
+    sock.timeout = 1.0
+    with pytest.raises(NetlinkError) as info:
+        three_links().send(sock, timeout=0.1)
+    assert info.value.status == errno.ETIMEDOUT
+    assert sock.timeout == 1.0
@@ -0,0 +1,66 @@
+import os
+import subprocess
+
+import pytest
+
+import state
+
+
+def dead_pid():
+    process = subprocess.Popen(["true"])
+    process.wait()
+    return process.pid
+
+
+def test_record_and_get(store):
+    state.record("c1", status="creating", cgroups=["container_c1"], config_path="/tmp/c1.json")
+    state.record("c1", status="running", pid=10)
+    row = state.get("c1")
+    assert row["status"] == "running"
+    assert row["pid"] == 10
+    # 再次record只修改给出的字段
+    assert row["cgroups"] == ["container_c1"]
+    assert row["config_path"] == "/tmp/c1.json"
+    assert row["mounts"] == []
+    assert state.by_pid(10)["id"] == "c1"
+    assert state.get("missing") is None
+    assert os.path.exists(os.path.join(str(store), "state.db"))
+
+
+def test_unknown_field(store):
+    with pytest.raises(state.StateError):
+        state.record("c1", colour="red")
+
+
+def test_update_containers_filter_and_remove(store):
+    for container_id in ["c1", "c2", "c3"]:
+        state.record(container_id, status="running")
+    state.update(["c1", "c3"], status="exited", exit_code=0)
+    assert [row["id"] for row in state.containers("exited")] == ["c1", "c3"]
+    assert [row["id"] for row in state.containers(["running", "exited"])] == ["c1", "c2", "c3"]
+    assert state.get("c1")["exit_code"] == 0
+    state.remove(["c1", "c2"])
+    assert [row["id"] for row in state.containers()] == ["c3"]
+
+
+def test_store_follows_store_root(store, tmp_path_factory, monkeypatch):
+    state.record("c1", status="running")
+    monkeypatch.setattr(state.image, "STORE_ROOT", str(tmp_path_factory.mktemp("other")))
+    assert state.get("c1") is None
+
+
+def test_recover(store):
+    me = state.owner_fields()
+    gone = dead_pid()
+    state.record("alive", status="running", pid=os.getpid(), pid_start=me["owner_start"])
+    state.record("dead", status="running", pid=gone, pid_start=1)
+    # pid被复用时启动时间不同，也算退出
+    state.record("reused", status="running", pid=os.getpid(), pid_start=me["owner_start"] - 1)
+    # 启动器还在准备的容器没有进程，不算退出
+    state.record("preparing", status="creating", **me)
+    state.record("orphan", status="creating", owner=gone, owner_start=1)
+    state.record("done", status="exited", pid=gone)
+    assert sorted(row["id"] for row in state.recover()) == ["dead", "orphan", "reused"]
+    assert {row["id"]: row["status"] for row in state.containers()} == {
+        "alive": "running", "dead": "exited", "done": "exited", "orphan": "exited", "preparing": "creating",
+        "reused": "exited"}
@@ -0,0 +1,42 @@
+import os
+
+import stats
+
+
+def fake_v1(tmp_path, monkeypatch, names):
+    mounts = {subsystem: tmp_path / subsystem for subsystem in ["cpu", "cpuacct", "memory", "pids", "blkio"]}
+    for subsystem, mount_point in mounts.items():
+        mount_point.mkdir()
+        for name in names.get(subsystem, []):
+            (mount_point / name).mkdir()
+    index = {"subsystems": {k: (str(v), 1) for k, v in mounts.items()}, "unified": None}
+    monkeypatch.setattr(stats, "get_mount_index", lambda: index)
+    monkeypatch.setattr(stats, "use_cgroup_v2", lambda: False)
+    return mounts
+
+
+def test_stat_files_reads_cpuacct(tmp_path, monkeypatch):
+    mounts = fake_v1(tmp_path, monkeypatch, {"cpu": ["c1"], "cpuacct": ["c1"]})
+    files = {filename: path for filename, path, _ in stats.stat_files("c1")}
+    assert files["cpuacct.usage"] == str(mounts["cpuacct"] / "c1" / "cpuacct.usage")
+    assert "cgroup.procs" not in files
+
+
+def test_stat_files_without_cpuacct_cgroup(tmp_path, monkeypatch):
+    # cpuacct单独挂载、容器只有cpu cgroup时，从cpu cgroup中的进程统计
+    mounts = fake_v1(tmp_path, monkeypatch, {"cpu": ["c1"]})
+    procs = mounts["cpu"] / "c1" / "cgroup.procs"
+    procs.write_text("{0}\n".format(os.getpid()))
+    files = {filename: path for filename, path, _ in stats.stat_files("c1")}
+    assert files["cgroup.procs"] == str(procs)
+    assert "cpuacct.usage" not in files
+    container = stats.ContainerStats("c1", stats.stat_files("c1"))
+    try:
+        assert container.sample()["cpu_usage_ns"] > 0
+    finally:
+        container.close()
+
+
+def test_process_cpu_usage_skips_missing_processes():
+    assert stats.process_cpu_usage([b"999999999", b"x"]) == 0
+    assert stats.process_cpu_usage([str(os.getpid())]) > 0
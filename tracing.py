@@ -0,0 +1,134 @@
+import json
+import os
+import select
+import struct
+import threading
+import time
+
+# 默认既不记录也不输出，span()返回共享的空对象，几乎没有开销
+_enabled = False
+_verbose = False
+_events = []
+_sink = None
+# 多线程进程fork出的子进程中，其他线程可能持有sys.stdout的锁，直接写fd
+_raw_output = False
+
+
+def enable(record=True, verbose=False):
+    global _enabled, _verbose
+    _enabled = record
+    _verbose = verbose
+
+
+def enabled():
+    return _enabled
+
+
+def after_fork():
+    global _raw_output
+    _raw_output = True
+
+
+def now_us():
+    # 父子进程使用同一个CLOCK_MONOTONIC，时间戳可以直接比较
+    return time.monotonic_ns() // 1000
+
+
+def event(name, /, **fields):
+    if _verbose:
+        line = " ".join([name] + ["{0}={1}".format(k, v) for k, v in fields.items()])
+        if _raw_output:
+            os.write(1, line.encode() + b'\n')
+        else:
+            print(line)
+    if _enabled:
+        _events.append({"name": name, "ph": "i", "ts": now_us(), "pid": os.getpid(),
+                        "tid": threading.get_ident(), "args": fields})
+
+
+class Span:
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.start = None
+
+    def __enter__(self):
+        self.start = now_us()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _events.append({"name": self.name, "ph": "X", "ts": self.start, "dur": now_us() - self.start,
+                        "pid": os.getpid(), "tid": threading.get_ident(), "args": self.fields})
+        return False
+
+
+class NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+def span(name, /, **fields):
+    if not _enabled:
+        return NOOP_SPAN
+    return Span(name, fields)
+
+
+def events():
+    return list(_events)
+
+
+# 子进程在execve之前把记录的事件写回父进程，fork之前父进程记录的事件不再重复发送
+def set_sink(fd):
+    global _sink
+    _sink = fd
+    del _events[:]
+
+
+def flush():
+    if _sink is None or not _enabled:
+        return
+    payload = json.dumps(_events).encode()
+    data = struct.pack("!I", len(payload)) + payload
+    while data:
+        data = data[os.write(_sink, data):]
+
+
+def receive(fd, pid, timeout=5.0):
+    # 读取子进程发回的事件，以宿主机上的pid标记
+    result = []
+    try:
+        if not select.select([fd], [], [], timeout)[0]:
+            return result
+        header = os.read(fd, 4)
+        if len(header) < 4:
+            return result
+        size = struct.unpack("!I", header)[0]
+        payload = b''
+        while len(payload) < size:
+            chunk = os.read(fd, size - len(payload))
+            if not chunk:
+                return result
+            payload += chunk
+        result = json.loads(payload)
+    finally:
+        os.close(fd)
+    for item in result:
+        item["pid"] = pid
+    _events.extend(result)
+    return result
+
+
+def dump(path, trace_format="json"):
+    items = sorted(_events, key=lambda e: e.get("ts"))
+    if trace_format == "chrome":
+        data = {"traceEvents": items, "displayTimeUnit": "ms"}
+    else:
+        data = {"events": [dict(e, phase=e.get("ph")) for e in items]}
+    with open(path, "w") as f:
+        json.dump(data, f)
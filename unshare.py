@@ -1,5 +1,8 @@
 import ctypes
 import os
+import signal
+
+from tracing import span
 
 CSIGNAL = 0x000000ff  # /* signal mask to be sent at exit */
 CLONE_VM = 0x00000100  # /* set if VM shared between processes */
@@ -26,18 +29,154 @@ CLONE_NEWPID = 0x20000000  # /* New pid namespace */
 CLONE_NEWNET = 0x40000000  # /* New network namespace */
 CLONE_IO = 0x80000000  # /* Clone io context */
 CLONE_NEWTIME	=0x00000080
+CLONE_INTO_CGROUP = 0x200000000  # /* Clone into a specific cgroup given the right permissions */
+
+MS_RDONLY = 0x00000001  # /* Mount read-only */
+MS_NOSUID = 0x00000002  # /* Ignore suid and sgid bits */
+MS_NODEV = 0x00000004  # /* Disallow access to device special files */
+MS_NOEXEC = 0x00000008  # /* Disallow program execution */
+MS_REMOUNT = 0x00000020  # /* Alter flags of a mounted FS */
+MS_BIND = 0x00001000  # /* Create a bind mount */
+MS_MOVE = 0x00002000  # /* Atomically move a subtree */
+MS_REC = 0x00004000  # /* Recursive bind mount / propagation change */
+MS_PRIVATE = 0x00040000  # /* Change to private */
+MS_SLAVE = 0x00080000  # /* Change to slave */
+MS_SHARED = 0x00100000  # /* Change to shared */
+
+MNT_FORCE = 0x00000001  # /* Attempt to forcibily umount */
+MNT_DETACH = 0x00000002  # /* Just detach from the tree */
+
+PR_SET_PDEATHSIG = 1  # /* Second arg is a signal */
+
 libc = ctypes.CDLL("libc.so.6", use_errno=True)
 libc.syscall.argtypes = [ctypes.c_int, ctypes.c_int]
+libc.mount.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p]
+libc.umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+libc.sethostname.argtypes = [ctypes.c_char_p, ctypes.c_size_t]
+libc.setns.argtypes = [ctypes.c_int, ctypes.c_int]
+libc.prctl.argtypes = [ctypes.c_int, ctypes.c_ulong, ctypes.c_ulong, ctypes.c_ulong, ctypes.c_ulong]
+# glibc没有pivot_root的封装，单独取一个syscall函数对象，避免与unshare的argtypes冲突
+_syscall_path2 = libc["syscall"]
+_syscall_path2.argtypes = [ctypes.c_long, ctypes.c_char_p, ctypes.c_char_p]
+# clone3通过PyDLL调用，调用期间不释放GIL，子进程返回时与os.fork一样持有GIL
+_pylibc = ctypes.PyDLL("libc.so.6", use_errno=True)
+_syscall_clone3 = _pylibc["syscall"]
+_syscall_clone3.argtypes = [ctypes.c_long, ctypes.c_void_p, ctypes.c_size_t]
+_syscall_clone3.restype = ctypes.c_long
+for _name in ("PyOS_BeforeFork", "PyOS_AfterFork_Parent", "PyOS_AfterFork_Child"):
+    getattr(ctypes.pythonapi, _name).restype = None
+
+
+class clone_args(ctypes.Structure):
+    # struct clone_args, from linux/sched.h
+    _fields_ = [("flags", ctypes.c_uint64),
+                ("pidfd", ctypes.c_uint64),
+                ("child_tid", ctypes.c_uint64),
+                ("parent_tid", ctypes.c_uint64),
+                ("exit_signal", ctypes.c_uint64),
+                ("stack", ctypes.c_uint64),
+                ("stack_size", ctypes.c_uint64),
+                ("tls", ctypes.c_uint64),
+                ("set_tid", ctypes.c_uint64),
+                ("set_tid_size", ctypes.c_uint64),
+                ("cgroup", ctypes.c_uint64)]
+
+
+def _encode(path):
+    return None if path is None else os.fsencode(path)
+
+
+def _raise_errno(filename=None):
+    errno = ctypes.get_errno()
+    raise OSError(errno, os.strerror(errno), filename)
+
 
 def unshare(flags):
     SYS_unshare = 272  # from asm/unistd_64.h
-    ret = libc.syscall(SYS_unshare, flags)
+    with span("unshare", flags=hex(flags)):
+        ret = libc.syscall(SYS_unshare, flags)
     if ret < 0:
         errno = ctypes.get_errno()
         raise OSError(errno, os.strerror(errno))
     return ret
 
 
+# 与fork一样在子进程中返回0，stack为0时子进程使用父进程栈的副本
+# cgroup_fd为cgroup v2目录的fd时，子进程直接创建在该cgroup中
+def clone3(flags, cgroup_fd=None):
+    SYS_clone3 = 435  # from asm/unistd_64.h
+    args = clone_args(flags=flags, exit_signal=signal.SIGCHLD)
+    if cgroup_fd is not None:
+        args.flags |= CLONE_INTO_CGROUP
+        args.cgroup = cgroup_fd
+    with span("clone3", flags=hex(args.flags)):
+        ctypes.pythonapi.PyOS_BeforeFork()
+        pid = _syscall_clone3(SYS_clone3, ctypes.byref(args), ctypes.sizeof(args))
+        if pid == 0:
+            ctypes.pythonapi.PyOS_AfterFork_Child()
+            return 0
+        errno = ctypes.get_errno()
+        ctypes.pythonapi.PyOS_AfterFork_Parent()
+    if pid < 0:
+        raise OSError(errno, os.strerror(errno))
+    return pid
+
+
+def setns(fd, nstype=0):
+    ret = libc.setns(fd, nstype)
+    if ret < 0:
+        _raise_errno()
+    return ret
+
+
+def reset_pid_namespace():
+    # 每个进程只能unshare一次pid namespace，fork后切回当前的pid namespace，之后才能再次unshare
+    fd = os.open("/proc/self/ns/pid", os.O_RDONLY)
+    try:
+        setns(fd, CLONE_NEWPID)
+    finally:
+        os.close(fd)
+
+
+def set_pdeathsig(sig):
+    ret = libc.prctl(PR_SET_PDEATHSIG, sig, 0, 0, 0)
+    if ret < 0:
+        _raise_errno()
+    return ret
+
+
+def mount(source, target, fs_type=None, flags=0, data=None):
+    with span("mount", target=target, type=fs_type):
+        ret = libc.mount(_encode(source), _encode(target), _encode(fs_type), flags, _encode(data))
+    if ret < 0:
+        _raise_errno(target)
+    return ret
+
+
+def umount2(target, flags=0):
+    ret = libc.umount2(_encode(target), flags)
+    if ret < 0:
+        _raise_errno(target)
+    return ret
+
+
+def pivot_root(new_root, put_old):
+    SYS_pivot_root = 155  # from asm/unistd_64.h
+    with span("pivot_root"):
+        ret = _syscall_path2(SYS_pivot_root, _encode(new_root), _encode(put_old))
+    if ret < 0:
+        _raise_errno(new_root)
+    return ret
+
+
+def sethostname(hostname):
+    name = hostname.encode()
+    ret = libc.sethostname(name, len(name))
+    if ret < 0:
+        _raise_errno()
+    return ret
+
+
 if __name__ == '__main__':
     ret = libc.syscall(272,0x10000000)
     print(ret)
@@ -0,0 +1,114 @@
+import json
+import os
+import signal
+import struct
+import traceback
+from collections import deque
+
+from unshare import *
+
+# 预先创建的namespace
+# mount namespace要在rootfs挂载之后创建，cgroup namespace要在加入cgroup之后创建，都放到启动时
+ZYGOTE_FLAGS = CLONE_NEWUTS | CLONE_NEWIPC | CLONE_NEWNET
+
+
+def zygote_accepts(namespaces):
+    # zygote中已经存在的namespace不能撤销，容器需要的这部分namespace必须与zygote完全相同
+    return namespaces & ZYGOTE_FLAGS == ZYGOTE_FLAGS
+
+
+def read_exact(fd, size):
+    data = b''
+    while len(data) < size:
+        chunk = os.read(fd, size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+class Zygote:
+    def __init__(self, pid, control_w):
+        self.pid = pid
+        self.control_w = control_w
+
+
+class ZygotePool:
+    # 维护一组已经处于新namespace中、阻塞在控制管道上的子进程
+    # activate(config)在子进程中执行，完成pivot_root、hostname等剩余步骤后execve
+    # 只在主线程中使用：zygote由主线程fork，PR_SET_PDEATHSIG跟随创建它的线程，主线程退出时zygote才退出
+    def __init__(self, size, activate):
+        self.size = size
+        self.activate = activate
+        self.idle = deque()
+        self.closed = False
+        self.refill()
+
+    def fork_zygote(self):
+        unshare(CLONE_NEWPID)
+        control_r, control_w = os.pipe()
+        pid = os.fork()
+        if not pid:
+            os.close(control_w)
+            # 其他zygote的控制管道不属于这个进程
+            for zygote in list(self.idle):
+                os.close(zygote.control_w)
+            try:
+                self.park(control_r)
+            except BaseException:
+                # 其他线程可能持有stderr的锁，不经过sys.stderr
+                os.write(2, traceback.format_exc().encode(errors="replace"))
+            os._exit(1)
+        reset_pid_namespace()
+        os.close(control_r)
+        return Zygote(pid, control_w)
+
+    def park(self, control_r):
+        # 启动器退出时，未被使用的zygote随之退出
+        # zygote是新pid namespace的init，getppid()总是0，不能用来检查启动器是否还在
+        # 设置之前启动器已经退出时，控制管道的写端已经关闭，下面的read返回EOF后退出
+        set_pdeathsig(signal.SIGKILL)
+        unshare(ZYGOTE_FLAGS)
+        header = read_exact(control_r, 4)
+        if header is None:
+            os._exit(0)
+        payload = read_exact(control_r, struct.unpack("!I", header)[0])
+        if payload is None:
+            os._exit(0)
+        os.close(control_r)
+        set_pdeathsig(0)
+        self.activate(json.loads(payload))
+
+    # 补足空闲的zygote，由主线程在启动容器的间隙调用
+    def refill(self, count=None):
+        missing = self.size - len(self.idle)
+        for _ in range(missing if count is None else min(count, missing)):
+            if self.closed:
+                return
+            self.idle.append(self.fork_zygote())
+
+    # 取出一个空闲的zygote，池为空时返回None，由调用者走普通启动流程
+    def acquire(self):
+        return self.idle.popleft() if self.idle else None
+
+    def start(self, zygote, config, cg):
+        cg.apply([zygote.pid])
+        payload = json.dumps(config).encode()
+        os.write(zygote.control_w, struct.pack("!I", len(payload)) + payload)
+        os.close(zygote.control_w)
+
+    def kill(self, zygote):
+        try:
+            os.close(zygote.control_w)
+        except OSError:
+            pass
+        try:
+            os.kill(zygote.pid, signal.SIGKILL)
+            os.waitpid(zygote.pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+
+    def close(self):
+        self.closed = True
+        while self.idle:
+            self.kill(self.idle.popleft())